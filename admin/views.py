@@ -16,6 +16,9 @@ from models import db, User, DigitalAsset, DigitalWill, PlatformPolicy, Story, F
 from .decorators import admin_required
 from .stats import get_dashboard_stats, get_user_growth_data, get_activity_data
 from .crud import user_crud, asset_crud, will_crud, content_crud
+from ai.vector_index import knowledge_index, SOURCE_EXTERNAL
+from ai.embedding_store import schedule_prune
+from ai.jobs import JOB_EXTERNAL_SYNC, JobError, enqueue_job, get_job, has_active_job, register_job_handler
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -929,20 +932,21 @@ def api_list_external_knowledge():
     return jsonify({'success': True, 'links': data})
 
 
-def _sync_knowledge_from_provider(link):
+def _sync_knowledge_from_provider(link, progress=None):
     """
     核心同步函数：通过对应提供者获取内容 → 切分 → 向量化 → 存储
     
     Args:
         link: ExternalKnowledge 实例
+        progress: 进度回调(可选)，签名同 JobContext.progress(stage, done, total)
     
     Returns:
         tuple: (success: bool, message: str, chunk_count: int)
     """
     from ai.knowledge_providers import get_provider
     from ai.chunker import split_text
-    from ai.embedding import embed_texts
-    import json
+    from flask import current_app
+    from ai.embedding_store import embed_texts_dedup
     from models import get_china_time
 
     # 获取提供者实例并验证配置
@@ -961,32 +965,47 @@ def _sync_knowledge_from_provider(link):
         text = provider.fetch_content()
     except Exception as e:
         return False, f"获取内容失败: {str(e)}", 0
+    progress = progress or (lambda *args, **kwargs: None)
+    progress('parsed')
 
     # 切分文本
     chunks = split_text(text, chunk_size=500, chunk_overlap=50)
     if not chunks:
         return False, "内容切分后无有效片段", 0
+    progress('chunked', 0, len(chunks))
 
-    # 生成向量
+    # 生成向量（内容未变的文本块复用已存储的向量，只对新增/修改的片段调用API）
     try:
-        embeddings = embed_texts(chunks)
+        embeddings, hashes = embed_texts_dedup(
+            chunks, window=current_app.config.get('INGESTION_EMBED_WINDOW', 128),
+            on_progress=lambda done, total: progress('embedding', done, total), return_hashes=True)
     except Exception as emb_err:
         return False, f"向量化失败: {str(emb_err)}", 0
 
     # 删除旧chunks，写入新chunks
     ExternalKnowledgeChunk.query.filter_by(external_id=link.id).delete()
-    for idx, (chunk_text, embedding) in enumerate(zip(chunks, embeddings)):
+    new_chunks = []
+    for idx, (chunk_text, embedding, chunk_hash) in enumerate(zip(chunks, embeddings, hashes)):
         chunk = ExternalKnowledgeChunk(
             external_id=link.id,
             chunk_index=idx,
             content=chunk_text,
-            embedding=json.dumps(embedding, ensure_ascii=False)
+            content_hash=chunk_hash
         )
+        chunk.set_embedding(embedding)
         db.session.add(chunk)
+        new_chunks.append(chunk)
 
     link.chunk_count = len(chunks)
     link.last_synced = get_china_time()
 
+    # 增量更新进程内向量索引（调用方随后提交；若提交失败，索引指纹比对会触发重建）
+    db.session.flush()
+    if link.is_active:
+        knowledge_index.replace(SOURCE_EXTERNAL, link.id,
+                                [(c.id, c.content, e, c.chunk_index) for c, e in zip(new_chunks, embeddings)],
+                                source_name=link.name)
+
     return True, f"成功同步，共 {len(chunks)} 个知识片段", len(chunks)
 
 
@@ -1017,21 +1036,27 @@ def api_add_external_knowledge():
     )
     ext.set_config(config)
     db.session.add(ext)
-    db.session.flush()
-
-    # 执行同步
-    success, message, chunk_count = _sync_knowledge_from_provider(ext)
+    db.session.commit()
+    ext_id = ext.id
 
-    if success:
-        db.session.commit()
-        return jsonify({
-            'success': True,
-            'message': f'"{name}" - {message}',
-            'chunk_count': chunk_count
-        })
-    else:
+    # 在后台同步；同步失败时删除本次新建的链接，与原先"添加失败则不保存"的行为一致
+    try:
+        job_id = enqueue_job(JOB_EXTERNAL_SYNC, current_user.id, name, target_id=ext_id,
+                             options={'delete_on_failure': True})
+    except Exception as e:
+        # 任务未能创建时链接永远不会被同步，随即删除
         db.session.rollback()
-        return jsonify({'success': False, 'message': f'添加失败: {message}'}), 400
+        stale = db.session.get(ExternalKnowledge, ext_id)
+        if stale is not None:
+            db.session.delete(stale)
+            db.session.commit()
+        return jsonify({'success': False, 'message': f'创建同步任务失败: {str(e)}'}), 500
+    return jsonify({
+        'success': True,
+        'message': f'"{name}" 已添加，正在后台同步内容',
+        'job_id': job_id,
+        'job': get_job(job_id)
+    }), 202
 
 
 @admin_bp.route('/api/external-knowledge/<int:link_id>', methods=['DELETE'])
@@ -1042,6 +1067,8 @@ def api_delete_external_knowledge(link_id):
     try:
         db.session.delete(link)
         db.session.commit()
+        knowledge_index.remove(SOURCE_EXTERNAL, link_id)
+        schedule_prune()
         return jsonify({'success': True, 'message': '已删除外部知识库链接'})
     except Exception as e:
         db.session.rollback()
@@ -1056,6 +1083,10 @@ def api_toggle_external_knowledge(link_id):
     link.is_active = not link.is_active
     try:
         db.session.commit()
+        if link.is_active:
+            knowledge_index.reload(SOURCE_EXTERNAL, link.id)
+        else:
+            knowledge_index.remove(SOURCE_EXTERNAL, link.id)
         return jsonify({'success': True, 'is_active': link.is_active})
     except Exception as e:
         db.session.rollback()
@@ -1067,21 +1098,73 @@ def api_toggle_external_knowledge(link_id):
 def api_sync_external_knowledge(link_id):
     """重新同步外部知识库链接内容"""
     link = ExternalKnowledge.query.get_or_404(link_id)
+    if has_active_job(JOB_EXTERNAL_SYNC, target_id=link.id):
+        return jsonify({'success': False, 'message': f'"{link.name}" 正在后台同步中，请稍候'}), 400
+
+    try:
+        job_id = enqueue_job(JOB_EXTERNAL_SYNC, current_user.id, link.name, target_id=link.id)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'创建同步任务失败: {str(e)}'}), 500
+    return jsonify({
+        'success': True,
+        'message': f'"{link.name}" 正在后台同步',
+        'job_id': job_id,
+        'job': get_job(job_id)
+    }), 202
+
+
+def _run_external_sync_job(job):
+    """后台任务：同步外部知识库链接（添加或重新同步）
+
+    Args:
+        job: ai.jobs.JobContext，target_id 为 ExternalKnowledge.id；
+             options['delete_on_failure'] 为真时同步失败会删除该链接（新添加的链接）
+
+    Returns:
+        str: 成功信息
+    """
+    link = db.session.get(ExternalKnowledge, job.target_id)
+    if link is None:
+        raise JobError('外部知识库链接不存在或已删除')
 
     try:
-        success, message, chunk_count = _sync_knowledge_from_provider(link)
+        success, message, chunk_count = _sync_knowledge_from_provider(link, progress=job.progress)
         if success:
             db.session.commit()
-            return jsonify({
-                'success': True,
-                'message': f'"{link.name}" - {message}',
-                'chunk_count': chunk_count
-            })
-        else:
-            db.session.rollback()
-            return jsonify({'success': False, 'message': f'同步失败: {message}'}), 400
+            job.progress('committed', chunk_count, chunk_count)
+            # 页面修改后旧文本块的向量不再被引用
+            schedule_prune()
+            return f'"{link.name}" - {message}'
     except Exception as e:
-        db.session.rollback()
-        return jsonify({'success': False, 'message': f'同步异常: {str(e)}'}), 500
+        success, message = False, f'同步异常: {str(e)}'
+
+    db.session.rollback()
+    if job.options.get('delete_on_failure'):
+        link = db.session.get(ExternalKnowledge, job.target_id)
+        if link is not None:
+            db.session.delete(link)
+            db.session.commit()
+            knowledge_index.remove(SOURCE_EXTERNAL, job.target_id)
+        raise JobError(f'添加失败: {message}')
+    raise JobError(f'同步失败: {message}')
+
+
+register_job_handler(JOB_EXTERNAL_SYNC, _run_external_sync_job)
+
+
+@admin_bp.route('/api/jobs/<int:job_id>')
+@admin_required
+def api_job_status(job_id):
+    """查询知识库后台任务进度（上传文件/同步外部知识库）
+
+    返回(JSON):
+        - job: 任务状态，含 status(queued/running/succeeded/failed)、
+               stage(parsed/chunked/embedding/committed)、progress_done/progress_total、message
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job})
 
 
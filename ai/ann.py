@@ -0,0 +1,205 @@
+"""
+近似最近邻(ANN) - IVF 倒排索引
+
+知识库规模很大(数万~数十万文本块)时，逐块精确打分的耗时与块数成正比。
+IVF(Inverted File) 先用球面 k-means 把归一化向量聚成 n_list 个簇，
+检索时只对与问题最接近的 n_probe 个簇内的向量打分：
+
+    1. 问题向量 与 n_list 个簇中心打分，取 top n_probe 个簇
+    2. 仅对这些簇内的向量计算余弦相似度，取 top-k
+
+簇中心与每个文本块的簇归属可序列化到磁盘(.npz)，
+多 worker / 重启后直接加载，无需重新训练 k-means。
+
+配置(环境变量，见 config.py):
+    RAG_INDEX_ENGINE: 'exact'(默认，精确扫描) | 'ivf'
+    RAG_IVF_NLIST: 簇数量，0 表示自动取 sqrt(块数)
+    RAG_IVF_NPROBE: 检索时探查的簇数量，越大召回越高、越慢
+    RAG_IVF_MIN_CHUNKS: 块数低于此值时仍使用精确扫描
+"""
+import os
+
+import numpy as np
+
+
+def get_ann_settings():
+    """读取 ANN 相关配置
+
+    Returns:
+        dict: engine / n_list / n_probe / min_chunks
+    """
+    return {
+        'engine': os.environ.get('RAG_INDEX_ENGINE', 'exact').lower(),
+        'n_list': int(os.environ.get('RAG_IVF_NLIST', '0')),
+        'n_probe': int(os.environ.get('RAG_IVF_NPROBE', '8')),
+        'min_chunks': int(os.environ.get('RAG_IVF_MIN_CHUNKS', '2000')),
+    }
+
+
+def auto_n_list(n):
+    """根据向量数量自动确定簇数量（约 sqrt(n)，至少1）"""
+    return max(1, int(round(np.sqrt(n))))
+
+
+def assign_lists(matrix, centroids, batch_size=8192):
+    """将归一化向量分配到最相似的簇中心
+
+    Args:
+        matrix: 归一化向量矩阵(numpy.ndarray, shape=(n, d))
+        centroids: 簇中心矩阵(numpy.ndarray, shape=(n_list, d))
+        batch_size: 分批大小(int)，避免 n×n_list 打分矩阵过大
+
+    Returns:
+        numpy.ndarray: 每个向量的簇编号(int32, shape=(n,))
+    """
+    n = matrix.shape[0]
+    lists = np.empty(n, dtype=np.int32)
+    for start in range(0, n, batch_size):
+        block = matrix[start:start + batch_size]
+        lists[start:start + batch_size] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+
+def train_centroids(matrix, n_list, n_iter=10, sample_size=None, seed=0):
+    """球面 k-means 训练簇中心（向量已归一化，以内积作为相似度）
+
+    Args:
+        matrix: 归一化向量矩阵(numpy.ndarray, shape=(n, d))
+        n_list: 簇数量(int)
+        n_iter: 迭代次数(int)，默认10
+        sample_size: 训练采样数量(int)，默认 min(n, 256*n_list)，大语料只用样本训练
+        seed: 随机种子(int)
+
+    Returns:
+        numpy.ndarray: 归一化的簇中心矩阵(float32, shape=(n_list, d))
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    n_list = max(1, min(n_list, n))
+    if sample_size is None:
+        sample_size = 256 * n_list
+    if n > sample_size:
+        sample = matrix[rng.choice(n, sample_size, replace=False)]
+    else:
+        sample = matrix
+
+    centroids = sample[rng.choice(sample.shape[0], n_list, replace=False)].copy()
+    for _ in range(n_iter):
+        lists = assign_lists(sample, centroids)
+        counts = np.bincount(lists, minlength=n_list)
+        # 按簇排序后分段求和（比 np.add.at 快得多）
+        order = np.argsort(lists, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+        # 空簇重新随机选一个样本点作为中心
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            sums[empty] = sample[rng.choice(sample.shape[0], empty.size, replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def probe_candidates(query, centroids, lists, n_probe):
+    """找出与查询最接近的 n_probe 个簇内的全部向量位置
+
+    Args:
+        query: 归一化查询向量(numpy.ndarray, shape=(d,))
+        centroids: 簇中心矩阵(numpy.ndarray)
+        lists: 每个向量的簇编号(numpy.ndarray)，-1 表示未分配
+        n_probe: 探查簇数量(int)
+
+    Returns:
+        numpy.ndarray: 候选向量在矩阵中的位置
+    """
+    n_list = centroids.shape[0]
+    n_probe = max(1, min(n_probe, n_list))
+    centroid_scores = centroids @ query
+    if n_probe < n_list:
+        probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+    else:
+        probe = np.arange(n_list)
+    return np.flatnonzero(np.isin(lists, probe))
+
+
+# ==============================================================================
+# 序列化
+# ==============================================================================
+def get_ivf_index_path():
+    """获取IVF索引文件路径
+
+    环境变量 RAG_IVF_INDEX_PATH 优先，否则为 DATA_DIR/knowledge_ivf.npz
+    """
+    path = os.environ.get('RAG_IVF_INDEX_PATH')
+    if path:
+        return path
+    try:
+        from flask import current_app
+        data_dir = current_app.config.get('DATA_DIR', 'instance')
+    except RuntimeError:
+        data_dir = 'instance'
+    return os.path.join(data_dir, 'knowledge_ivf.npz')
+
+
+def save_ivf(path, centroids, keys, lists, trained_rows):
+    """将簇中心和簇归属保存到 .npz 文件（先写临时文件再原子替换）
+
+    Args:
+        path: 文件路径(str)
+        centroids: 簇中心矩阵(numpy.ndarray)
+        keys: 每个向量的唯一键(numpy.ndarray[int64])，由来源类型和块ID组合而成
+        lists: 每个向量的簇编号(numpy.ndarray[int32])
+        trained_rows: 训练时的向量数量(int)，用于判断语料规模变化后是否需要重新训练
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, centroids=centroids, keys=keys, lists=lists,
+                 trained_rows=np.int64(trained_rows))
+    os.replace(tmp_path, path)
+
+
+def load_ivf(path):
+    """从 .npz 文件加载簇中心和簇归属
+
+    Returns:
+        dict 或 None: 包含 centroids / keys / lists / trained_rows，文件不存在或损坏时返回None
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {
+                'centroids': data['centroids'].astype(np.float32),
+                'keys': data['keys'],
+                'lists': data['lists'].astype(np.int32),
+                'trained_rows': int(data['trained_rows']),
+            }
+    except (OSError, KeyError, ValueError) as e:
+        print(f"[WARN] 加载IVF索引文件失败，将重新训练: {e}")
+        return None
+
+
+def lookup_lists(saved_keys, saved_lists, keys):
+    """按键从已保存的簇归属中查找，找不到的返回 -1
+
+    Args:
+        saved_keys: 已保存的键(numpy.ndarray[int64])
+        saved_lists: 已保存的簇编号(numpy.ndarray[int32])
+        keys: 待查询的键(numpy.ndarray[int64])
+
+    Returns:
+        numpy.ndarray: 簇编号(int32)，未找到为 -1
+    """
+    result = np.full(keys.shape[0], -1, dtype=np.int32)
+    if saved_keys.size == 0:
+        return result
+    order = np.argsort(saved_keys)
+    sorted_keys = saved_keys[order]
+    pos = np.clip(np.searchsorted(sorted_keys, keys), 0, sorted_keys.size - 1)
+    found = sorted_keys[pos] == keys
+    result[found] = saved_lists[order[pos[found]]]
+    return result
@@ -0,0 +1,198 @@
+"""
+回答缓存 - 相同/相近的常见问题直接复用已生成的回答
+
+绝大多数对话都是几十个典型问题（微信/QQ/抖音账号如何继承等）的变体，
+每次都要完整检索并调用一次LLM生成。本模块缓存知识库问答的回答:
+
+    键: 问题向量(余弦相似度 ≥ ANSWER_CACHE_SIMILARITY 视为同一问题)
+        + 检索到的文本块指纹(来源 + 块ID，必须完全一致，保证回答依据的资料相同)
+        规范化后的问题文本与指纹都相同时直接命中；关键词结果明确而跳过了向量检索的提问
+        没有问题向量，只按 规范化文本 + 指纹 精确匹配（不为查缓存额外调用 Embedding API）
+    值: 回答文本与引用来源
+
+适用范围: 无图片、无历史对话(会话第一问)、且检索到了知识库内容的提问；
+使用网络搜索补充的回答不缓存（搜索结果随时间变化）。
+
+失效: 知识库索引版本号(KnowledgeIndex.generation)变化时清空全部缓存，
+即任何文件上传/删除、外部知识库同步/启停、多worker间的索引重建之后都不会命中旧回答。
+容量超出 ANSWER_CACHE_SIZE 时按 LRU 淘汰，条目超过 ANSWER_CACHE_TTL 秒过期。
+
+配置(环境变量，见 config.py):
+    ANSWER_CACHE_SIZE: 每进程缓存条数上限，0 表示禁用
+    ANSWER_CACHE_SIMILARITY: 命中所需的问题向量相似度
+    ANSWER_CACHE_TTL: 缓存存活时间(秒)
+"""
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# 回放缓存回答时每个流式片段的字符数
+REPLAY_CHUNK_CHARS = 8
+
+
+def get_answer_cache_settings():
+    """读取回答缓存配置
+
+    Returns:
+        dict: size / similarity / ttl
+    """
+    return {
+        'size': int(os.environ.get('ANSWER_CACHE_SIZE', '256')),
+        'similarity': float(os.environ.get('ANSWER_CACHE_SIMILARITY', '0.95')),
+        'ttl': float(os.environ.get('ANSWER_CACHE_TTL', '86400')),
+    }
+
+
+def chunk_fingerprint(chunks):
+    """检索结果指纹: 排序后的 (来源, 块ID) 的 sha1
+
+    Args:
+        chunks: retrieve_knowledge() 的结果
+
+    Returns:
+        str: 40位十六进制字符串
+    """
+    keys = sorted(f"{chunk['source']}\x00{chunk['chunk_id']}" for chunk in chunks)
+    return hashlib.sha1('\x01'.join(keys).encode('utf-8')).hexdigest()
+
+
+def replay_answer(answer):
+    """把缓存的回答切成小片段逐个产出，模拟流式输出
+
+    Yields:
+        str: 回答片段
+    """
+    for start in range(0, len(answer), REPLAY_CHUNK_CHARS):
+        yield answer[start:start + REPLAY_CHUNK_CHARS]
+
+
+class AnswerCache:
+    """语义回答缓存（进程内 LRU），线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # 条目ID -> dict(vector, text, fingerprint, answer, sources, created)
+        self._ids = itertools.count()
+        self._generation = None
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evicted': 0, 'invalidated': 0}
+
+    def _check_generation(self, generation):
+        """知识库版本变化时清空缓存（调用方需持有锁）"""
+        if generation != self._generation:
+            if self._entries:
+                self._stats['invalidated'] += len(self._entries)
+                self._entries.clear()
+            self._generation = generation
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def get(self, vector, text, fingerprint, generation):
+        """查找相近问题的缓存回答
+
+        Args:
+            vector: 问题向量，None 表示只按问题文本精确匹配
+            text: 规范化后的问题文本(normalize_query 的结果)
+            fingerprint: chunk_fingerprint() 的结果
+            generation: 当前知识库索引版本号
+
+        Returns:
+            dict 或 None: 命中时返回 {'answer', 'sources', 'similarity'}
+        """
+        settings = get_answer_cache_settings()
+        if settings['size'] <= 0:
+            return None
+        query = self._normalize(vector) if vector is not None else None
+        now = time.time()
+        with self._lock:
+            self._check_generation(generation)
+            best_id, best_score = None, settings['similarity']
+            for entry_id, entry in list(self._entries.items()):
+                if now - entry['created'] > settings['ttl']:
+                    del self._entries[entry_id]
+                    continue
+                if entry['fingerprint'] != fingerprint:
+                    continue
+                if entry['text'] == text:
+                    score = 1.0
+                elif query is not None and entry['vector'] is not None and entry['vector'].shape == query.shape:
+                    score = float(entry['vector'] @ query)
+                else:
+                    continue
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self._stats['hits'] += 1
+            entry = self._entries[best_id]
+            return {'answer': entry['answer'], 'sources': list(entry['sources']),
+                    'similarity': round(best_score, 4)}
+
+    def put(self, vector, text, fingerprint, generation, answer, sources):
+        """写入回答（生成期间知识库已变化则不写入；vector 为 None 时只能被相同文本命中）"""
+        settings = get_answer_cache_settings()
+        if settings['size'] <= 0 or not answer:
+            return
+        query = self._normalize(vector) if vector is not None else None
+        with self._lock:
+            self._check_generation(generation)
+            if generation != self._generation:
+                return
+            # 与已有条目几乎相同的问题直接覆盖，避免重复占用容量
+            for entry_id, entry in list(self._entries.items()):
+                if entry['fingerprint'] != fingerprint:
+                    continue
+                if entry['text'] == text or (
+                        query is not None and entry['vector'] is not None
+                        and entry['vector'].shape == query.shape and float(entry['vector'] @ query) >= 0.999):
+                    del self._entries[entry_id]
+            self._entries[next(self._ids)] = {
+                'vector': query, 'text': text, 'fingerprint': fingerprint, 'answer': answer,
+                'sources': list(sources), 'created': time.time(),
+            }
+            self._stats['stores'] += 1
+            while len(self._entries) > settings['size']:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def stats(self):
+        """命中/未命中计数及当前条数
+
+        Returns:
+            dict: hits / misses / stores / evicted / invalidated / size / capacity / hit_rate
+        """
+        settings = get_answer_cache_settings()
+        with self._lock:
+            result = dict(self._stats)
+            result['size'] = len(self._entries)
+        result['capacity'] = settings['size']
+        lookups = result['hits'] + result['misses']
+        result['hit_rate'] = round(result['hits'] / lookups, 4) if lookups else 0.0
+        return result
+
+    def clear(self):
+        """清空缓存和计数"""
+        with self._lock:
+            self._entries.clear()
+            for name in self._stats:
+                self._stats[name] = 0
+
+
+# 全局单例
+answer_cache = AnswerCache()
+
+
+def get_answer_cache_stats():
+    """本进程回答缓存的命中统计（用于健康检查接口）"""
+    return answer_cache.stats()
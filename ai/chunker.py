@@ -3,6 +3,14 @@
 RAG的核心步骤之一：合理的分块策略直接影响检索效果
 """
 
+from collections import namedtuple
+
+# 短于此字符数的块被丢弃（可能是空块或仅含标点）
+MIN_CHUNK_CHARS = 10
+
+# 流式切分产出的文本块: text 为块文本；[start, end) 为块在片段流(全部片段依次拼接)中覆盖的字符区间
+Chunk = namedtuple('Chunk', ['text', 'start', 'end'])
+
 
 def split_text(text, chunk_size=500, chunk_overlap=50):
     """将长文本切分为固定长度的文本块，相邻块之间有重叠
@@ -25,45 +33,77 @@ def split_text(text, chunk_size=500, chunk_overlap=50):
     """
     if not text or not text.strip():
         return []
+    return [chunk.text for chunk in iter_chunks([text], chunk_size, chunk_overlap)]
 
-    # 按段落分割
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
 
-    chunks = []
-    current_chunk = ""
+def _iter_paragraphs(segments):
+    """把文本片段流拆成段落流（按双换行符分割，去除首尾空白）
+
+    Yields:
+        tuple: (段落文本, 起始偏移, 结束偏移)，偏移为段落在片段流中的位置
+    """
+    base = 0
+    for segment in segments:
+        pos = base
+        for part in segment.split('\n\n'):
+            stripped = part.strip()
+            if stripped:
+                start = pos + len(part) - len(part.lstrip())
+                yield stripped, start, start + len(stripped)
+            pos += len(part) + 2
+        base += len(segment)
+
+
+def iter_chunks(segments, chunk_size=500, chunk_overlap=50):
+    """流式切分：逐个消费文本片段（页/段落），逐个产出带偏移的文本块
 
-    for para in paragraphs:
+    与 split_text 的分块策略完全相同（split_text 即 iter_chunks([text]) 的块文本），
+    但不需要先拼出完整文本，也不保存已产出的块，内存占用只与 chunk_size 有关。
+
+    Args:
+        segments: 文本片段的可迭代对象(如 ai.document_parser.iter_document 的结果)
+        chunk_size: 每个文本块的最大字符数(int)，默认500
+        chunk_overlap: 相邻块之间的重叠字符数(int)，默认50
+
+    Yields:
+        Chunk: (text, start, end)。偏移相对于片段流（全部片段依次拼接，不插入分隔符）；
+        由多个段落合并的块，text 中段落以双换行连接，与原文区间内的空白可能不同
+    """
+    current_chunk, current_start, current_end = "", 0, 0
+    last_emitted = None  # 最近一个产出(过滤前)的块，硬切分后的重叠部分从这里截取
+
+    for para, para_start, para_end in _iter_paragraphs(segments):
         # 如果当前块加上这个段落不超过限制，则合并
         if len(current_chunk) + len(para) + 2 <= chunk_size:
             if current_chunk:
                 current_chunk += '\n\n' + para
             else:
-                current_chunk = para
+                current_chunk, current_start = para, para_start
+            current_end = para_end
         else:
-            # 当前块已满，先保存
+            # 当前块已满，先产出
             if current_chunk:
-                chunks.append(current_chunk)
+                last_emitted = current_chunk
+                if len(current_chunk.strip()) >= MIN_CHUNK_CHARS:
+                    yield Chunk(current_chunk, current_start, current_end)
             # 如果段落本身超过chunk_size，需要硬切分
             if len(para) > chunk_size:
-                # 先把current_chunk中不足一个chunk的部分处理完
-                sub_chunks = _hard_split(para, chunk_size, chunk_overlap)
-                chunks.extend(sub_chunks)
-                # 最后一个子块作为新的current_chunk继续合并
-                if chunks and chunk_overlap > 0:
-                    current_chunk = chunks[-1][-chunk_overlap:] if len(chunks[-1]) > chunk_overlap else chunks[-1]
+                for sub_chunk, sub_start in _hard_split(para, chunk_size, chunk_overlap):
+                    last_emitted = sub_chunk
+                    if len(sub_chunk.strip()) >= MIN_CHUNK_CHARS:
+                        yield Chunk(sub_chunk, para_start + sub_start, para_start + sub_start + len(sub_chunk))
+                # 最后一个子块(止于段落末尾)的末尾作为新的current_chunk继续合并
+                if last_emitted is not None and chunk_overlap > 0:
+                    current_chunk = last_emitted[-chunk_overlap:] if len(last_emitted) > chunk_overlap else last_emitted
+                    current_start, current_end = para_end - len(current_chunk), para_end
                 else:
                     current_chunk = ""
             else:
-                current_chunk = para
+                current_chunk, current_start, current_end = para, para_start, para_end
 
     # 不要忘记最后一个块
-    if current_chunk:
-        chunks.append(current_chunk)
-
-    # 去除过短的块（可能是空块或仅含标点）
-    chunks = [c for c in chunks if len(c.strip()) >= 10]
-
-    return chunks
+    if current_chunk and len(current_chunk.strip()) >= MIN_CHUNK_CHARS:
+        yield Chunk(current_chunk, current_start, current_end)
 
 
 def _hard_split(text, chunk_size, chunk_overlap):
@@ -75,10 +115,10 @@ def _hard_split(text, chunk_size, chunk_overlap):
         chunk_overlap: 重叠字符数(int)
     
     Returns:
-        list[str]: 切分后的文本块列表
+        list[tuple]: 切分后的 (文本块, 在 text 中的起始位置) 列表
     
     示例(chunk_size=10, overlap=3):
-        "ABCDEFGHIJKLMNO" -> ["ABCDEFGHIJ", "HIJKLMNO"]  (HIJ为重叠部分)
+        "ABCDEFGHIJKLMNO" -> [("ABCDEFGHIJ", 0), ("HIJKLMNO", 7)]  (HIJ为重叠部分)
     """
     chunks = []
     start = 0
@@ -86,7 +126,7 @@ def _hard_split(text, chunk_size, chunk_overlap):
         end = start + chunk_size
         chunk = text[start:end]
         if chunk.strip():
-            chunks.append(chunk)
+            chunks.append((chunk, start))
         # 下一个块的起始位置后退overlap个字符，形成重叠
         start = end - chunk_overlap
         # 防止overlap过大导致无限循环
@@ -1,9 +1,35 @@
 """
 文档解析器 - 从上传的文件中提取纯文本内容
 支持格式: PDF, TXT, Markdown, DOCX
+
+每种格式都有两种接口:
+  - iter_xxx / iter_document: 生成器，按页(PDF)或段落(TXT/MD/DOCX)逐段产出文本，
+    配合 ai.chunker.iter_chunks 流式切分，内存占用与文档大小无关
+  - parse_xxx / parse_document: 返回完整文本(各段以空行连接)，与流式结果等价
 """
+import codecs
 import io
 
+# 流式解码TXT时每次读取的字节数
+_READ_BLOCK = 64 * 1024
+
+
+def iter_pdf(file_data):
+    """逐页产出PDF文本（跳过无文字的页）
+
+    Args:
+        file_data: PDF文件的二进制内容(bytes)
+
+    Yields:
+        str: 单页文本
+    """
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(file_data))
+    for page in reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            yield page_text
+
 
 def parse_pdf(file_data):
     """从PDF二进制数据中提取文本
@@ -18,14 +44,45 @@ def parse_pdf(file_data):
         使用 PyPDF2 逐页提取文本，适用于文字型PDF
         扫描件/图片型PDF无法提取，需要OCR（暂不支持）
     """
-    from PyPDF2 import PdfReader
-    text_parts = []
-    reader = PdfReader(io.BytesIO(file_data))
-    for page in reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text_parts.append(page_text)
-    return '\n\n'.join(text_parts)
+    return '\n\n'.join(iter_pdf(file_data))
+
+
+def _detect_text_encoding(file_data):
+    """判断文本编码：能完整按UTF-8解码则为UTF-8，否则按GBK处理
+
+    使用增量解码器分块校验，不生成完整的解码字符串
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(file_data), _READ_BLOCK):
+            decoder.decode(file_data[start:start + _READ_BLOCK])
+        decoder.decode(b'', final=True)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'gbk'
+
+
+def iter_txt(file_data):
+    """逐段产出TXT文本（以空行分段），按行流式解码
+
+    Args:
+        file_data: TXT文件的二进制内容(bytes)
+
+    Yields:
+        str: 段落文本（不含段落之间的空行）
+    """
+    encoding = _detect_text_encoding(file_data)
+    errors = 'strict' if encoding == 'utf-8' else 'ignore'
+    stream = io.TextIOWrapper(io.BytesIO(file_data), encoding=encoding, errors=errors, newline='')
+    lines = []
+    for line in stream:
+        if line.strip():
+            lines.append(line)
+        elif lines:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
 
 
 def parse_txt(file_data):
@@ -43,6 +100,11 @@ def parse_txt(file_data):
         return file_data.decode('gbk', errors='ignore')
 
 
+def iter_markdown(file_data):
+    """逐段产出Markdown文本（与TXT相同）"""
+    return iter_txt(file_data)
+
+
 def parse_markdown(file_data):
     """从Markdown文件二进制数据中提取文本
     
@@ -55,6 +117,22 @@ def parse_markdown(file_data):
     return parse_txt(file_data)
 
 
+def iter_docx(file_data):
+    """逐段产出DOCX段落文本（跳过空段落）
+
+    Args:
+        file_data: DOCX文件的二进制内容(bytes)
+
+    Yields:
+        str: 段落文本
+    """
+    from docx import Document
+    doc = Document(io.BytesIO(file_data))
+    for para in doc.paragraphs:
+        if para.text.strip():
+            yield para.text
+
+
 def parse_docx(file_data):
     """从DOCX文件二进制数据中提取文本
     
@@ -64,10 +142,7 @@ def parse_docx(file_data):
     Returns:
         str: 提取的纯文本内容（按段落拼接）
     """
-    from docx import Document
-    doc = Document(io.BytesIO(file_data))
-    paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-    return '\n\n'.join(paragraphs)
+    return '\n\n'.join(iter_docx(file_data))
 
 
 # 支持的文件类型及其对应的解析函数
@@ -78,6 +153,14 @@ PARSERS = {
     'docx': parse_docx,
 }
 
+# 支持的文件类型及其对应的流式解析函数
+STREAM_PARSERS = {
+    'pdf': iter_pdf,
+    'txt': iter_txt,
+    'md': iter_markdown,
+    'docx': iter_docx,
+}
+
 
 def parse_document(file_data, file_type):
     """根据文件类型自动选择解析器提取文本
@@ -99,6 +182,26 @@ def parse_document(file_data, file_type):
     return parser(file_data)
 
 
+def iter_document(file_data, file_type):
+    """根据文件类型自动选择流式解析器，逐页/逐段产出文本
+
+    Args:
+        file_data: 文件的二进制内容(bytes)
+        file_type: 文件类型后缀(str)，如 'pdf', 'txt', 'md', 'docx'
+
+    Returns:
+        generator[str]: 文本片段生成器，可直接传给 ai.chunker.iter_chunks
+
+    Raises:
+        ValueError: 不支持的文件类型
+    """
+    file_type = file_type.lower().strip('.')
+    parser = STREAM_PARSERS.get(file_type)
+    if not parser:
+        raise ValueError(f"不支持的文件类型: {file_type}，支持类型: {list(STREAM_PARSERS.keys())}")
+    return parser(file_data)
+
+
 def get_supported_types():
     """获取支持的文件类型列表
     
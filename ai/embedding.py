@@ -11,10 +11,154 @@ Embedding 层 - 将文本转化为向量表示
 API文档:
   - SiliconFlow: https://docs.siliconflow.cn/cn/api-reference/embeddings
   - 智谱AI: https://open.bigmodel.cn/dev/api/text/embedding-3
+
+并发与重试:
+  embed_texts 将文本分批后在线程池中并发发送(EMBEDDING_CONCURRENCY)，按原顺序拼接结果；
+  所有请求共用 ai/http_client.py 的连接池(keep-alive)，每个提供者一个令牌桶限速(EMBEDDING_RATE_LIMIT)，
+  429/5xx/网络错误按指数退避重试(EMBEDDING_MAX_RETRIES)。
+
+存储格式:
+  向量以小端 float32/float16 原始字节存入 embedding_blob 列(附带维度和类型)，
+  读取时 np.frombuffer 直接映射，无需JSON解析。通过 EMBEDDING_STORAGE_DTYPE 选择精度。
 """
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
 
+from ai import http_client
+from ai.embedding_cache import make_cache_key, query_embedding_cache
+
+
+# 各提供者使用的模型名称（同时作为问题向量缓存键的一部分）
+EMBEDDING_MODELS = {
+    'siliconflow': 'BAAI/bge-large-zh-v1.5',
+    'zhipu': 'embedding-3',
+}
+
+
+# ===== HTTP 客户端: 连接池 + 限速 + 重试 =====
+# 需要重试的HTTP状态码（限流与服务端临时错误）
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_client_settings():
+    """读取 Embedding 客户端配置
+
+    环境变量:
+        EMBEDDING_CONCURRENCY: 同时在途的批次数，默认4
+        EMBEDDING_RATE_LIMIT: 每个提供者每秒最多发起的请求数，默认5，0表示不限速
+        EMBEDDING_MAX_RETRIES: 429/5xx/网络错误的最大重试次数，默认3
+        EMBEDDING_RETRY_BACKOFF: 首次重试等待秒数，之后每次翻倍，默认1.0
+
+    Returns:
+        dict: concurrency / rate_limit / max_retries / backoff
+    """
+    return {
+        'concurrency': max(1, int(os.environ.get('EMBEDDING_CONCURRENCY', '4'))),
+        'rate_limit': float(os.environ.get('EMBEDDING_RATE_LIMIT', '5')),
+        'max_retries': max(0, int(os.environ.get('EMBEDDING_MAX_RETRIES', '3'))),
+        'backoff': float(os.environ.get('EMBEDDING_RETRY_BACKOFF', '1.0')),
+    }
+
+
+class _TokenBucket:
+    """令牌桶限速器（线程安全）：每秒补充 rate 个令牌，桶容量为 max(1, rate)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，令牌不足时阻塞等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_bucket_lock = threading.Lock()
+_buckets = {}
+
+
+def _get_bucket(provider):
+    """获取提供者对应的令牌桶（限速配置变化时重建）"""
+    rate = get_client_settings()['rate_limit']
+    with _bucket_lock:
+        bucket = _buckets.get(provider)
+        if bucket is None or bucket.rate != rate:
+            bucket = _buckets[provider] = _TokenBucket(rate)
+        return bucket
+
+
+def _retry_delay(resp, attempt, backoff):
+    """计算重试等待秒数：优先使用 Retry-After 头，否则指数退避并加随机抖动"""
+    if resp is not None:
+        retry_after = resp.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), 60.0)
+            except ValueError:
+                pass
+    return backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+
+
+def _post_embeddings(provider, url, api_key, payload):
+    """发送一次 Embedding 请求（限速 + 429/5xx/网络错误指数退避重试）
+
+    Args:
+        provider: 提供者名称(str)，用于选择令牌桶
+        url: API端点(str)
+        api_key: API密钥(str)
+        payload: 请求体(dict)
+
+    Returns:
+        list[list[float]]: 按 index 排序后的向量列表
+
+    Raises:
+        requests.HTTPError / requests.RequestException: 重试次数用尽或非可重试错误
+    """
+    settings = get_client_settings()
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    bucket = _get_bucket(provider)
+
+    for attempt in range(settings['max_retries'] + 1):
+        bucket.acquire()
+        resp = None
+        try:
+            resp = http_client.post(f'{provider}_embedding', url, read_timeout=30,
+                                    headers=headers, json=payload)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= settings['max_retries']:
+                raise
+            print(f"[WARN] {provider} Embedding请求失败({e.__class__.__name__})，第{attempt + 1}次重试")
+        else:
+            if resp.status_code not in RETRY_STATUS_CODES or attempt >= settings['max_retries']:
+                resp.raise_for_status()
+                result = resp.json()
+                embeddings = sorted(result['data'], key=lambda x: x['index'])
+                return [item['embedding'] for item in embeddings]
+            print(f"[WARN] {provider} Embedding返回{resp.status_code}，第{attempt + 1}次重试")
+        time.sleep(_retry_delay(resp, attempt, settings['backoff']))
+
 
 # ===== SiliconFlow Embedding (免费) =====
 def _siliconflow_embed(texts, api_key):
@@ -35,20 +179,12 @@ def _siliconflow_embed(texts, api_key):
     API端点: https://api.siliconflow.cn/v1/embeddings (OpenAI兼容格式)
     """
     url = "https://api.siliconflow.cn/v1/embeddings"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
     data = {
-        "model": "BAAI/bge-large-zh-v1.5",
+        "model": EMBEDDING_MODELS['siliconflow'],
         "input": texts,
         "encoding_format": "float"
     }
-    resp = requests.post(url, headers=headers, json=data, timeout=30)
-    resp.raise_for_status()
-    result = resp.json()
-    embeddings = sorted(result['data'], key=lambda x: x['index'])
-    return [item['embedding'] for item in embeddings]
+    return _post_embeddings('siliconflow', url, api_key, data)
 
 
 # ===== 智谱AI Embedding (备选) =====
@@ -65,19 +201,11 @@ def _zhipu_embed(texts, api_key):
     模型: embedding-3 (智谱最新embedding模型，2048维)
     """
     url = "https://open.bigmodel.cn/api/paas/v4/embeddings"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
     data = {
-        "model": "embedding-3",
+        "model": EMBEDDING_MODELS['zhipu'],
         "input": texts
     }
-    resp = requests.post(url, headers=headers, json=data, timeout=30)
-    resp.raise_for_status()
-    result = resp.json()
-    embeddings = sorted(result['data'], key=lambda x: x['index'])
-    return [item['embedding'] for item in embeddings]
+    return _post_embeddings('zhipu', url, api_key, data)
 
 
 # ===== 统一接口 =====
@@ -105,6 +233,9 @@ def embed_texts(texts):
     自动根据 EMBEDDING_PROVIDER 环境变量选择后端:
         - siliconflow(默认): BAAI/bge-large-zh-v1.5, 免费, 1024维, 批量32
         - zhipu: embedding-3, 2048维, 批量16
+
+    多个批次时最多 EMBEDDING_CONCURRENCY 个批次同时在途，结果按输入顺序返回；
+    任一批次重试后仍失败则抛出异常。
     """
     provider = get_embedding_provider()
 
@@ -123,25 +254,49 @@ def embed_texts(texts):
     else:
         raise ValueError(f"不支持的 EMBEDDING_PROVIDER: {provider}，可选: siliconflow, zhipu")
 
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    concurrency = min(get_client_settings()['concurrency'], len(batches))
+    http_client.get_session(min_pool_size=concurrency)  # 连接池至少容纳全部在途批次
+    if concurrency <= 1:
+        results = [embed_fn(batch, api_key) for batch in batches]
+    else:
+        # executor.map 按提交顺序返回结果，保证向量与输入文本一一对应
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embedding') as executor:
+            results = list(executor.map(lambda batch: embed_fn(batch, api_key), batches))
+
     all_embeddings = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        embs = embed_fn(batch, api_key)
+    for embs in results:
         all_embeddings.extend(embs)
-
     return all_embeddings
 
 
 def embed_single(text):
-    """将单条文本转化为向量（便捷方法）
+    """将单条文本转化为向量（便捷方法，用于用户提问）
 
     Args:
         text: 待向量化的文本(str)
 
     Returns:
-        list[float]: 向量（浮点数组）
+        list[float] 或 numpy.ndarray: 向量（缓存命中时为只读 float32 数组）
+
+    结果按 (提供者, 模型, 规范化文本) 缓存（见 ai/embedding_cache.py），
+    相同问题再次提问时不再调用 Embedding API。
     """
-    return embed_texts([text])[0]
+    provider = get_embedding_provider()
+    model = EMBEDDING_MODELS.get(provider, '')
+    key = make_cache_key(provider, model, text)
+    cached = query_embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
+    embedding = embed_texts([text])[0]
+    query_embedding_cache.put(key, embedding, provider, model)
+    return embedding
+
+
+def get_query_cache_stats():
+    """问题向量缓存的命中/未命中统计（见 QueryEmbeddingCache.stats）"""
+    return query_embedding_cache.stats()
 
 
 def cosine_similarity(vec_a, vec_b):
@@ -162,3 +317,64 @@ def cosine_similarity(vec_a, vec_b):
     if norm_a == 0 or norm_b == 0:
         return 0.0
     return dot_product / (norm_a * norm_b)
+
+
+# ===== 向量二进制存储 =====
+# 存储类型 -> 小端numpy类型
+EMBEDDING_STORAGE_DTYPES = {
+    'float32': '<f4',
+    'float16': '<f2',
+}
+
+
+def get_embedding_storage_dtype():
+    """获取向量存储精度
+
+    环境变量:
+        EMBEDDING_STORAGE_DTYPE: 'float32'(默认) | 'float16'(体积减半，精度损失可忽略)
+
+    Returns:
+        str: 存储类型名称
+    """
+    dtype = os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float32').lower()
+    return dtype if dtype in EMBEDDING_STORAGE_DTYPES else 'float32'
+
+
+def encode_embedding(embedding, dtype=None):
+    """将向量编码为小端原始字节
+
+    Args:
+        embedding: 向量(list[float] 或 numpy数组)
+        dtype: 存储类型(str)，'float32' | 'float16'，默认取 EMBEDDING_STORAGE_DTYPE
+
+    Returns:
+        tuple: (bytes, 维度int, 存储类型str)，可直接写入 embedding_blob/embedding_dim/embedding_dtype
+
+    示例:
+        1024维 float32 向量 -> 4096 字节（JSON文本约20KB）
+    """
+    dtype = dtype or get_embedding_storage_dtype()
+    arr = np.asarray(embedding, dtype=EMBEDDING_STORAGE_DTYPES[dtype])
+    return arr.tobytes(), int(arr.shape[0]), dtype
+
+
+def decode_embedding(blob, dim, dtype='float32'):
+    """将 embedding_blob 字节解码为 numpy 数组（零拷贝，只读视图）
+
+    Args:
+        blob: 原始字节(bytes/memoryview)
+        dim: 向量维度(int)
+        dtype: 存储类型(str)，'float32' | 'float16'
+
+    Returns:
+        numpy.ndarray: 一维向量，dtype与存储类型一致
+
+    Raises:
+        ValueError: 字节长度与维度不符或类型未知
+    """
+    np_dtype = EMBEDDING_STORAGE_DTYPES.get(dtype or 'float32')
+    if np_dtype is None:
+        raise ValueError(f"未知的向量存储类型: {dtype}")
+    if dim is None or len(blob) != dim * np.dtype(np_dtype).itemsize:
+        raise ValueError(f"向量字节长度 {len(blob)} 与维度 {dim}({dtype}) 不符")
+    return np.frombuffer(blob, dtype=np_dtype, count=dim)
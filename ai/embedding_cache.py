@@ -0,0 +1,241 @@
+"""
+问题向量缓存 - 避免相同/相近问题重复调用 Embedding API
+
+大量用户会问几乎一样的问题（如"微信账号怎么继承"），每次提问都要同步调用一次
+SiliconFlow/智谱 Embedding 接口。本模块按 (提供者, 模型, 规范化文本) 缓存问题向量：
+
+    1. 进程内 LRU 层: OrderedDict，按条数上限和存活时间(TTL)淘汰，命中无网络开销
+    2. 持久层(可选): 主数据库 query_embedding_cache 表，多个 gunicorn worker / 重启后共享命中
+
+配置(环境变量，见 config.py):
+    QUERY_EMBEDDING_CACHE_SIZE: 进程内缓存条数上限，0 表示禁用缓存
+    QUERY_EMBEDDING_CACHE_TTL: 缓存存活时间(秒)，两层共用
+    QUERY_EMBEDDING_CACHE_PERSIST: 是否启用数据库持久层('true'/'false')
+    QUERY_EMBEDDING_CACHE_PERSIST_MAX: 持久层条数上限，超出时删除最旧的记录
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+
+
+def normalize_query(text):
+    """规范化问题文本：全角转半角(NFKC)、去首尾空白、合并连续空白、英文小写
+
+    使仅空白、全角/半角或英文大小写不同的问题命中同一缓存。
+    """
+    text = unicodedata.normalize('NFKC', text or '')
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def make_cache_key(provider, model, text):
+    """生成缓存键: sha256(提供者 + 模型 + 规范化文本)
+
+    Returns:
+        str: 64位十六进制字符串
+    """
+    raw = f"{provider}\x00{model}\x00{normalize_query(text)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def get_cache_settings():
+    """读取问题向量缓存配置
+
+    Returns:
+        dict: size / ttl / persist / persist_max
+    """
+    return {
+        'size': int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', '1024')),
+        'ttl': float(os.environ.get('QUERY_EMBEDDING_CACHE_TTL', '604800')),
+        'persist': os.environ.get('QUERY_EMBEDDING_CACHE_PERSIST', 'false').lower() == 'true',
+        'persist_max': int(os.environ.get('QUERY_EMBEDDING_CACHE_PERSIST_MAX', '20000')),
+    }
+
+
+class QueryEmbeddingCache:
+    """问题向量两级缓存（进程内 LRU + 可选数据库持久层），线程安全"""
+
+    # 每写入多少条持久缓存后检查一次条数上限与过期记录
+    PRUNE_EVERY = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (写入时间戳, numpy向量)
+        self._writes_since_prune = 0
+        self._stats = {'hits': 0, 'persistent_hits': 0, 'misses': 0,
+                       'expired': 0, 'evicted': 0, 'persist_errors': 0}
+
+    # ------------------------------------------------------------------
+    # 对外接口
+    # ------------------------------------------------------------------
+    def get(self, key):
+        """查询缓存，依次查进程内层和持久层
+
+        Returns:
+            numpy.ndarray 或 None: 命中时返回向量(float32)
+        """
+        settings = get_cache_settings()
+        if settings['size'] <= 0:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= settings['ttl']:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats['expired'] += 1
+
+        if settings['persist']:
+            vector = self._persistent_get(key, settings['ttl'])
+            if vector is not None:
+                with self._lock:
+                    self._stats['persistent_hits'] += 1
+                    self._put_local(key, vector, now, settings['size'])
+                return vector
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, key, embedding, provider='', model=''):
+        """写入缓存（进程内层，启用时同时写持久层）"""
+        settings = get_cache_settings()
+        if settings['size'] <= 0:
+            return
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector.setflags(write=False)
+        with self._lock:
+            self._put_local(key, vector, time.time(), settings['size'])
+        if settings['persist']:
+            self._persistent_put(key, vector, provider, model, settings)
+
+    def stats(self):
+        """命中/未命中计数及当前条数
+
+        Returns:
+            dict: hits(进程内命中) / persistent_hits(持久层命中) / misses / expired / evicted /
+                  persist_errors / size / capacity / hit_rate
+        """
+        settings = get_cache_settings()
+        with self._lock:
+            result = dict(self._stats)
+            result['size'] = len(self._entries)
+        result['capacity'] = settings['size']
+        result['persist'] = settings['persist']
+        lookups = result['hits'] + result['persistent_hits'] + result['misses']
+        result['hit_rate'] = round((result['hits'] + result['persistent_hits']) / lookups, 4) if lookups else 0.0
+        return result
+
+    def clear(self):
+        """清空进程内缓存和计数（持久层不受影响）"""
+        with self._lock:
+            self._entries.clear()
+            for name in self._stats:
+                self._stats[name] = 0
+
+    # ------------------------------------------------------------------
+    # 进程内层
+    # ------------------------------------------------------------------
+    def _put_local(self, key, vector, now, capacity):
+        """写入进程内 LRU（调用方需持有锁），超出上限时淘汰最久未使用的条目"""
+        self._entries[key] = (now, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > capacity:
+            self._entries.popitem(last=False)
+            self._stats['evicted'] += 1
+
+    # ------------------------------------------------------------------
+    # 持久层（主数据库）
+    # 使用独立连接而非 db.session，读写失败不会回滚调用方会话中未提交的修改
+    # ------------------------------------------------------------------
+    def _persistent_get(self, key, ttl):
+        from flask import has_app_context
+        if not has_app_context():
+            return None
+        from ai.embedding import decode_embedding
+        from models import db, get_china_time, QueryEmbeddingCache as CacheRow
+        table = CacheRow.__table__
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(
+                    db.select(table.c.embedding_blob, table.c.embedding_dim,
+                              table.c.embedding_dtype, table.c.created_at)
+                    .where(table.c.cache_key == key)
+                ).first()
+        except Exception as e:
+            self._record_persist_error(f"读取持久缓存失败: {e}")
+            return None
+        if row is None or row.created_at is None:
+            return None
+        if get_china_time() - row.created_at > timedelta(seconds=ttl):
+            return None
+        try:
+            vector = decode_embedding(row.embedding_blob, row.embedding_dim, row.embedding_dtype)
+        except ValueError:
+            return None
+        vector = vector.astype(np.float32)
+        vector.setflags(write=False)
+        return vector
+
+    def _persistent_put(self, key, vector, provider, model, settings):
+        from flask import has_app_context
+        if not has_app_context():
+            return
+        from ai.embedding import encode_embedding
+        from models import db, get_china_time, QueryEmbeddingCache as CacheRow
+        table = CacheRow.__table__
+        blob, dim, dtype = encode_embedding(vector, 'float32')
+        try:
+            with db.engine.begin() as conn:
+                # 先删后插，兼容 SQLite 与 PostgreSQL（并发写入同一键时后写者覆盖）
+                conn.execute(table.delete().where(table.c.cache_key == key))
+                conn.execute(table.insert().values(
+                    cache_key=key, provider=provider, model=model,
+                    embedding_blob=blob, embedding_dim=dim, embedding_dtype=dtype,
+                    created_at=get_china_time(),
+                ))
+        except Exception as e:
+            self._record_persist_error(f"写入持久缓存失败: {e}")
+            return
+
+        with self._lock:
+            self._writes_since_prune += 1
+            if self._writes_since_prune < self.PRUNE_EVERY:
+                return
+            self._writes_since_prune = 0
+        self._prune_persistent(settings)
+
+    def _prune_persistent(self, settings):
+        """删除过期记录，并将总条数控制在 persist_max 以内（按写入时间保留最新的）"""
+        from models import db, get_china_time, QueryEmbeddingCache as CacheRow
+        table = CacheRow.__table__
+        cutoff = get_china_time() - timedelta(seconds=settings['ttl'])
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.created_at < cutoff))
+                overflow = conn.execute(db.select(db.func.count()).select_from(table)).scalar() \
+                    - settings['persist_max']
+                if overflow > 0:
+                    oldest = db.select(table.c.cache_key).order_by(table.c.created_at).limit(overflow)
+                    conn.execute(table.delete().where(table.c.cache_key.in_(oldest.scalar_subquery())))
+        except Exception as e:
+            self._record_persist_error(f"清理持久缓存失败: {e}")
+
+    def _record_persist_error(self, message):
+        with self._lock:
+            self._stats['persist_errors'] += 1
+        print(f"[WARN] {message}")
+
+
+# 全局单例
+query_embedding_cache = QueryEmbeddingCache()
@@ -0,0 +1,225 @@
+"""
+文本块向量去重存储 - 按内容哈希复用已计算过的向量
+
+上传知识库、重新同步外部知识库(飞书Wiki/网页)、以及 sync_knowledge_to_neon.py --re-vectorize
+都会把全部文本块重新向量化，即使页面 95% 的内容没有变化。
+
+本模块以 sha256(模型名 + 文本块原文) 为键，把向量保存在 chunk_embeddings 表中：
+    1. 批量查出已存在的向量直接复用
+    2. 只把从未见过的文本块（同一批内也去重）发给 Embedding API
+    3. 新向量立即写入存储（独立事务，调用方后续失败也不会浪费已付出的API调用）
+
+模型名是键的一部分，切换 EMBEDDING_PROVIDER 后不会误用另一模型的向量。
+
+存储只是可复用的缓存（文本块自身保存了向量）。文本块表同时保存各自的 content_hash(带索引)，
+上传、同步、删除知识库后调用 schedule_prune()，在后台以一条 NOT EXISTS 删除语句清除
+不再被任何文本块(knowledge_chunks / external_knowledge_chunks)引用的向量，
+页面反复修改、重新同步时存储不会无限增长。
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+# 单条 IN 查询携带的哈希数量上限
+LOOKUP_BATCH_SIZE = 500
+
+# 清理时保留最近写入的向量(秒)：并发的上传/同步可能已写入向量、但还未写入引用它们的文本块
+PRUNE_GRACE_SECONDS = 3600
+
+# 后台清理线程（单线程；已有清理在排队时不再重复提交）
+_prune_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embedding-prune')
+_prune_pending = False
+_prune_lock = threading.Lock()
+
+
+def content_hash(model, text):
+    """文本块内容哈希: sha256(模型名 + 原文)，原文不做任何规范化
+
+    Returns:
+        str: 64位十六进制字符串
+    """
+    return hashlib.sha256(f"{model}\x00{text}".encode('utf-8')).hexdigest()
+
+
+def _lookup(conn, table, hashes):
+    """批量查询已存储的向量
+
+    Returns:
+        dict: {content_hash: numpy.ndarray}
+    """
+    from ai.embedding import decode_embedding
+
+    found = {}
+    for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+        rows = conn.execute(
+            table.select().with_only_columns(
+                table.c.content_hash, table.c.embedding_blob,
+                table.c.embedding_dim, table.c.embedding_dtype)
+            .where(table.c.content_hash.in_(batch))
+        )
+        for row in rows:
+            try:
+                found[row.content_hash] = decode_embedding(
+                    row.embedding_blob, row.embedding_dim, row.embedding_dtype)
+            except ValueError:
+                continue  # 损坏的记录视为未命中，随后重新向量化并覆盖
+    return found
+
+
+def _store(engine, table, model, new_vectors):
+    """写入新向量（独立事务；已存在的键先删除再插入，兼容 SQLite 与 PostgreSQL）"""
+    from ai.embedding import encode_embedding
+    from models import get_china_time
+
+    now = get_china_time()
+    rows = []
+    for h, vector in new_vectors.items():
+        blob, dim, dtype = encode_embedding(vector, 'float32')
+        rows.append({'content_hash': h, 'model': model, 'embedding_blob': blob,
+                     'embedding_dim': dim, 'embedding_dtype': dtype, 'created_at': now})
+    hashes = list(new_vectors)
+    with engine.begin() as conn:
+        for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            conn.execute(table.delete().where(
+                table.c.content_hash.in_(hashes[start:start + LOOKUP_BATCH_SIZE])))
+        conn.execute(table.insert(), rows)
+
+
+def current_model():
+    """当前 EMBEDDING_PROVIDER 对应的模型名（content_hash 的默认模型）"""
+    from ai.embedding import EMBEDDING_MODELS, get_embedding_provider
+    return EMBEDDING_MODELS.get(get_embedding_provider(), '')
+
+
+def embed_texts_dedup(texts, engine=None, embed_fn=None, model=None, window=None, on_progress=None,
+                      return_hashes=False):
+    """将文本块列表转化为向量，已存储过的文本块直接复用向量
+
+    Args:
+        texts: 文本块列表(list[str])
+        engine: SQLAlchemy Engine(可选)，默认为应用主数据库 db.engine；
+                同步脚本可传入云端数据库引擎
+        embed_fn: 向量化函数(可选)，签名 embed_fn(list[str]) -> list[list[float]]，默认 embed_texts
+        model: 模型名(可选)，默认取当前 EMBEDDING_PROVIDER 对应的模型
+        window: 每次调用 embed_fn 的最大文本块数(int，可选)，默认一次发送全部未命中的文本块
+        on_progress: 进度回调(可选)，签名 on_progress(已得到向量的块数, 总块数)，每个窗口完成后调用
+        return_hashes: 为 True 时同时返回各文本块的 content_hash(bool)，调用方写入文本块的 content_hash 列
+
+    Returns:
+        list: 与 texts 一一对应的向量（复用的为只读 float32 numpy 数组，新计算的为浮点列表）；
+        return_hashes 为 True 时返回 (向量列表, content_hash列表)
+
+    Raises:
+        与 embed_fn 相同（Embedding API 调用失败时抛出）；存储读写失败仅打印警告，退化为全部重新向量化
+    """
+    from ai.embedding import embed_texts
+    from models import ChunkEmbedding
+
+    if not texts:
+        return ([], []) if return_hashes else []
+    if engine is None:
+        from models import db
+        engine = db.engine
+    embed_fn = embed_fn or embed_texts
+    model = model or current_model()
+    table = ChunkEmbedding.__table__
+
+    hashes = [content_hash(model, t) for t in texts]
+    unique_hashes = list(dict.fromkeys(hashes))
+    try:
+        with engine.connect() as conn:
+            vectors = _lookup(conn, table, unique_hashes)
+    except Exception as e:
+        print(f"[WARN] 读取向量存储失败，将全部重新向量化: {e}")
+        vectors = {}
+
+    # 只对从未见过的文本块调用 Embedding API（同一批内重复的文本只算一次）
+    missing = [h for h in unique_hashes if h not in vectors]
+    if missing:
+        first_text = {}
+        for h, t in zip(hashes, texts):
+            first_text.setdefault(h, t)
+        window = window or len(missing)
+        for start in range(0, len(missing), window):
+            window_hashes = missing[start:start + window]
+            new_embeddings = embed_fn([first_text[h] for h in window_hashes])
+            new_vectors = dict(zip(window_hashes, new_embeddings))
+            vectors.update(new_vectors)
+            try:
+                _store(engine, table, model, new_vectors)
+            except Exception as e:
+                print(f"[WARN] 写入向量存储失败（不影响本次结果）: {e}")
+            if on_progress:
+                on_progress(len(texts) - len(missing) + start + len(window_hashes), len(texts))
+
+    reused = len(texts) - len(missing)
+    print(f"[INFO] 向量化 {len(texts)} 个文本块: 复用 {reused} 个，新调用API {len(missing)} 个")
+    embeddings = [vectors[h] for h in hashes]
+    return (embeddings, hashes) if return_hashes else embeddings
+
+
+def prune_unreferenced(engine=None):
+    """删除不再被任何知识库文本块引用的向量
+
+    在数据库内执行一条 DELETE ... WHERE NOT EXISTS(文本块.content_hash = 向量.content_hash)，
+    走 content_hash 索引，不读取文本块原文；PRUNE_GRACE_SECONDS 内写入的记录保留。
+    仍有文本块未回填 content_hash(旧数据，见 app.py 迁移)时跳过，避免误删其引用的向量。
+
+    Args:
+        engine: SQLAlchemy Engine(可选)，默认为应用主数据库 db.engine；同步脚本可传入云端数据库引擎
+
+    Returns:
+        int: 删除的记录数
+    """
+    from sqlalchemy import exists, inspect, select
+    from models import ChunkEmbedding, ExternalKnowledgeChunk, KnowledgeChunk, get_china_time
+
+    if engine is None:
+        from models import db
+        engine = db.engine
+    table = ChunkEmbedding.__table__
+    cutoff = get_china_time() - timedelta(seconds=PRUNE_GRACE_SECONDS)
+    chunk_tables = [model.__table__ for model in (KnowledgeChunk, ExternalKnowledgeChunk)
+                    if inspect(engine).has_table(model.__tablename__)]
+
+    with engine.begin() as conn:
+        for chunks in chunk_tables:
+            if conn.execute(select(chunks.c.id).where(chunks.c.content_hash.is_(None)).limit(1)).first():
+                print(f"[INFO] 向量存储清理跳过: {chunks.name} 中仍有未回填 content_hash 的文本块")
+                return 0
+        deleted = conn.execute(table.delete().where(
+            table.c.created_at < cutoff,
+            *[~exists().where(chunks.c.content_hash == table.c.content_hash) for chunks in chunk_tables]
+        )).rowcount
+    if deleted:
+        print(f"[INFO] 向量存储清理: 删除 {deleted} 条不再被引用的向量")
+    return deleted
+
+
+def schedule_prune():
+    """在后台执行 prune_unreferenced()（需在应用上下文中调用；上传/同步/删除知识库后调用）"""
+    global _prune_pending
+    from flask import current_app
+
+    with _prune_lock:
+        if _prune_pending:
+            return
+        _prune_pending = True
+    _prune_pool.submit(_run_prune, current_app._get_current_object())
+
+
+def _run_prune(app):
+    global _prune_pending
+    from models import db
+
+    with _prune_lock:
+        _prune_pending = False
+    with app.app_context():
+        try:
+            prune_unreferenced()
+        except Exception as e:
+            print(f"[WARN] 向量存储清理失败(下次上传/同步/删除后重试): {e}")
+        finally:
+            db.session.remove()
@@ -0,0 +1,231 @@
+"""
+提供者HTTP传输层 - 所有 AI 提供者请求共用的连接池
+
+对话(智谱AI/SiliconFlow)、Embedding、网络搜索(Tavily)原先每次请求都直接调用 requests.post，
+每轮对话都要重新建立一次 TCP + TLS 连接后才能收到第一个token。
+
+本模块提供:
+    1. 进程内共享的 requests.Session: keep-alive 复用连接，连接池大小可配置(HTTP_POOL_SIZE)
+    2. 按提供者区分的 (连接超时, 读取超时)
+    3. 每个提供者的请求耗时与首token耗时(TTFT)统计，见 get_transport_stats()
+
+配置(环境变量，见 config.py):
+    HTTP_POOL_SIZE: 每个主机保留的最大连接数
+    HTTP_CONNECT_TIMEOUT: 默认连接超时(秒)
+    HTTP_STREAM_READ_TIMEOUT: 流式响应两个数据块之间的最长等待(秒)
+    HTTP_TIMEOUT_<提供者>: 单个提供者的超时，格式 "连接,读取"，如 HTTP_TIMEOUT_ZHIPU=5,120
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# 各提供者默认的读取超时(秒)（非流式请求从发出到收到完整响应头/数据块的最长等待）
+DEFAULT_READ_TIMEOUTS = {
+    'zhipu': 120,
+    'siliconflow': 120,
+    'tavily': 15,
+}
+
+# 每个提供者保留的最近耗时样本数（用于计算 p50/p95）
+STATS_WINDOW = 200
+
+
+def get_transport_settings():
+    """读取传输层配置
+
+    Returns:
+        dict: pool_size / connect_timeout / stream_read_timeout
+    """
+    return {
+        'pool_size': max(1, int(os.environ.get('HTTP_POOL_SIZE', '10'))),
+        'connect_timeout': float(os.environ.get('HTTP_CONNECT_TIMEOUT', '10')),
+        'stream_read_timeout': float(os.environ.get('HTTP_STREAM_READ_TIMEOUT', '300')),
+    }
+
+
+def get_timeout(provider, stream=False, read=None):
+    """获取提供者的 (连接超时, 读取超时)
+
+    Args:
+        provider: 提供者名称(str)，如 'zhipu' / 'siliconflow' / 'tavily'
+        stream: 是否流式响应(bool)；流式时读取超时取 HTTP_STREAM_READ_TIMEOUT
+        read: 调用方指定的默认读取超时(秒，可选)，HTTP_TIMEOUT_<提供者> 优先
+
+    Returns:
+        tuple: (connect, read)
+    """
+    settings = get_transport_settings()
+    connect = settings['connect_timeout']
+    if stream:
+        read = settings['stream_read_timeout']
+    elif read is None:
+        read = DEFAULT_READ_TIMEOUTS.get(provider, 60)
+
+    override = os.environ.get(f'HTTP_TIMEOUT_{provider.upper()}', '')
+    if override:
+        try:
+            parts = [float(p) for p in override.split(',')]
+            connect = parts[0]
+            if len(parts) > 1 and not stream:
+                read = parts[1]
+        except ValueError:
+            print(f"[WARN] HTTP_TIMEOUT_{provider.upper()} 格式错误(应为 连接,读取)，使用默认超时")
+    return (connect, read)
+
+
+_session = None
+_pool_size = 0
+_session_lock = threading.Lock()
+
+
+def get_session(min_pool_size=0):
+    """获取进程内共享的 requests.Session（首次调用时创建）
+
+    Args:
+        min_pool_size: 调用方需要的最小连接池大小(int)，如 Embedding 的并发数；
+                       大于当前连接池时换用更大的连接池
+
+    Returns:
+        requests.Session
+    """
+    global _session, _pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        wanted = max(get_transport_settings()['pool_size'], min_pool_size)
+        if wanted > _pool_size:
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=wanted)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _pool_size = wanted
+        return _session
+
+
+def post(provider, url, stream=False, read_timeout=None, **kwargs):
+    """通过共享连接池发送 POST 请求，并记录耗时
+
+    Args:
+        provider: 提供者名称(str)，决定超时并用于统计
+        url: 请求地址(str)
+        stream: 是否流式读取响应(bool)
+        read_timeout: 非流式请求的默认读取超时(秒，可选)
+        **kwargs: 透传给 requests.Session.post（headers / json 等）
+
+    Returns:
+        requests.Response（流式时仅已收到响应头）
+
+    Raises:
+        requests.RequestException: 连接失败或超时
+    """
+    kwargs.setdefault('timeout', get_timeout(provider, stream, read_timeout))
+    started = time.perf_counter()
+    try:
+        resp = get_session().post(url, stream=stream, **kwargs)
+    except requests.RequestException:
+        transport_stats.record(provider, (time.perf_counter() - started) * 1000, ok=False)
+        raise
+    resp.started_at = started
+    transport_stats.record(provider, (time.perf_counter() - started) * 1000, ok=resp.ok)
+    return resp
+
+
+def track_first_token(provider, tokens, started):
+    """包装token生成器，在产出第一个token时记录首token耗时(TTFT)
+
+    Args:
+        provider: 提供者名称(str)
+        tokens: token生成器
+        started: 请求发出时刻(time.perf_counter())
+
+    Yields:
+        str: 原样产出的token
+    """
+    first = True
+    for token in tokens:
+        if first:
+            first = False
+            ttft_ms = (time.perf_counter() - started) * 1000
+            transport_stats.record_ttft(provider, ttft_ms)
+            print(f"[INFO] {provider} 首token耗时 {ttft_ms:.0f}ms")
+        yield token
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 1)
+
+
+class TransportStats:
+    """每个提供者的请求数、失败数、响应耗时与首token耗时（最近 STATS_WINDOW 次），线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def _entry(self, provider):
+        entry = self._providers.get(provider)
+        if entry is None:
+            entry = self._providers[provider] = {
+                'requests': 0, 'errors': 0,
+                'latency': deque(maxlen=STATS_WINDOW), 'ttft': deque(maxlen=STATS_WINDOW),
+            }
+        return entry
+
+    def record(self, provider, latency_ms, ok=True):
+        """记录一次请求（latency_ms: 发出请求到收到响应头的耗时）"""
+        with self._lock:
+            entry = self._entry(provider)
+            entry['requests'] += 1
+            if not ok:
+                entry['errors'] += 1
+            entry['latency'].append(latency_ms)
+
+    def record_ttft(self, provider, ttft_ms):
+        """记录一次流式响应的首token耗时（非流式请求不记录，见 ai/llm.py _read_completion）"""
+        with self._lock:
+            self._entry(provider)['ttft'].append(ttft_ms)
+
+    def ttft_percentile(self, provider, q, min_samples=1):
+        """首token耗时的分位数(ms)，样本不足 min_samples 时返回 None"""
+        with self._lock:
+            entry = self._providers.get(provider)
+            samples = list(entry['ttft']) if entry else []
+        if len(samples) < min_samples:
+            return None
+        return _percentile(samples, q)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: {提供者: {requests, errors, latency_p50_ms, latency_p95_ms, ttft_p50_ms, ttft_p95_ms}}
+        """
+        with self._lock:
+            items = [(name, dict(e, latency=list(e['latency']), ttft=list(e['ttft'])))
+                     for name, e in self._providers.items()]
+        return {
+            name: {
+                'requests': e['requests'],
+                'errors': e['errors'],
+                'latency_p50_ms': _percentile(e['latency'], 0.5),
+                'latency_p95_ms': _percentile(e['latency'], 0.95),
+                'ttft_p50_ms': _percentile(e['ttft'], 0.5),
+                'ttft_p95_ms': _percentile(e['ttft'], 0.95),
+            }
+            for name, e in items
+        }
+
+
+# 全局单例
+transport_stats = TransportStats()
+
+
+def get_transport_stats():
+    """本进程各提供者的请求耗时与首token耗时统计（用于健康检查接口）"""
+    return transport_stats.snapshot()
@@ -0,0 +1,338 @@
+"""
+知识库后台任务 - 把解析/切分/向量化/入库移出HTTP请求
+
+上传知识库文件、添加/重新同步外部知识库都可能耗时数分钟，在请求内执行会撞上
+gunicorn 的 --timeout 120 并长时间占用仅有的 1~3 个 worker。
+
+流程:
+    1. 接口调用 enqueue_job() 写入 ingestion_jobs 表，立即返回任务ID
+    2. 每个进程内的 JobRunner 线程从表中领取任务（条件UPDATE，多worker不会重复领取）
+    3. 处理函数通过 job.progress() 上报阶段: parsed → chunked → embedding N/M → committed
+    4. 前端轮询 /admin/api/jobs/<id> 获取进度
+
+任务保存在数据库中，进程重启后未完成的任务会被重新领取：
+状态为 running 但心跳(updated_at)超过 INGESTION_JOB_STALE_SECONDS 未更新的任务视为执行者已退出。
+处理函数运行期间由心跳线程定期刷新 updated_at（抓取外部内容等长时间不上报进度的阶段也不会被误判为超时）；
+进度与最终状态只在任务仍属于本次领取(worker + attempts 未变)时写入，被重新领取后旧执行者的结果不会覆盖新执行者。
+
+配置(环境变量，见 config.py):
+    INGESTION_WORKERS: 每个进程的后台线程数，0 表示在请求内同步执行(开发调试用)
+    INGESTION_POLL_SECONDS: 空闲时轮询任务表的间隔(秒)
+    INGESTION_JOB_STALE_SECONDS: running 任务心跳超时(秒)，超时后可被其他worker重新领取
+"""
+import json
+import os
+import threading
+import traceback
+from datetime import timedelta
+
+# 任务状态
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+# 任务类型
+JOB_KNOWLEDGE_UPLOAD = 'knowledge_upload'   # 上传知识库文件
+JOB_EXTERNAL_SYNC = 'external_sync'         # 添加/重新同步外部知识库
+
+# 同一任务最多执行次数（执行者反复异常退出时不再重试）
+MAX_ATTEMPTS = 3
+
+# 任务类型 -> 处理函数
+_handlers = {}
+
+
+class JobError(Exception):
+    """任务处理失败（消息直接展示给管理员）"""
+
+
+def get_job_settings():
+    """读取后台任务配置
+
+    Returns:
+        dict: workers / poll_seconds / stale_seconds
+    """
+    return {
+        'workers': int(os.environ.get('INGESTION_WORKERS', '1')),
+        'poll_seconds': float(os.environ.get('INGESTION_POLL_SECONDS', '5')),
+        'stale_seconds': float(os.environ.get('INGESTION_JOB_STALE_SECONDS', '600')),
+    }
+
+
+def register_job_handler(kind, handler):
+    """注册任务处理函数
+
+    Args:
+        kind: 任务类型(str)
+        handler: 处理函数，签名 handler(job: JobContext) -> str(成功信息)；
+                 失败时抛出 JobError(展示给用户的信息) 或其他异常
+    """
+    _handlers[kind] = handler
+
+
+class JobContext:
+    """传给处理函数的任务上下文（只读字段 + 进度上报）"""
+
+    def __init__(self, row):
+        self.id = row.id
+        self.claim = (row.worker, row.attempts)
+        self.kind = row.kind
+        self.user_id = row.user_id
+        self.target_id = row.target_id
+        self.name = row.name
+        self.payload = row.payload
+        try:
+            self.options = json.loads(row.options_json or '{}')
+        except (TypeError, ValueError):
+            self.options = {}
+
+    def progress(self, stage, done=None, total=None, message=None):
+        """上报进度（独立事务立即提交，不影响处理函数自己的数据库会话）
+
+        Args:
+            stage: 阶段(str): parsed / chunked / embedding / committed
+            done: 已完成的文本块数(int，可选)
+            total: 文本块总数(int，可选)
+            message: 附加说明(str，可选)
+        """
+        values = {'stage': stage}
+        if done is not None:
+            values['progress_done'] = done
+        if total is not None:
+            values['progress_total'] = total
+        if message is not None:
+            values['message'] = message
+        _update_job(self.id, claim=self.claim, **values)
+
+
+def _update_job(job_id, claim=None, engine=None, **values):
+    """更新任务行（同时刷新心跳）
+
+    Args:
+        job_id: 任务ID(int)
+        claim: (worker, attempts)(可选)，给出时仅当任务仍属于这次领取才更新
+        engine: SQLAlchemy Engine(可选)，默认 db.engine（心跳线程没有应用上下文时传入）
+
+    Returns:
+        bool: 是否更新了任务行
+    """
+    from models import db, get_china_time, IngestionJob
+    table = IngestionJob.__table__
+    values['updated_at'] = get_china_time()
+    condition = [table.c.id == job_id]
+    if claim is not None:
+        condition += [table.c.worker == claim[0], table.c.attempts == claim[1]]
+    with (engine or db.engine).begin() as conn:
+        result = conn.execute(table.update().where(*condition).values(**values))
+    return result.rowcount == 1
+
+
+def _heartbeat(engine, job_id, claim, interval, stop):
+    """心跳线程：处理函数运行期间定期刷新 updated_at，任务被其他执行者领取后停止"""
+    while not stop.wait(interval):
+        try:
+            if not _update_job(job_id, claim=claim, engine=engine):
+                print(f"[WARN] 后台任务 {job_id} 已被其他执行者重新领取，停止心跳")
+                return
+        except Exception as e:
+            print(f"[WARN] 后台任务 {job_id} 心跳更新失败: {e}")
+
+
+def enqueue_job(kind, user_id, name, payload=None, options=None, target_id=None):
+    """创建后台任务并唤醒本进程的执行线程
+
+    INGESTION_WORKERS=0 时在当前请求内同步执行完毕再返回。
+
+    Args:
+        kind: 任务类型(str)，需已通过 register_job_handler 注册
+        user_id: 发起任务的用户ID(int)
+        name: 显示名称(str)
+        payload: 文件数据(bytes，可选)
+        options: 任务参数(dict，可选)
+        target_id: 关联对象ID(int，可选)
+
+    Returns:
+        int: 任务ID
+    """
+    from models import db, IngestionJob
+
+    if kind not in _handlers:
+        raise ValueError(f"未注册的任务类型: {kind}")
+    job = IngestionJob(
+        kind=kind, user_id=user_id, name=name, payload=payload, target_id=target_id,
+        options_json=json.dumps(options or {}, ensure_ascii=False),
+        status=JOB_QUEUED, stage=JOB_QUEUED,
+    )
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+
+    if get_job_settings()['workers'] <= 0:
+        if job_runner.claim(job_id):
+            job_runner.run_claimed(job_id, remove_session=False)
+    else:
+        job_runner.notify()
+    return job_id
+
+
+def get_job(job_id):
+    """查询任务状态
+
+    Returns:
+        dict 或 None: IngestionJob.to_dict()
+    """
+    from models import db, IngestionJob
+    job = db.session.get(IngestionJob, job_id)
+    return job.to_dict() if job else None
+
+
+def has_active_job(kind, name=None, target_id=None):
+    """是否存在同类型、同对象且尚未结束的任务（用于拒绝重复提交）
+
+    Args:
+        kind: 任务类型(str)
+        name: 显示名称(str)，未给出 target_id 时按名称判断（文件上传按文件名）
+        target_id: 关联对象ID(int，可选)，给出时按对象判断（外部知识库同步：同名的不同链接互不影响）
+    """
+    from models import IngestionJob
+    query = IngestionJob.query.filter(IngestionJob.kind == kind,
+                                      IngestionJob.status.in_((JOB_QUEUED, JOB_RUNNING)))
+    if target_id is not None:
+        query = query.filter(IngestionJob.target_id == target_id)
+    else:
+        query = query.filter(IngestionJob.name == name)
+    return query.first() is not None
+
+
+class JobRunner:
+    """进程内后台任务执行器：若干守护线程轮询任务表"""
+
+    def __init__(self):
+        self._app = None
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, app):
+        """启动执行线程（每个进程只启动一次；INGESTION_WORKERS=0 时不启动）"""
+        with self._lock:
+            self._app = app
+            if self._threads:
+                return
+            n_workers = get_job_settings()['workers']
+            for i in range(n_workers):
+                t = threading.Thread(target=self._loop, name=f'ingestion-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+        if n_workers > 0:
+            print(f"[INFO] 知识库后台任务线程已启动: {n_workers} 个 (pid={os.getpid()})")
+
+    def notify(self):
+        """唤醒空闲的执行线程"""
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            job_id = None
+            try:
+                with self._app.app_context():
+                    job_id = self._claim_next()
+                    if job_id is not None:
+                        self.run_claimed(job_id)
+            except Exception as e:
+                print(f"[WARN] 后台任务线程异常: {e}")
+            if job_id is None:
+                self._wakeup.wait(get_job_settings()['poll_seconds'])
+                self._wakeup.clear()
+
+    def _claim_next(self):
+        """领取下一个待执行任务（含心跳超时的 running 任务），返回任务ID或None"""
+        from models import db, get_china_time, IngestionJob
+        table = IngestionJob.__table__
+        stale_before = get_china_time() - timedelta(seconds=get_job_settings()['stale_seconds'])
+        with db.engine.connect() as conn:
+            candidates = conn.execute(
+                db.select(table.c.id).where(db.or_(
+                    table.c.status == JOB_QUEUED,
+                    db.and_(table.c.status == JOB_RUNNING, table.c.updated_at < stale_before),
+                )).order_by(table.c.id).limit(5)
+            ).scalars().all()
+        for job_id in candidates:
+            if self.claim(job_id, stale_before):
+                return job_id
+        return None
+
+    def claim(self, job_id, stale_before=None):
+        """用条件UPDATE领取任务，返回是否领取成功（多个worker竞争时只有一个成功）"""
+        from models import db, get_china_time, IngestionJob
+        table = IngestionJob.__table__
+        condition = table.c.status == JOB_QUEUED
+        if stale_before is not None:
+            condition = db.or_(condition, db.and_(table.c.status == JOB_RUNNING,
+                                                  table.c.updated_at < stale_before))
+        now = get_china_time()
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                table.update().where(table.c.id == job_id, condition).values(
+                    status=JOB_RUNNING, started_at=now, updated_at=now,
+                    attempts=table.c.attempts + 1,
+                    worker=f"{os.getpid()}/{threading.current_thread().name}"[:50],
+                )
+            )
+        return result.rowcount == 1
+
+    def run_claimed(self, job_id, remove_session=True):
+        """执行已领取的任务，并记录成功/失败结果
+
+        Args:
+            job_id: 任务ID(int)
+            remove_session: 结束后是否释放数据库会话(bool)；在请求内同步执行时为False，
+                            由请求结束时统一释放
+        """
+        from models import db, get_china_time, IngestionJob
+        # populate_existing: 在请求内同步执行时会话中缓存的是领取前的任务行
+        row = db.session.get(IngestionJob, job_id, populate_existing=True)
+        if row is None:
+            return
+        handler = _handlers.get(row.kind)
+        ctx = JobContext(row)
+        attempts = row.attempts or 0
+        db.session.commit()  # 结束读取事务，处理函数使用干净的会话
+
+        # 心跳间隔取超时时间的1/4，偶尔一次更新失败也不会被判定为超时
+        stop_heartbeat = threading.Event()
+        threading.Thread(
+            target=_heartbeat, name=f'ingestion-heartbeat-{job_id}', daemon=True,
+            args=(db.engine, job_id, ctx.claim, max(1.0, get_job_settings()['stale_seconds'] / 4), stop_heartbeat),
+        ).start()
+        try:
+            if handler is None:
+                raise JobError(f"未注册的任务类型: {ctx.kind}")
+            if attempts > MAX_ATTEMPTS:
+                raise JobError(f"任务已重试 {MAX_ATTEMPTS} 次仍未完成，请重新提交")
+            message = handler(ctx)
+            stop_heartbeat.set()
+            if not _update_job(job_id, claim=ctx.claim, status=JOB_SUCCEEDED, stage='committed',
+                               message=message or '', payload=None, finished_at=get_china_time()):
+                print(f"[WARN] 后台任务 {job_id}({ctx.kind}) 已被其他执行者重新领取，不记录本次结果")
+        except Exception as e:
+            stop_heartbeat.set()
+            db.session.rollback()
+            if not isinstance(e, JobError):
+                traceback.print_exc()
+            message = str(e) if isinstance(e, JobError) else f"处理失败: {e}"
+            print(f"[WARN] 后台任务 {job_id}({ctx.kind}) 失败: {message}")
+            try:
+                _update_job(job_id, claim=ctx.claim, status=JOB_FAILED, message=message,
+                            payload=None, finished_at=get_china_time())
+            except Exception as update_err:
+                print(f"[WARN] 记录任务 {job_id} 失败状态时出错: {update_err}")
+        finally:
+            stop_heartbeat.set()
+            if remove_session:
+                db.session.remove()
+
+
+# 全局单例
+job_runner = JobRunner()
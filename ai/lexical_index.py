@@ -0,0 +1,251 @@
+"""
+关键词索引 - 知识库文本块的 BM25 倒排索引，与向量检索融合
+
+用户经常直接问法条编号(如"第一千一百二十二条")或平台名称，这类字面匹配在向量检索中排名偏低；
+而且每次提问都要先调用一次远程 Embedding API。
+
+本模块:
+    - 分词: 中文按相邻两字(bigram)切分，单独的汉字保留单字；英文单词与数字整体作为一个词
+      （先做 NFKC 规范化并转小写，全角数字/字母与半角一致）
+    - LexicalIndex: 词 -> {文本块: 词频} 的倒排表，BM25 打分；由 KnowledgeIndex 持有并随之增量维护
+      (上传/删除/外部知识库同步，见 ai/vector_index.py)
+    - 融合: 向量检索与关键词检索的候选按排名做 RRF(倒数排名融合)
+    - 关键词结果足够明确时(见 is_decisive)直接采用，不再调用 Embedding API；
+      这类结果没有余弦相似度，以 keyword_score(相对最佳命中的 BM25 分数比例)排序(见 keyword_only_hits)
+
+配置(环境变量，见 config.py):
+    HYBRID_SEARCH_ENABLED: 是否启用关键词检索与融合
+    HYBRID_RRF_K: RRF 平滑常数
+    HYBRID_DECISIVE_COVERAGE: 最佳关键词命中覆盖问题词权重的比例达到此值时视为明确(大于1表示从不跳过向量检索)
+    HYBRID_DECISIVE_MARGIN: 同时要求最佳命中的 BM25 分数是第二名的多少倍
+"""
+import heapq
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 覆盖率低于此值的关键词命中不参与融合（只沾到一两个常见词）
+LEXICAL_MIN_COVERAGE = 0.3
+
+# 问题至少包含的词数，太短的问题(如"微信")不跳过向量检索
+DECISIVE_MIN_TERMS = 3
+
+# 汉字连续片段 或 英文/数字连续片段
+_TOKEN_PATTERN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+')
+
+_stats_lock = threading.Lock()
+_stats = {'lexical_only': 0, 'fused': 0, 'lexical_fallback': 0}
+
+
+def get_hybrid_settings():
+    """读取混合检索配置
+
+    Returns:
+        dict: enabled / rrf_k / decisive_coverage / decisive_margin
+    """
+    return {
+        'enabled': os.environ.get('HYBRID_SEARCH_ENABLED', 'true').lower() == 'true',
+        'rrf_k': max(1, int(os.environ.get('HYBRID_RRF_K', '60'))),
+        'decisive_coverage': float(os.environ.get('HYBRID_DECISIVE_COVERAGE', '0.9')),
+        'decisive_margin': max(1.0, float(os.environ.get('HYBRID_DECISIVE_MARGIN', '2.0'))),
+    }
+
+
+def tokenize(text):
+    """把文本切分为检索词
+
+    Args:
+        text: 文本(str)
+
+    Returns:
+        list[str]: 检索词列表（中文为相邻两字，英文/数字为整词）
+
+    示例:
+        >>> tokenize("民法典第1122条")
+        ['民法', '法典', '典第', '1122', '条']
+    """
+    if not text:
+        return []
+    terms = []
+    for piece in _TOKEN_PATTERN.findall(unicodedata.normalize('NFKC', text).lower()):
+        if piece.isascii() or len(piece) == 1:
+            terms.append(piece)
+        else:
+            terms.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return terms
+
+
+class LexicalIndex:
+    """BM25 倒排索引（非线程安全，由 KnowledgeIndex 在其锁内调用）
+
+    文本块以 (来源类型, 块ID) 标识，按 (来源类型, 来源ID) 整体删除。
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)   # 词 -> {(kind, chunk_id): 词频}
+        self._lengths = {}                   # (kind, chunk_id) -> 词数
+        self._owners = defaultdict(list)     # (kind, owner_id) -> [(kind, chunk_id), ...]
+        self._owner_terms = defaultdict(set)  # (kind, owner_id) -> 该来源出现过的词（删除时只需遍历这些词）
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, kind, owner_id, chunk_id, content):
+        """加入一个文本块"""
+        doc = (kind, chunk_id)
+        if doc in self._lengths:
+            return
+        terms = tokenize(content)
+        counts = Counter(terms)
+        for term, count in counts.items():
+            self._postings[term][doc] = count
+        self._lengths[doc] = len(terms)
+        self._owners[(kind, owner_id)].append(doc)
+        self._owner_terms[(kind, owner_id)].update(counts)
+        self._total_length += len(terms)
+
+    def remove_owner(self, kind, owner_id):
+        """删除某个来源的全部文本块"""
+        docs = set(self._owners.pop((kind, owner_id), ()))
+        terms = self._owner_terms.pop((kind, owner_id), ())
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            for doc in docs.intersection(postings):
+                del postings[doc]
+            if not postings:
+                del self._postings[term]
+        for doc in docs:
+            self._total_length -= self._lengths.pop(doc, 0)
+
+    def search(self, query, top_k):
+        """BM25 检索
+
+        Args:
+            query: 问题文本(str)
+            top_k: 返回数量(int)
+
+        Returns:
+            tuple: ([((kind, chunk_id), BM25分数, 覆盖率), ...] 按分数降序, 问题的检索词数)；
+                   覆盖率为命中的问题词 IDF 之和 / 全部问题词 IDF 之和(语料中没有的词也计入分母)
+        """
+        terms = set(tokenize(query))
+        n = len(self._lengths)
+        if not terms or n == 0 or top_k <= 0:
+            return [], len(terms)
+        avg_length = max(self._total_length / n, 1.0)
+        idfs = {}
+        for term in terms:
+            df = len(self._postings.get(term, ()))
+            idfs[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        total_idf = sum(idfs.values())
+
+        scores = defaultdict(float)
+        matched = defaultdict(float)
+        for term, idf in idfs.items():
+            for doc, tf in self._postings.get(term, {}).items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc] / avg_length)
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched[doc] += idf
+        top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(doc, score, matched[doc] / total_idf) for doc, score in top], len(terms)
+
+
+def is_decisive(lexical_hits, term_count, settings):
+    """关键词检索结果是否足够明确，可以不再做向量检索
+
+    要求: 问题至少 DECISIVE_MIN_TERMS 个词、最佳命中的覆盖率达到 decisive_coverage、
+    且 BM25 分数是第二名的 decisive_margin 倍以上（只有一个命中时不比较）。
+    """
+    if not lexical_hits or term_count < DECISIVE_MIN_TERMS:
+        return False
+    best = lexical_hits[0]
+    if best['coverage'] < settings['decisive_coverage']:
+        return False
+    return len(lexical_hits) == 1 or best['bm25'] >= settings['decisive_margin'] * lexical_hits[1]['bm25']
+
+
+def keyword_only_hits(lexical_hits, min_coverage=LEXICAL_MIN_COVERAGE):
+    """只有关键词检索结果时(跳过了向量检索或 Embedding 失败)的候选
+
+    丢弃覆盖率低于 min_coverage 的命中；keyword_score 为 BM25 分数与最佳命中之比。
+    结果不含 similarity 字段：BM25 比例不是余弦相似度，不参与相似度阈值(见 ai/rerank.py)。
+
+    Args:
+        lexical_hits: KnowledgeIndex.lexical_search() 的结果(按 BM25 降序)
+        min_coverage: 最低覆盖率(float)，默认 LEXICAL_MIN_COVERAGE
+
+    Returns:
+        list[dict]: 字段同 lexical_hits，另有 keyword_score
+    """
+    if not lexical_hits:
+        return []
+    top = lexical_hits[0]['bm25']
+    return [dict(hit, keyword_score=hit['bm25'] / top)
+            for hit in lexical_hits if hit['coverage'] >= min_coverage]
+
+
+def fuse_hits(vector_hits, lexical_hits, query_embedding, similarity_threshold, rrf_k):
+    """按 RRF 融合向量检索与关键词检索的候选
+
+    Args:
+        vector_hits: KnowledgeIndex.search(with_vectors=True) 的结果
+        lexical_hits: KnowledgeIndex.lexical_search() 的结果
+        query_embedding: 问题向量，用于计算仅由关键词命中的块的余弦相似度
+        similarity_threshold: 相似度阈值(float)，仅由关键词命中的块同样需要达到
+        rrf_k: RRF 平滑常数(int)
+
+    Returns:
+        list[dict]: 按融合分数降序；similarity 均为余弦相似度，
+                    fused 为归一化到 (0, 1] 的融合分数，lexical 表示是否有关键词命中
+    """
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(query))
+    query = query / norm if norm else None
+
+    merged = {}
+    for rank, hit in enumerate(vector_hits):
+        merged[(hit['kind'], hit['chunk_id'])] = dict(hit, fused=1.0 / (rrf_k + rank + 1), lexical=False)
+    for rank, hit in enumerate(lexical_hits):
+        if hit['coverage'] < LEXICAL_MIN_COVERAGE:
+            continue
+        key = (hit['kind'], hit['chunk_id'])
+        entry = merged.get(key)
+        if entry is None:
+            if query is None or hit['vector'].shape != query.shape:
+                continue
+            similarity = float(hit['vector'] @ query)
+            if similarity < similarity_threshold:
+                continue
+            entry = merged[key] = dict(hit, similarity=similarity, fused=0.0)
+        entry['fused'] += 1.0 / (rrf_k + rank + 1)
+        entry['lexical'] = True
+    if not merged:
+        return []
+    top = max(entry['fused'] for entry in merged.values())
+    for entry in merged.values():
+        entry['fused'] /= top
+    return sorted(merged.values(), key=lambda entry: entry['fused'], reverse=True)
+
+
+def record_retrieval(mode):
+    """记录一次检索方式: lexical_only(跳过了向量检索) / fused / lexical_fallback(Embedding失败)"""
+    with _stats_lock:
+        _stats[mode] += 1
+
+
+def get_hybrid_stats():
+    """本进程各检索方式的次数（用于健康检查接口）"""
+    with _stats_lock:
+        return dict(_stats)
@@ -9,14 +9,26 @@ LLM 模块 - 调用大语言模型生成回答
   - 流式输出(SSE): 逐token推送，适用于文本对话
   - 非流式输出: 一次性返回完整回答，适用于视觉问答
 
+所有请求经 ai/http_client.py 的共享连接池发出(keep-alive)，省去每轮对话的TCP/TLS握手，
+并记录每个提供者的首token耗时(TTFT)。后端选择由 ai/provider_router.py 按健康状况决定。
+
 环境变量:
   ZHIPU_API_KEY: 智谱AI API密钥(必需)，在 https://open.bigmodel.cn/ 注册获取
   SILICONFLOW_API_KEY: SiliconFlow API密钥(可选)，在 https://cloud.siliconflow.cn/ 注册获取
 """
+import asyncio
 import os
 import json
+import queue
+import socket
+import threading
+import time
+
 import requests
 
+from ai import http_client
+from ai.provider_router import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_RATE_LIMITED, provider_router
+
 
 # ==============================================================================
 # 系统提示词
@@ -65,6 +77,8 @@ def chat(messages, stream=False):
     策略:
       - 文本对话: 优先智谱AI glm-4-flash, 429时自动切换SiliconFlow Qwen2.5-7B
       - 视觉问答: 仅智谱AI视觉模型(SiliconFlow无免费视觉模型), 429时自动切换备选视觉模型
+      - 持续失败的后端被熔断，熔断期间新请求直接使用下一个后端（见 ai/provider_router.py）
+      - 流式文本对话可启用对冲(LLM_HEDGE_ENABLED): 主后端首token超出预算时同时请求备选后端
 
     Args:
         messages: 对话消息列表(list[dict])
@@ -93,191 +107,345 @@ def chat(messages, stream=False):
 
     if has_image:
         # 视觉问答: 仅智谱AI（SiliconFlow无免费视觉模型）
-        return _chat_vision(messages, zhipu_key)
+        return _chat_vision(messages)
     else:
-        # 文本对话: 智谱AI优先，429时切换SiliconFlow
-        return _chat_text(messages, stream, zhipu_key)
+        # 文本对话: 智谱AI优先，排队或熔断时切换SiliconFlow
+        return _chat_text(messages, stream)
 
 
 # ==============================================================================
-# 文本对话（智谱AI优先 + SiliconFlow备选）
+# 后端路由（按健康状况选择，熔断持续失败的后端，见 ai/provider_router.py）
 # ==============================================================================
-def _chat_text(messages, stream, zhipu_key):
-    """文本对话：智谱AI优先，429排队时自动切换SiliconFlow
+# 提供者 -> (API密钥环境变量, 显示名称)
+PROVIDER_INFO = {
+    'zhipu': ('ZHIPU_API_KEY', '智谱AI'),
+    'siliconflow': ('SILICONFLOW_API_KEY', 'SiliconFlow'),
+}
 
-    Args:
-        messages: 对话消息列表(list[dict])
-        stream: 是否流式输出(bool)
-        zhipu_key: 智谱AI API密钥(str)
+# 需要切换到下一个后端的HTTP状态码（排队限流与服务端临时错误）；其他错误(如400)直接抛出
+FAILOVER_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _api_url(provider):
+    return ZHIPU_API_URL if provider == 'zhipu' else SILICONFLOW_API_URL
+
+
+def _build_request(provider, model, messages, stream):
+    """构建请求头和请求体
 
     Returns:
-        流式时返回生成器，非流式时返回完整文本(str)
+        tuple: (headers, data)
     """
-    # 构建智谱AI请求
     headers = {
-        "Authorization": f"Bearer {zhipu_key}",
+        "Authorization": f"Bearer {os.environ.get(PROVIDER_INFO[provider][0], '')}",
         "Content-Type": "application/json"
     }
-    data = {
-        "model": ZHIPU_TEXT_MODEL,
+    if model in VISION_MODELS:
+        # 视觉模型不支持stream/temperature/max_tokens参数，传了会返回400
+        return headers, {"model": model, "messages": messages}
+    return headers, {
+        "model": model,
         "messages": messages,
         "stream": stream,
         "max_tokens": 4096,
         "temperature": 0.7
     }
 
-    if stream:
-        # 流式请求: 先尝试智谱AI，429时切换SiliconFlow
-        # timeout=(连接超时, 读取超时): 读取设300s防止长回答中途断开
-        resp = requests.post(ZHIPU_API_URL, headers=headers, json=data, stream=True, timeout=(30, 300))
-        if resp.ok:
-            return _parse_sse_stream(resp)
-        elif resp.status_code == 429:
-            # 智谱AI排队，尝试SiliconFlow
-            sf_result = _try_siliconflow_stream(messages)
-            if sf_result is not None:
-                return sf_result
-            # SiliconFlow也不行，抛异常
-            _raise_api_error(resp, "智谱AI")
-        else:
-            _raise_api_error(resp, "智谱AI")
-    else:
-        # 非流式请求
-        resp = requests.post(ZHIPU_API_URL, headers=headers, json=data, timeout=120)
-        if resp.ok:
-            return resp.json()['choices'][0]['message']['content']
-        elif resp.status_code == 429:
-            # 智谱AI排队，尝试SiliconFlow
-            sf_result = _try_siliconflow_non_stream(messages)
-            if sf_result is not None:
-                return sf_result
-            _raise_api_error(resp, "智谱AI")
-        else:
-            _raise_api_error(resp, "智谱AI")
 
+def _route_request(candidates, messages, stream):
+    """按路由顺序依次请求候选后端，返回第一个成功的响应
 
-def _try_siliconflow_stream(messages):
-    """尝试SiliconFlow流式请求
+    熔断中的后端被直接跳过；排队(429)、5xx、连接失败时切换到下一个后端，并把结果上报给路由器。
 
     Args:
+        candidates: [(provider, model), ...]，按优先级排列
         messages: 对话消息列表(list[dict])
+        stream: 是否流式输出(bool)
 
     Returns:
-        生成器或None(SiliconFlow不可用时)
+        tuple: (provider, requests响应对象)
+
+    Raises:
+        Exception: 非可切换错误，或全部后端失败
     """
-    sf_key = os.environ.get('SILICONFLOW_API_KEY')
-    if not sf_key:
-        print("[INFO] 未配置SILICONFLOW_API_KEY，跳过SiliconFlow备选")
-        return None
+    last_resp, last_error, tried = None, None, []
+    for provider, model in provider_router.order(candidates):
+        if tried:
+            print(f"[INFO] {tried[-1]} 不可用，尝试备选 {provider}/{model}...")
+        tried.append(f"{provider}/{model}")
+        headers, data = _build_request(provider, model, messages, stream)
+        started = time.perf_counter()
+        try:
+            resp = http_client.post(provider, _api_url(provider), stream=stream, headers=headers, json=data)
+        except requests.RequestException as e:
+            provider_router.record(provider, model, OUTCOME_ERROR, (time.perf_counter() - started) * 1000)
+            print(f"[WARN] {provider}/{model} 请求异常: {e}")
+            last_error = e
+            continue
 
-    print(f"[INFO] 智谱AI排队中，尝试SiliconFlow {SILICONFLOW_TEXT_MODEL}...")
-    headers = {
-        "Authorization": f"Bearer {sf_key}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": SILICONFLOW_TEXT_MODEL,
-        "messages": messages,
-        "stream": True,
-        "max_tokens": 4096,
-        "temperature": 0.7
+        latency_ms = (time.perf_counter() - started) * 1000
+        if resp.ok:
+            provider_router.record(provider, model, OUTCOME_OK, latency_ms)
+            if len(tried) > 1:
+                print(f"[INFO] 切换到 {provider}/{model} 成功")
+            return provider, resp
+        if resp.status_code not in FAILOVER_STATUS_CODES:
+            _raise_api_error(resp, PROVIDER_INFO[provider][1])
+        provider_router.record(provider, model,
+                               OUTCOME_RATE_LIMITED if resp.status_code == 429 else OUTCOME_ERROR, latency_ms)
+        # 读取错误信息的同时读完响应体，连接归还连接池
+        print(f"[WARN] {provider}/{model} 返回{resp.status_code}: {_extract_error_message(resp)}")
+        last_resp = resp
+
+    if last_resp is None and last_error is not None:
+        raise last_error
+    if last_resp is not None and last_resp.status_code == 429 and all(m in VISION_MODELS for _, m in candidates):
+        err_info = _extract_error_message(last_resp)
+        raise Exception(f"智谱AI视觉模型全部排队({', '.join(m for _, m in candidates)})，请稍后重试: {err_info}")
+    provider = tried[-1].split('/')[0]
+    _raise_api_error(last_resp, PROVIDER_INFO[provider][1])
+
+
+def _probe_backend(provider, model):
+    """探测熔断中的后端是否恢复（由路由器后台线程调用，发送一条极短的请求）
+
+    Returns:
+        str: OUTCOME_OK / OUTCOME_RATE_LIMITED / OUTCOME_ERROR
+    """
+    if not os.environ.get(PROVIDER_INFO[provider][0]):
+        return OUTCOME_ERROR
+    headers, data = _build_request(provider, model, [{"role": "user", "content": "你好"}], False)
+    if model not in VISION_MODELS:
+        data["max_tokens"] = 1
+    try:
+        resp = http_client.post(provider, _api_url(provider), headers=headers, json=data)
+    except requests.RequestException:
+        return OUTCOME_ERROR
+    resp.close()
+    if resp.ok:
+        return OUTCOME_OK
+    return OUTCOME_RATE_LIMITED if resp.status_code == 429 else OUTCOME_ERROR
+
+
+provider_router.set_prober(_probe_backend)
+
+
+# ==============================================================================
+# 对冲请求（流式文本对话，可选）
+# 主后端在预算时间内没有产出第一个token时，把同一请求再发给备选后端，
+# 采用先产出token的一方，取消另一方
+# ==============================================================================
+# 自动预算所需的最少首token耗时样本数，样本不足时使用 HEDGE_FALLBACK_DELAY_MS
+HEDGE_MIN_SAMPLES = 20
+HEDGE_FALLBACK_DELAY_MS = 3000
+
+_hedge_lock = threading.Lock()
+_hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_won': 0, 'primary_won': 0, 'failover': 0}
+
+
+def get_hedge_settings():
+    """读取对冲请求配置
+
+    环境变量:
+        LLM_HEDGE_ENABLED: 是否启用对冲('true'/'false')，默认false
+        LLM_HEDGE_DELAY_MS: 等待主后端首token的预算(ms)，默认0表示自动取主后端最近首token耗时的p95
+
+    Returns:
+        dict: enabled / delay_ms
+    """
+    return {
+        'enabled': os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true',
+        'delay_ms': float(os.environ.get('LLM_HEDGE_DELAY_MS', '0')),
     }
+
+
+def get_hedge_stats():
+    """本进程对冲请求计数
+
+    Returns:
+        dict: requests(启用对冲的流式请求数) / hedged(发出了对冲请求) / hedge_won(备选先出token) /
+              primary_won(发出对冲后主后端仍先出token) / failover(主后端首token前失败，直接改用备选) /
+              hedge_win_rate
+    """
+    with _hedge_lock:
+        result = dict(_hedge_stats)
+    result['hedge_win_rate'] = round(result['hedge_won'] / result['hedged'], 4) if result['hedged'] else 0.0
+    return result
+
+
+def _count_hedge(name):
+    with _hedge_lock:
+        _hedge_stats[name] += 1
+
+
+def _hedge_delay(provider):
+    """等待主后端首token的预算(秒)"""
+    delay_ms = get_hedge_settings()['delay_ms']
+    if delay_ms <= 0:
+        delay_ms = http_client.transport_stats.ttft_percentile(provider, 0.95, HEDGE_MIN_SAMPLES) \
+            or HEDGE_FALLBACK_DELAY_MS
+    return delay_ms / 1000
+
+
+def _run_stream_lane(candidate, messages, lane, events):
+    """在线程中请求一个后端并把事件放入队列: (后端, 'token'|'done'|'error', 值)"""
     try:
-        resp = requests.post(SILICONFLOW_API_URL, headers=headers, json=data, stream=True, timeout=(30, 300))
-        if resp.ok:
-            print(f"[INFO] 切换到SiliconFlow {SILICONFLOW_TEXT_MODEL} 成功")
-            return _parse_sse_stream(resp)
-        else:
-            print(f"[WARN] SiliconFlow请求失败({resp.status_code})")
-            return None
+        provider, resp = _route_request([candidate], messages, True)
+        lane['resp'] = resp
+        if lane['cancel'].is_set():
+            resp.close()
+            return
+        for token in _parse_sse_stream(resp, provider):
+            if lane['cancel'].is_set():
+                return
+            events.put((candidate, 'token', token))
+        events.put((candidate, 'done', None))
     except Exception as e:
-        print(f"[WARN] SiliconFlow请求异常: {e}")
-        return None
+        if not lane['cancel'].is_set():
+            events.put((candidate, 'error', e))
+
+
+def _cancel_lane(lane):
+    """取消一路请求：标记取消并断开仍在读取的连接（阻塞读取的线程随即退出）"""
+    lane['cancel'].set()
+    resp = lane.get('resp')
+    # resp.close() 要等另一线程中阻塞的读取返回，shutdown 可立即打断；
+    # 已读完的响应连接已归还连接池(connection 为 None)，不受影响
+    sock = getattr(getattr(resp.raw, 'connection', None), 'sock', None) if resp is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
-def _try_siliconflow_non_stream(messages):
-    """尝试SiliconFlow非流式请求
+def _hedged_stream(primary, secondary, messages):
+    """对冲流式请求
 
     Args:
+        primary: 主后端 (provider, model)
+        secondary: 备选后端 (provider, model)
         messages: 对话消息列表(list[dict])
 
-    Returns:
-        str或None(SiliconFlow不可用时)
+    Yields:
+        str: 胜出后端的token
+
+    主后端在首token前失败(429/5xx等)时立即改用备选后端，与原先的切换逻辑一致。
     """
-    sf_key = os.environ.get('SILICONFLOW_API_KEY')
-    if not sf_key:
-        print("[INFO] 未配置SILICONFLOW_API_KEY，跳过SiliconFlow备选")
-        return None
+    events = queue.Queue()
+    lanes = {}
+
+    def launch(candidate):
+        lanes[candidate] = {'cancel': threading.Event(), 'resp': None}
+        threading.Thread(target=_run_stream_lane, args=(candidate, messages, lanes[candidate], events),
+                         name='llm-hedge', daemon=True).start()
+
+    _count_hedge('requests')
+    launch(primary)
+    deadline = time.monotonic() + _hedge_delay(primary[0])
+    winner, first, hedged, errors = None, None, False, {}
 
-    print(f"[INFO] 智谱AI排队中，尝试SiliconFlow {SILICONFLOW_TEXT_MODEL}...")
-    headers = {
-        "Authorization": f"Bearer {sf_key}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": SILICONFLOW_TEXT_MODEL,
-        "messages": messages,
-        "stream": False,
-        "max_tokens": 4096,
-        "temperature": 0.7
-    }
     try:
-        resp = requests.post(SILICONFLOW_API_URL, headers=headers, json=data, timeout=120)
-        if resp.ok:
-            print(f"[INFO] 切换到SiliconFlow {SILICONFLOW_TEXT_MODEL} 成功")
-            return resp.json()['choices'][0]['message']['content']
-        else:
-            print(f"[WARN] SiliconFlow请求失败({resp.status_code})")
-            return None
-    except Exception as e:
-        print(f"[WARN] SiliconFlow请求异常: {e}")
-        return None
+        while winner is None:
+            timeout = None if secondary in lanes else max(0.0, deadline - time.monotonic())
+            try:
+                candidate, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                print(f"[INFO] {primary[0]}/{primary[1]} 超过首token预算，对冲请求 {secondary[0]}/{secondary[1]}")
+                hedged = True
+                _count_hedge('hedged')
+                launch(secondary)
+                continue
+            if kind == 'error':
+                errors[candidate] = value
+                if secondary not in lanes:
+                    _count_hedge('failover')
+                    launch(secondary)
+                elif len(errors) == len(lanes):
+                    raise errors.get(primary, value)
+                continue
+            winner, first = candidate, (value if kind == 'token' else None)
+            if kind == 'done':
+                lanes[candidate]['finished'] = True
+
+        if hedged:
+            _count_hedge('hedge_won' if winner == secondary else 'primary_won')
+            print(f"[INFO] 对冲结果: {winner[0]}/{winner[1]} 先产出token")
+        for candidate, lane in lanes.items():
+            if candidate != winner:
+                _cancel_lane(lane)
+
+        if first is not None:
+            yield first
+        if lanes[winner].get('finished'):
+            return
+        while True:
+            candidate, kind, value = events.get()
+            if candidate != winner:
+                continue
+            if kind == 'token':
+                yield value
+            elif kind == 'done':
+                return
+            else:
+                raise value
+    finally:
+        # 调用方中途停止或出错时，取消所有仍在进行的请求
+        for lane in lanes.values():
+            _cancel_lane(lane)
+
+
+# ==============================================================================
+# 文本对话（智谱AI优先 + SiliconFlow备选）
+# ==============================================================================
+def _text_candidates():
+    """文本对话的候选后端: 智谱AI优先，配置了密钥时以SiliconFlow为备选"""
+    candidates = [('zhipu', ZHIPU_TEXT_MODEL)]
+    if os.environ.get('SILICONFLOW_API_KEY'):
+        candidates.append(('siliconflow', SILICONFLOW_TEXT_MODEL))
+    return candidates
+
+
+def _chat_text(messages, stream):
+    """文本对话：智谱AI优先，排队或熔断时使用SiliconFlow
+
+    Args:
+        messages: 对话消息列表(list[dict])
+        stream: 是否流式输出(bool)
+
+    Returns:
+        流式时返回生成器，非流式时返回完整文本(str)
+    """
+    candidates = _text_candidates()
+
+    if stream and get_hedge_settings()['enabled']:
+        routed = provider_router.order(candidates)
+        if len(routed) >= 2:
+            return _hedged_stream(routed[0], routed[1], messages)
+
+    # 流式请求的读取超时取 HTTP_STREAM_READ_TIMEOUT(默认300s)，防止长回答中途断开
+    provider, resp = _route_request(candidates, messages, stream)
+    if stream:
+        return _parse_sse_stream(resp, provider)
+    return _read_completion(resp)
 
 
 # ==============================================================================
 # 视觉问答（仅智谱AI）
 # ==============================================================================
-def _chat_vision(messages, zhipu_key):
-    """视觉问答：仅使用智谱AI视觉模型，429排队时自动切换备选视觉模型
+def _chat_vision(messages):
+    """视觉问答：仅使用智谱AI视觉模型，排队或熔断时使用备选视觉模型
 
     Args:
         messages: 包含图片的对话消息列表(list[dict])
-        zhipu_key: 智谱AI API密钥(str)
 
     Returns:
         str: 模型生成的完整回答文本
 
     注意: 视觉问答不支持流式输出，始终返回完整文本
     """
-    model = VISION_MODELS[0]
-    headers = {
-        "Authorization": f"Bearer {zhipu_key}",
-        "Content-Type": "application/json"
-    }
-    # 视觉模型不支持stream/temperature/max_tokens参数，传了会返回400
-    data = {"model": model, "messages": messages}
-
-    resp = requests.post(ZHIPU_API_URL, headers=headers, json=data, timeout=120)
-
-    # 429排队时，逐个尝试备选视觉模型
-    if not resp.ok and resp.status_code == 429:
-        tried = [model]
-        for fallback in VISION_MODELS[1:]:
-            print(f"[INFO] 视觉模型 {model} 排队中，尝试备选 {fallback}...")
-            tried.append(fallback)
-            data["model"] = fallback
-            resp = requests.post(ZHIPU_API_URL, headers=headers, json=data, timeout=120)
-            if resp.ok:
-                print(f"[INFO] 切换到 {fallback} 成功")
-                break
-        else:
-            err_info = _extract_error_message(resp)
-            raise Exception(f"智谱AI视觉模型全部排队({', '.join(tried)})，请稍后重试: {err_info}")
-
-    if not resp.ok:
-        _raise_api_error(resp, "智谱AI")
-
-    return resp.json()['choices'][0]['message']['content']
+    _, resp = _route_request([('zhipu', model) for model in VISION_MODELS], messages, False)
+    return _read_completion(resp)
 
 
 # ==============================================================================
@@ -374,36 +542,327 @@ def build_image_message(text, image_base64, image_mime_type="image/jpeg"):
 # ==============================================================================
 # 流式输出解析
 # ==============================================================================
-def _parse_sse_stream(response):
+def _read_completion(response):
+    """读取非流式响应的回答文本
+
+    不记录首token耗时：非流式的完整响应耗时(摘要、视觉问答等)远大于流式首token耗时，
+    混入后会抬高对冲请求的等待预算(见 _hedge_delay)。
+
+    Args:
+        response: requests响应对象(由 http_client.post 返回)
+
+    Returns:
+        str: 回答文本
+    """
+    return response.json()['choices'][0]['message']['content']
+
+
+def _parse_sse_stream(response, provider):
     """解析标准SSE(Server-Sent Events)格式的流式响应
 
     智谱AI和SiliconFlow均使用OpenAI兼容的SSE格式
 
     Args:
-        response: requests的流式响应对象
+        response: requests的流式响应对象(由 http_client.post 返回)
+        provider: 提供者名称(str)，用于记录首token耗时
 
-    Yields:
-        str: 逐个token的文本片段
+    Returns:
+        生成器: 逐个yield token文本片段(str)
 
     SSE格式示例:
         data: {"choices":[{"delta":{"content":"你"}}]}
         data: {"choices":[{"delta":{"content":"好"}}]}
         data: [DONE]
     """
-    for line in response.iter_lines(decode_unicode=True):
-        if not line or not line.startswith('data:'):
-            continue
-        data_str = line[5:].strip()
-        if data_str == '[DONE]':
-            break
+    return http_client.track_first_token(provider, _iter_sse_tokens(response), response.started_at)
+
+
+def _iter_sse_tokens(response):
+    """逐行解析SSE数据并产出token
+
+    [DONE] 之后继续读完响应体（通常只剩分块结束标记），使连接能回到连接池复用；
+    调用方中途停止时关闭连接。
+    """
+    done = False
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if done:
+                continue
+            content = _sse_line_content(line)
+            if content is SSE_DONE:
+                done = True
+            elif content:
+                yield content
+    finally:
+        response.close()
+
+
+# _sse_line_content 遇到 [DONE] 时的返回值
+SSE_DONE = object()
+
+
+def _sse_line_content(line):
+    """解析一行SSE数据
+
+    Returns:
+        str: token文本（非数据行或无内容时为空字符串）；遇到 [DONE] 返回 SSE_DONE
+    """
+    if not line or not line.startswith('data:'):
+        return ''
+    data_str = line[5:].strip()
+    if data_str == '[DONE]':
+        return SSE_DONE
+    try:
+        data = json.loads(data_str)
+        return data['choices'][0].get('delta', {}).get('content', '') or ''
+    except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+        return ''
+
+
+# ==============================================================================
+# 异步流式文本对话（ASGI 流式接口 asgi.py 使用）
+# 与 _chat_text 的路由/切换/对冲规则相同，上游请求使用 httpx.AsyncClient，
+# 一个事件循环即可同时承载数百个流式回答，不再每个回答占用一个线程
+# ==============================================================================
+_async_client = None   # (事件循环, httpx.AsyncClient)
+
+
+def _get_async_client():
+    """获取当前事件循环共享的 httpx.AsyncClient（keep-alive 连接池）
+
+    事件循环更换时关闭旧循环上的客户端，释放其连接池。
+    """
+    global _async_client
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop:
+        if _async_client is not None:
+            _close_async_client(*_async_client)
+        limits = httpx.Limits(
+            max_connections=int(os.environ.get('ASGI_UPSTREAM_CONNECTIONS', '200')),
+            max_keepalive_connections=http_client.get_transport_settings()['pool_size'],
+        )
+        _async_client = (loop, httpx.AsyncClient(limits=limits))
+    return _async_client[1]
+
+
+def _close_async_client(loop, client):
+    """在客户端所属的事件循环上关闭它（该循环已关闭时其连接已无法使用，只能随对象回收）"""
+    if loop.is_closed():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    except RuntimeError:
+        pass  # 循环恰好在此期间关闭
+
+
+async def aclose_async_client():
+    """关闭当前事件循环的共享客户端（ASGI 服务关闭时由 asgi.py 调用）"""
+    global _async_client
+    if _async_client is not None and _async_client[0] is asyncio.get_running_loop():
+        client, _async_client = _async_client[1], None
+        await client.aclose()
+
+
+async def _aopen_stream(client, candidates, messages):
+    """按路由顺序依次请求候选后端，返回第一个成功的流式响应（切换规则同 _route_request）
+
+    Args:
+        client: httpx.AsyncClient
+        candidates: [(provider, model), ...]，按优先级排列
+        messages: 纯文本对话消息列表(list[dict])
+
+    Returns:
+        tuple: (provider, httpx响应对象(仅已收到响应头), 请求发出时刻)
+
+    Raises:
+        Exception: 非可切换错误，或全部后端失败（异常信息与同步路径一致，便于统一友好化提示）
+    """
+    import httpx
+
+    last_resp, last_error, tried = None, None, []
+    for provider, model in provider_router.order(candidates):
+        if tried:
+            print(f"[INFO] {tried[-1]} 不可用，尝试备选 {provider}/{model}...")
+        tried.append(f"{provider}/{model}")
+        headers, data = _build_request(provider, model, messages, True)
+        connect, read = http_client.get_timeout(provider, stream=True)
+        started = time.perf_counter()
         try:
-            data = json.loads(data_str)
-            delta = data['choices'][0].get('delta', {})
-            content = delta.get('content', '')
+            request = client.build_request('POST', _api_url(provider), headers=headers, json=data,
+                                           timeout=httpx.Timeout(read, connect=connect))
+            resp = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            latency_ms = (time.perf_counter() - started) * 1000
+            provider_router.record(provider, model, OUTCOME_ERROR, latency_ms)
+            http_client.transport_stats.record(provider, latency_ms, ok=False)
+            print(f"[WARN] {provider}/{model} 请求异常: {e!r}")
+            last_error = e
+            continue
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        http_client.transport_stats.record(provider, latency_ms, ok=resp.status_code < 400)
+        if resp.status_code < 400:
+            provider_router.record(provider, model, OUTCOME_OK, latency_ms)
+            if len(tried) > 1:
+                print(f"[INFO] 切换到 {provider}/{model} 成功")
+            return provider, resp, started
+        await resp.aread()
+        await resp.aclose()
+        if resp.status_code not in FAILOVER_STATUS_CODES:
+            _raise_api_error(resp, PROVIDER_INFO[provider][1])
+        provider_router.record(provider, model,
+                               OUTCOME_RATE_LIMITED if resp.status_code == 429 else OUTCOME_ERROR, latency_ms)
+        print(f"[WARN] {provider}/{model} 返回{resp.status_code}: {_extract_error_message(resp)}")
+        last_resp = resp
+
+    if last_resp is not None:
+        _raise_api_error(last_resp, PROVIDER_INFO[tried[-1].split('/')[0]][1])
+    # 与 requests 的异常信息保持一致，调用方据此给出"连接失败/超时"提示
+    if isinstance(last_error, httpx.TimeoutException):
+        raise Exception(f"Read timed out: {last_error!r}")
+    raise Exception(f"ConnectionError: {last_error!r}")
+
+
+async def _aiter_stream_tokens(resp, provider, started):
+    """逐行解析异步SSE响应并产出token，记录首token耗时；结束或调用方停止时关闭响应"""
+    first = True
+    try:
+        async for line in resp.aiter_lines():
+            content = _sse_line_content(line)
+            if content is SSE_DONE:
+                break
             if content:
+                if first:
+                    first = False
+                    http_client.transport_stats.record_ttft(provider, (time.perf_counter() - started) * 1000)
                 yield content
-        except (json.JSONDecodeError, KeyError, IndexError):
-            continue
+    finally:
+        await resp.aclose()
+
+
+async def _run_async_lane(client, candidate, messages, events):
+    """在任务中请求一个后端并把事件放入队列: (后端, 'token'|'done'|'error', 值)；任务被取消时关闭连接"""
+    try:
+        provider, resp, started = await _aopen_stream(client, [candidate], messages)
+        tokens = _aiter_stream_tokens(resp, provider, started)
+        try:
+            async for token in tokens:
+                events.put_nowait((candidate, 'token', token))
+        finally:
+            await tokens.aclose()
+        events.put_nowait((candidate, 'done', None))
+    except Exception as e:
+        events.put_nowait((candidate, 'error', e))
+
+
+async def _ahedged_stream(client, primary, secondary, messages):
+    """异步对冲流式请求（规则与计数同 _hedged_stream，两路请求为同一事件循环中的任务）
+
+    Args:
+        client: httpx.AsyncClient
+        primary: 主后端 (provider, model)
+        secondary: 备选后端 (provider, model)
+        messages: 纯文本对话消息列表(list[dict])
+
+    Yields:
+        str: 胜出后端的token
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    lanes = {}
+
+    def launch(candidate):
+        lanes[candidate] = asyncio.create_task(_run_async_lane(client, candidate, messages, events))
+
+    _count_hedge('requests')
+    launch(primary)
+    deadline = loop.time() + _hedge_delay(primary[0])
+    winner, first, finished, hedged, errors = None, None, False, False, {}
+
+    try:
+        while winner is None:
+            try:
+                if secondary in lanes:
+                    candidate, kind, value = await events.get()
+                else:
+                    candidate, kind, value = await asyncio.wait_for(events.get(),
+                                                                    max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                print(f"[INFO] {primary[0]}/{primary[1]} 超过首token预算，对冲请求 {secondary[0]}/{secondary[1]}")
+                hedged = True
+                _count_hedge('hedged')
+                launch(secondary)
+                continue
+            if kind == 'error':
+                errors[candidate] = value
+                if secondary not in lanes:
+                    _count_hedge('failover')
+                    launch(secondary)
+                elif len(errors) == len(lanes):
+                    raise errors.get(primary, value)
+                continue
+            winner, first, finished = candidate, (value if kind == 'token' else None), kind == 'done'
+
+        if hedged:
+            _count_hedge('hedge_won' if winner == secondary else 'primary_won')
+            print(f"[INFO] 对冲结果: {winner[0]}/{winner[1]} 先产出token")
+        for candidate, task in lanes.items():
+            if candidate != winner:
+                task.cancel()
+
+        if first is not None:
+            yield first
+        if finished:
+            return
+        while True:
+            candidate, kind, value = await events.get()
+            if candidate != winner:
+                continue
+            if kind == 'token':
+                yield value
+            elif kind == 'done':
+                return
+            else:
+                raise value
+    finally:
+        # 调用方中途停止或出错时，取消所有仍在进行的请求（任务内的 finally 关闭连接）
+        for task in lanes.values():
+            task.cancel()
+
+
+async def achat_stream(messages):
+    """异步流式文本对话（不支持图片，视觉问答仍走同步 chat()）
+
+    启用对冲(LLM_HEDGE_ENABLED)且有两个可用后端时，规则与同步路径的 _hedged_stream 相同。
+
+    Args:
+        messages: 纯文本对话消息列表(list[dict])
+
+    Yields:
+        str: 逐个token的文本片段
+
+    Raises:
+        Exception: 非可切换错误，或全部后端失败（异常信息与同步路径一致，便于统一友好化提示）
+    """
+    if not os.environ.get('ZHIPU_API_KEY'):
+        raise Exception("未设置ZHIPU_API_KEY，请在.env中配置智谱AI API密钥")
+
+    client = _get_async_client()
+    candidates = _text_candidates()
+    routed = provider_router.order(candidates) if get_hedge_settings()['enabled'] else []
+    if len(routed) >= 2:
+        tokens = _ahedged_stream(client, routed[0], routed[1], messages)
+    else:
+        provider, resp, started = await _aopen_stream(client, candidates, messages)
+        tokens = _aiter_stream_tokens(resp, provider, started)
+    # 调用方中途停止时立即关闭上游连接（不等待垃圾回收）
+    try:
+        async for token in tokens:
+            yield token
+    finally:
+        await tokens.aclose()
 
 
 # ==============================================================================
@@ -0,0 +1,139 @@
+"""
+Prompt 预算 - 按估算的token数分配系统提示、参考资料、历史对话与问题
+
+build_messages 原先把知识库和搜索结果拼到系统提示后按 8000 字符硬截断
+（可能把文本块截在半句话中间），同时无条件附带最多 20 条任意长度的历史消息。
+
+现在按 token 预算(PROMPT_TOKEN_BUDGET)组装:
+    1. 系统提示与当前问题必须保留
+    2. 历史对话: 从最近一条往前整条选取，最多占剩余预算的 PROMPT_HISTORY_SHARE
+    3. 参考资料: 剩余预算(含历史未用完的部分)先按相关度从高到低整块放入知识库文本块，
+       再依次放入网络搜索结果；放不下的整块跳过，不截断
+    4. 仍有余量时，放不下的更早对话以用户提问摘要的形式附上(见 history_digest)
+
+token 数按字符估算(见 estimate_tokens)：中日韩字符与其他字符分别按各提供者分词器的经验比例换算。
+组装时尚未确定由哪个后端回答（见 ai/provider_router.py），默认取各提供者中最保守的比例。
+
+配置(环境变量，见 config.py):
+    PROMPT_TOKEN_BUDGET: 每次请求输入部分的token预算
+    PROMPT_HISTORY_SHARE: 历史对话最多占用的预算比例
+"""
+import os
+import re
+
+# 各提供者分词器的经验比例: (每个中日韩字符的token数, 每个其他字符的token数)
+TOKEN_RATIOS = {
+    'zhipu': (0.6, 0.25),        # GLM-4: 约1.6个汉字/token
+    'siliconflow': (0.7, 0.25),  # Qwen: 约1.4个汉字/token
+}
+
+# 未知提供者使用的比例（偏保守）
+DEFAULT_TOKEN_RATIO = (1.0, 0.3)
+
+# 每条消息的格式开销(角色标记等)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 被省略的早期对话摘要: 最多列出最近几条用户提问、每条保留的字数
+HISTORY_DIGEST_QUESTIONS = 5
+HISTORY_DIGEST_CHARS = 40
+
+# 中日韩字符（含中日文标点与全角字符）
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def get_prompt_budget_settings():
+    """读取Prompt预算配置
+
+    Returns:
+        dict: budget / history_share
+    """
+    return {
+        'budget': max(500, int(os.environ.get('PROMPT_TOKEN_BUDGET', '5000'))),
+        'history_share': min(1.0, max(0.0, float(os.environ.get('PROMPT_HISTORY_SHARE', '0.3')))),
+    }
+
+
+def estimate_tokens(text, provider=None):
+    """估算文本的token数
+
+    Args:
+        text: 文本(str)
+        provider: 提供者名称(str)，None 表示取各提供者中最保守的估算
+
+    Returns:
+        int: 估算的token数(向上取整)
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    if provider is None:
+        ratios = TOKEN_RATIOS.values()
+    else:
+        ratios = [TOKEN_RATIOS.get(provider, DEFAULT_TOKEN_RATIO)]
+    return int(max(cjk * per_cjk + other * per_other for per_cjk, per_other in ratios)) + 1
+
+
+def select_within_budget(items, cost, budget):
+    """按顺序选取放得下的条目（放不下的跳过，继续尝试后面更短的条目）
+
+    Args:
+        items: 候选条目列表（已按优先级排序）
+        cost: 计算单个条目token数的函数
+        budget: 可用token数(int)
+
+    Returns:
+        tuple: (选中的条目列表(保持原顺序), 使用的token数)
+    """
+    selected, used = [], 0
+    for item in items:
+        item_cost = cost(item)
+        if used + item_cost <= budget:
+            selected.append(item)
+            used += item_cost
+    return selected, used
+
+
+def fit_history(history, budget, provider=None):
+    """从最近一条往前选取放得下的历史消息
+
+    Args:
+        history: 历史消息列表(list[dict])，按时间正序
+        budget: 可用token数(int)
+        provider: 提供者名称(str，可选)
+
+    Returns:
+        tuple: (保留的消息列表(时间正序), 被省略的消息列表(时间正序), 使用的token数)
+    """
+    kept, used = [], 0
+    for index in range(len(history) - 1, -1, -1):
+        cost = estimate_tokens(history[index]['content'], provider) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        kept.append(history[index])
+        used += cost
+    kept.reverse()
+    # 保留的部分不以助手回答开头（否则缺少对应的提问）
+    while kept and kept[0]['role'] != 'user':
+        used -= estimate_tokens(kept[0]['content'], provider) + MESSAGE_OVERHEAD_TOKENS
+        kept.pop(0)
+    return kept, history[:len(history) - len(kept)], used
+
+
+def history_digest(omitted):
+    """被省略的早期对话的摘要：只列出用户最近 HISTORY_DIGEST_QUESTIONS 条提问(各截取前 HISTORY_DIGEST_CHARS 字)
+
+    Returns:
+        str: 摘要文本，没有可列出的提问时为空字符串
+    """
+    questions = []
+    for msg in omitted:
+        if msg['role'] == 'user' and msg['content'].strip():
+            text = ' '.join(msg['content'].split())
+            if len(text) > HISTORY_DIGEST_CHARS:
+                text = text[:HISTORY_DIGEST_CHARS] + '…'
+            questions.append(text)
+    if not questions:
+        return ""
+    questions = questions[-HISTORY_DIGEST_QUESTIONS:]
+    return "【更早的对话(已省略)中用户问过】\n" + '\n'.join(f"- {q}" for q in questions)
@@ -0,0 +1,253 @@
+"""
+LLM 提供者路由 - 按健康状况选择后端，熔断持续失败的提供者
+
+原先 chat() 总是先请求智谱AI，完整往返拿到 429 后才切换 SiliconFlow；
+视觉问答也要逐个模型各吃一次 429。智谱排队高峰期间，每个用户都要先付出一次注定失败的请求。
+
+本模块按 (提供者, 模型) 统计最近 ROUTER_WINDOW_SECONDS 秒内的请求结果:
+    - 延迟、错误率、429比例（见 snapshot()，健康检查接口展示）
+    - 熔断器: 连续失败 ROUTER_FAILURE_THRESHOLD 次，或窗口内失败率达到 ROUTER_ERROR_RATE，
+      则打开熔断，ROUTER_OPEN_SECONDS 秒内新请求直接跳过该后端
+    - 冷却结束后进入半开状态: 只放行一个请求试探（后台探测线程或真实请求），
+      成功则关闭熔断，失败则重新打开
+
+状态:
+    closed(正常) → open(熔断，跳过) → half_open(试探中) → closed / open
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# 请求结果
+OUTCOME_OK = 'ok'
+OUTCOME_RATE_LIMITED = 'rate_limited'   # 429 排队/限流
+OUTCOME_ERROR = 'error'                 # 5xx / 连接失败 / 超时
+
+# 熔断器状态
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+# 试探名额的有效期(秒)：放行的请求最终未发往该后端(前一个后端已成功)时，名额到期后释放
+PROBE_CLAIM_SECONDS = 60
+
+
+def get_router_settings():
+    """读取提供者路由配置
+
+    环境变量:
+        ROUTER_WINDOW_SECONDS: 统计窗口(秒)，默认60
+        ROUTER_FAILURE_THRESHOLD: 连续失败多少次打开熔断，默认3
+        ROUTER_ERROR_RATE: 窗口内失败率(含429)达到多少打开熔断，默认0.5
+        ROUTER_MIN_SAMPLES: 按失败率判断所需的最少样本数，默认5
+        ROUTER_OPEN_SECONDS: 熔断持续时间(秒)，之后进入半开试探，默认30
+        ROUTER_PROBE_ENABLED: 是否由后台线程主动探测恢复('true'/'false')，默认true
+
+    Returns:
+        dict: window / failure_threshold / error_rate / min_samples / open_seconds / probe_enabled
+    """
+    return {
+        'window': float(os.environ.get('ROUTER_WINDOW_SECONDS', '60')),
+        'failure_threshold': max(1, int(os.environ.get('ROUTER_FAILURE_THRESHOLD', '3'))),
+        'error_rate': float(os.environ.get('ROUTER_ERROR_RATE', '0.5')),
+        'min_samples': max(1, int(os.environ.get('ROUTER_MIN_SAMPLES', '5'))),
+        'open_seconds': float(os.environ.get('ROUTER_OPEN_SECONDS', '30')),
+        'probe_enabled': os.environ.get('ROUTER_PROBE_ENABLED', 'true').lower() == 'true',
+    }
+
+
+class _Backend:
+    """单个 (提供者, 模型) 的滚动统计与熔断状态（由 ProviderRouter 加锁访问）"""
+
+    def __init__(self):
+        self.samples = deque()          # (时间戳, 结果, 延迟ms)
+        self.consecutive_failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.retry_at = 0.0             # open 状态下允许试探的时刻
+        self.probing_since = None       # half_open 状态下试探请求的放行时刻(None 表示尚无)
+
+    def trim(self, now, window):
+        while self.samples and now - self.samples[0][0] > window:
+            self.samples.popleft()
+
+    def refresh(self, now):
+        """open 状态冷却结束后转为 half_open"""
+        if self.state == CIRCUIT_OPEN and now >= self.retry_at:
+            self.state = CIRCUIT_HALF_OPEN
+            self.probing_since = None
+
+    def claim_probe(self, now):
+        """half_open 状态下领取唯一的试探名额（领取后未上报结果的名额超时可被再次领取）"""
+        if self.probing_since is not None and now - self.probing_since < PROBE_CLAIM_SECONDS:
+            return False
+        self.probing_since = now
+        return True
+
+
+class ProviderRouter:
+    """按健康状况为请求排列候选后端，并在后台探测熔断后端的恢复情况（线程安全）"""
+
+    # 后台探测线程的检查间隔(秒)
+    PROBE_INTERVAL = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backends = {}
+        self._prober = None
+        self._probe_thread = None
+
+    def _backend(self, key):
+        backend = self._backends.get(key)
+        if backend is None:
+            backend = self._backends[key] = _Backend()
+        return backend
+
+    # ------------------------------------------------------------------
+    # 对外接口
+    # ------------------------------------------------------------------
+    def set_prober(self, prober):
+        """注册探测函数，签名 prober(provider, model) -> 结果(OUTCOME_*)"""
+        self._prober = prober
+
+    def order(self, candidates):
+        """按健康状况过滤候选后端（保持调用方给出的优先顺序）
+
+        Args:
+            candidates: [(provider, model), ...]，按优先级排列
+
+        Returns:
+            list: 可尝试的后端列表；熔断中的后端被跳过，半开后端仅放行一个试探请求。
+                  若全部熔断，则返回最早可恢复的一个（总要尝试一次，而不是直接报错）
+        """
+        now = time.monotonic()
+        allowed, blocked = [], []
+        with self._lock:
+            for key in candidates:
+                backend = self._backend(key)
+                backend.refresh(now)
+                if backend.state == CIRCUIT_CLOSED:
+                    allowed.append(key)
+                elif backend.state == CIRCUIT_HALF_OPEN and backend.claim_probe(now):
+                    allowed.append(key)
+                else:
+                    blocked.append((backend.retry_at, key))
+        if not allowed and blocked:
+            allowed.append(min(blocked)[1])
+        return allowed
+
+    def record(self, provider, model, outcome, latency_ms=None):
+        """记录一次请求结果并更新熔断状态
+
+        Args:
+            provider: 提供者(str)
+            model: 模型名(str)
+            outcome: OUTCOME_OK / OUTCOME_RATE_LIMITED / OUTCOME_ERROR
+            latency_ms: 请求耗时(ms，可选)
+        """
+        settings = get_router_settings()
+        now = time.monotonic()
+        opened = False
+        with self._lock:
+            backend = self._backend((provider, model))
+            backend.samples.append((now, outcome, latency_ms))
+            backend.trim(now, settings['window'])
+
+            if outcome == OUTCOME_OK:
+                backend.consecutive_failures = 0
+                if backend.state != CIRCUIT_CLOSED:
+                    backend.state = CIRCUIT_CLOSED
+                    backend.samples = deque([backend.samples[-1]])
+                    print(f"[INFO] {provider}/{model} 已恢复，关闭熔断")
+                return
+
+            backend.consecutive_failures += 1
+            failures = sum(1 for s in backend.samples if s[1] != OUTCOME_OK)
+            trip = (
+                backend.state == CIRCUIT_HALF_OPEN
+                or backend.consecutive_failures >= settings['failure_threshold']
+                or (len(backend.samples) >= settings['min_samples']
+                    and failures / len(backend.samples) >= settings['error_rate'])
+            )
+            if trip and backend.state != CIRCUIT_OPEN:
+                backend.state = CIRCUIT_OPEN
+                backend.retry_at = now + settings['open_seconds']
+                opened = True
+        if opened:
+            print(f"[WARN] {provider}/{model} 持续失败({outcome})，熔断 {settings['open_seconds']:.0f}s，"
+                  f"新请求将直接使用其他后端")
+            if settings['probe_enabled']:
+                self._ensure_probe_thread()
+
+    def snapshot(self):
+        """各后端最近窗口内的统计与熔断状态
+
+        Returns:
+            dict: {"provider/model": {state, requests, error_rate, rate_limited_rate, latency_p50_ms,
+                   consecutive_failures, retry_in_seconds}}
+        """
+        settings = get_router_settings()
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for (provider, model), backend in self._backends.items():
+                backend.trim(now, settings['window'])
+                backend.refresh(now)
+                samples = list(backend.samples)
+                latencies = sorted(s[2] for s in samples if s[2] is not None)
+                n = len(samples)
+                result[f"{provider}/{model}"] = {
+                    'state': backend.state,
+                    'requests': n,
+                    'error_rate': round(sum(1 for s in samples if s[1] != OUTCOME_OK) / n, 3) if n else 0.0,
+                    'rate_limited_rate': round(sum(1 for s in samples if s[1] == OUTCOME_RATE_LIMITED) / n, 3) if n else 0.0,
+                    'latency_p50_ms': round(latencies[len(latencies) // 2], 1) if latencies else None,
+                    'consecutive_failures': backend.consecutive_failures,
+                    'retry_in_seconds': round(max(0.0, backend.retry_at - now), 1) if backend.state == CIRCUIT_OPEN else 0,
+                }
+        return result
+
+    def reset(self):
+        """清空全部统计与熔断状态"""
+        with self._lock:
+            self._backends.clear()
+
+    # ------------------------------------------------------------------
+    # 后台探测
+    # ------------------------------------------------------------------
+    def _ensure_probe_thread(self):
+        with self._lock:
+            if self._probe_thread is not None or self._prober is None:
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, name='llm-router-probe', daemon=True)
+            self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.PROBE_INTERVAL)
+            if not get_router_settings()['probe_enabled']:
+                continue
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                for key, backend in self._backends.items():
+                    backend.refresh(now)
+                    if backend.state == CIRCUIT_HALF_OPEN and backend.claim_probe(now):
+                        due.append(key)
+            for provider, model in due:
+                started = time.perf_counter()
+                try:
+                    outcome = self._prober(provider, model)
+                except Exception as e:
+                    print(f"[WARN] 探测 {provider}/{model} 异常: {e}")
+                    outcome = OUTCOME_ERROR
+                self.record(provider, model, outcome, (time.perf_counter() - started) * 1000)
+
+
+# 全局单例
+provider_router = ProviderRouter()
+
+
+def get_router_stats():
+    """本进程各LLM后端的健康统计与熔断状态（用于健康检查接口）"""
+    return provider_router.snapshot()
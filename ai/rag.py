@@ -2,110 +2,141 @@
 RAG 核心逻辑 - 检索增强生成
 流程: 用户提问 → 向量检索知识库 → (可选)网络搜索补充 → 组装Prompt → LLM生成回答
 这是整个AI对话功能的核心模块
+
+上下文组装(assemble_context)并发执行三个互相独立的阶段：
+知识库检索(问题向量化HTTP + 索引检索)、历史对话读取(DB)、网络搜索(Tavily HTTP，可选投机执行)。
+每个阶段有独立的截止时间，超时或失败的阶段降级为空结果，不会拖慢整体；
+各阶段耗时随每次请求打印，并在返回结果中给出。
 """
 import json
-import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
 from flask import current_app
-from ai.embedding import embed_single, cosine_similarity
+from ai.answer_cache import answer_cache, chunk_fingerprint, get_answer_cache_settings, replay_answer
+from ai.embedding import embed_single
+from ai.embedding_cache import normalize_query
 from ai.llm import chat, get_system_prompt, build_image_message
+from ai.lexical_index import fuse_hits, get_hybrid_settings, is_decisive, keyword_only_hits, record_retrieval
+from ai.rerank import get_rerank_settings, rerank
+from ai.prompt_budget import (MESSAGE_OVERHEAD_TOKENS, estimate_tokens, fit_history, get_prompt_budget_settings,
+                              history_digest, select_within_budget)
 from ai.search import search_web, format_search_results
-from models import db, KnowledgeChunk, KnowledgeFile, ChatMessage, ExternalKnowledge, ExternalKnowledgeChunk
+from ai.summary import load_session_context, schedule_summary
+from ai.vector_index import knowledge_index
+from models import db, ChatMessage
 
 
-def retrieve_knowledge(query, top_k=5, similarity_threshold=0.3):
+def retrieve_knowledge(query, top_k=5, similarity_threshold=0.3, return_embedding=False):
     """从知识库中检索与问题最相关的文本块（包含本地知识库和外部知识库）
     
     Args:
         query: 用户提问(str)
         top_k: 返回最相关的K个结果(int)，默认5
         similarity_threshold: 相似度阈值(float)，低于此值的结果被过滤，默认0.3
+        return_embedding: 为 True 时同时返回本次检索使用的问题向量(bool)，默认False
     
     Returns:
-        list[dict]: 检索结果列表，每项包含:
+        list[dict]: 检索结果列表（return_embedding 为 True 时返回 (检索结果列表, 问题向量)，
+        未做向量检索——只用了关键词结果、Embedding 失败或知识库为空——时问题向量为 None），每项包含:
             - content: 文本内容
             - source: 来源文件名
-            - similarity: 与问题的相似度得分
+            - similarity: 与问题的余弦相似度；只有关键词检索结果时为 None
+            - keyword_score: 只有关键词检索结果时给出，BM25 分数与最佳命中之比
             - chunk_id: 文本块ID
-    """
-    scored_chunks = []
 
-    # 先检查知识库是否有数据，避免无意义地调用embedding API
-    try:
-        local_count = KnowledgeChunk.query.filter(KnowledgeChunk.embedding.isnot(None)).count()
-        external_count = ExternalKnowledgeChunk.query.filter(
-            ExternalKnowledgeChunk.embedding.isnot(None)
-        ).join(ExternalKnowledge).filter(ExternalKnowledge.is_active == True).count()
-        if local_count + external_count == 0:
-            return []
-    except Exception:
-        try:
-            local_count = KnowledgeChunk.query.filter(KnowledgeChunk.embedding.isnot(None)).count()
-            if local_count == 0:
-                return []
-        except Exception:
-            return []
+    向量打分由进程内索引 ai.vector_index.knowledge_index 完成
+    （一次矩阵-向量乘法 + argpartition），原文和来源名称也由索引直接给出，
+    因此每次提问的数据库查询次数是常数（通常为0，仅在定期比对指纹时查询），与命中数无关。
 
-    # 将问题向量化
-    try:
-        query_embedding = embed_single(query)
-    except Exception as e:
-        print(f"[WARN] Embedding失败，跳过知识库检索: {e}")
-        return []
+    启用混合检索(HYBRID_SEARCH_ENABLED)时同时做 BM25 关键词检索（见 ai/lexical_index.py）:
+    关键词结果足够明确时直接采用、不调用 Embedding API（按 keyword_score 排序，不经过余弦相似度阈值）；
+    否则与向量检索结果按 RRF 融合；Embedding 失败时同样退回关键词结果。
 
-    # 获取本地知识库文本块
-    try:
-        chunks = KnowledgeChunk.query.filter(KnowledgeChunk.embedding.isnot(None)).all()
-    except Exception as e:
-        db.session.rollback()
-        print(f"[WARN] 查询知识库失败: {e}")
-        chunks = []
+    启用重排序(RERANK_ENABLED)时先取 RERANK_CANDIDATES 个候选，经自适应阈值、
+    相邻块合并和MMR多样性选择后返回至多 top_k 段（见 ai/rerank.py），合并段的 content 为多个相邻块的拼接。
+    """
+    results, query_embedding = _retrieve(query, top_k, similarity_threshold)
+    return (results, query_embedding) if return_embedding else results
 
-    for chunk in chunks:
-        try:
-            chunk_embedding = json.loads(chunk.embedding)
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-            if similarity >= similarity_threshold:
-                source_file = KnowledgeFile.query.get(chunk.file_id)
-                source_name = source_file.filename if source_file else "未知来源"
-                scored_chunks.append({
-                    'content': chunk.content,
-                    'source': source_name,
-                    'similarity': round(similarity, 4),
-                    'chunk_id': chunk.id
-                })
-        except (json.JSONDecodeError, TypeError):
-            continue
-
-    # 获取外部知识库文本块（仅启用的链接）
+
+def _retrieve(query, top_k, similarity_threshold):
+    """retrieve_knowledge 的实现，返回 (检索结果列表, 问题向量或 None)"""
+    # 加载/校验索引；知识库为空时直接返回，避免无意义地调用embedding API
     try:
-        active_ids = [lk.id for lk in ExternalKnowledge.query.filter_by(is_active=True).all()]
-        if active_ids:
-            ext_chunks = ExternalKnowledgeChunk.query.filter(
-                ExternalKnowledgeChunk.embedding.isnot(None),
-                ExternalKnowledgeChunk.external_id.in_(active_ids)
-            ).all()
-            for chunk in ext_chunks:
-                try:
-                    chunk_embedding = json.loads(chunk.embedding)
-                    similarity = cosine_similarity(query_embedding, chunk_embedding)
-                    if similarity >= similarity_threshold:
-                        source_link = ExternalKnowledge.query.get(chunk.external_id)
-                        source_name = source_link.name if source_link else "外部知识库"
-                        scored_chunks.append({
-                            'content': chunk.content,
-                            'source': source_name,
-                            'similarity': round(similarity, 4),
-                            'chunk_id': chunk.id
-                        })
-                except (json.JSONDecodeError, TypeError):
-                    continue
+        knowledge_index.ensure_fresh()
     except Exception as e:
         db.session.rollback()
-        print(f"[WARN] 查询外部知识库失败: {e}")
+        print(f"[WARN] 加载知识库索引失败: {e}")
+        return [], None
+    if len(knowledge_index) == 0:
+        return [], None
+
+    settings = get_rerank_settings()
+    hybrid = get_hybrid_settings()
+    n_candidates = max(top_k, settings['candidates']) if settings['enabled'] else top_k
+
+    # 关键词检索（不需要问题向量）
+    lexical_hits, term_count = [], 0
+    query_embedding = None
+    if hybrid['enabled']:
+        lexical_hits, term_count = knowledge_index.lexical_search(query, n_candidates)
+
+    if is_decisive(lexical_hits, term_count, hybrid):
+        record_retrieval('lexical_only')
+        candidates = keyword_only_hits(lexical_hits)
+    else:
+        # 将问题向量化
+        try:
+            query_embedding = embed_single(query)
+        except Exception as e:
+            if not lexical_hits:
+                print(f"[WARN] Embedding失败，跳过知识库检索: {e}")
+                return [], None
+            print(f"[WARN] Embedding失败，仅使用关键词检索结果: {e}")
+            record_retrieval('lexical_fallback')
+            # 降级模式：保留全部关键词命中（小知识库中常见词的覆盖率偏低）
+            candidates = keyword_only_hits(lexical_hits, min_coverage=0.0)
+        else:
+            candidates = knowledge_index.search(query_embedding, n_candidates, similarity_threshold,
+                                                with_vectors=True)
+            if lexical_hits:
+                record_retrieval('fused')
+                candidates = fuse_hits(candidates, lexical_hits, query_embedding, similarity_threshold,
+                                       hybrid['rrf_k'])
+
+    if settings['enabled']:
+        hits = rerank(candidates, top_k, similarity_threshold, settings)
+    else:
+        hits = [hit for hit in candidates
+                if 'similarity' not in hit or hit['similarity'] >= similarity_threshold][:top_k]
+    results = []
+    for hit in hits:
+        result = {
+            'content': hit['content'],
+            'source': hit['source'],
+            'similarity': round(hit['similarity'], 4) if 'similarity' in hit else None,
+            'chunk_id': hit['chunk_id']
+        }
+        if 'similarity' not in hit:
+            result['keyword_score'] = round(hit['keyword_score'], 4)
+        results.append(result)
+    return results, query_embedding
+
 
-    # 按相似度降序排列，取top_k
-    scored_chunks.sort(key=lambda x: x['similarity'], reverse=True)
-    return scored_chunks[:top_k]
+def _chunk_relevance(chunk):
+    """检索结果的排序分数：余弦相似度，只有关键词检索结果时为 keyword_score"""
+    if chunk.get('similarity') is None:
+        return chunk.get('keyword_score', 0.0)
+    return chunk['similarity']
+
+
+def _chunk_label(chunk):
+    """参考资料标注行：向量检索结果标注相关度，只有关键词检索结果时标注关键词匹配度"""
+    if chunk.get('similarity') is None:
+        return f"[来源: {chunk.get('source', '未知')} | 关键词匹配度: {chunk.get('keyword_score', 0.0)}]"
+    return f"[来源: {chunk.get('source', '未知')} | 相关度: {chunk['similarity']}]"
 
 
 def format_knowledge_context(chunks):
@@ -132,6 +163,8 @@ def format_knowledge_context(chunks):
         微信账号继承需要提供...
         --- 参考资料结束 ---
         </untrusted_reference>
+
+        只有关键词检索结果时标注为 "关键词匹配度"(BM25 分数与最佳命中之比，不是余弦相似度)。
     """
     if not chunks:
         return ""
@@ -144,7 +177,7 @@ def format_knowledge_context(chunks):
     ]
     for chunk in chunks:
         parts.append("")
-        parts.append(f"[来源: {chunk.get('source', '未知')} | 相关度: {chunk['similarity']}]")
+        parts.append(_chunk_label(chunk))
         parts.append(chunk['content'])
     parts.append("")
     parts.append("--- 参考资料结束 ---")
@@ -152,7 +185,93 @@ def format_knowledge_context(chunks):
     return '\n'.join(parts)
 
 
-def build_messages(query, knowledge_context="", search_context="", history=None, image_base64=None, image_mime_type="image/jpeg"):
+def plan_prompt(query, knowledge_chunks=None, search_results=None, history=None, image_base64=None, provider=None,
+                summary=""):
+    """按token预算选取放入Prompt的参考资料与历史对话（规则见 ai/prompt_budget.py）
+
+    Args:
+        query: 用户当前提问(str)
+        knowledge_chunks: retrieve_knowledge() 的结果
+        search_results: search_web() 的结果
+        history: 历史对话列表(list[dict])
+        image_base64: 有图片时不带历史对话（图片本身不计入预算）
+        provider: 估算token使用的提供者(str)，None 表示取最保守的估算
+        summary: 较早对话的会话摘要(str，见 ai/summary.py)，计入历史对话的预算
+
+    Returns:
+        dict:
+            - knowledge_chunks: 放入的知识库文本块（按相关度从高到低）
+            - search_results: 放入的网络搜索结果
+            - history: 放入的历史消息（时间正序）
+            - history_digest: 会话摘要及被省略的早期提问(str，可能为空)
+            - report: 预算使用情况 {budget, tokens, chunks, search, history}，可放入 timings
+    """
+    settings = get_prompt_budget_settings()
+    knowledge_chunks = knowledge_chunks or []
+    search_results = search_results or []
+    history = [] if image_base64 else (history or [])[-20:]
+    summary_text = f"【此前对话摘要(系统根据较早的对话自动生成)】\n{summary}" if summary and not image_base64 else ""
+    system_prompt = get_system_prompt()
+    remaining = (settings['budget'] - estimate_tokens(system_prompt, provider)
+                 - estimate_tokens(query, provider) - 2 * MESSAGE_OVERHEAD_TOKENS)
+
+    # ① 会话摘要与历史对话：最近优先，合计最多占剩余预算的 history_share
+    history_budget = int(max(0, remaining) * settings['history_share'])
+    summary_cost = estimate_tokens(summary_text, provider)
+    if summary_cost > history_budget:
+        summary_text, summary_cost = "", 0
+    kept_history, omitted, used = fit_history(history, history_budget - summary_cost, provider)
+    remaining -= used + summary_cost
+
+    # ② 知识库文本块：按相关度从高到低整块放入
+    ranked = sorted(knowledge_chunks, key=_chunk_relevance, reverse=True)
+    overhead = estimate_tokens(format_knowledge_context([{'source': '', 'similarity': 0, 'content': ''}]), provider)
+    chunks, used = select_within_budget(
+        ranked,
+        lambda c: estimate_tokens(f"{_chunk_label(c)}\n{c['content']}\n", provider),
+        remaining - overhead)
+    if chunks:
+        remaining -= used + overhead
+
+    # ③ 网络搜索结果：用剩余预算依次放入
+    overhead = estimate_tokens(format_search_results([{'title': '', 'content': ''}]), provider)
+    results, used = select_within_budget(
+        search_results,
+        lambda r: estimate_tokens(f"{r['title']}\n   {r['content'][:300]}\n", provider),
+        remaining - overhead)
+    if results:
+        remaining -= used + overhead
+
+    # ④ 被省略的早期对话：预算还有余量时附上提问摘要
+    digest = history_digest(omitted)
+    if digest and estimate_tokens(digest, provider) <= remaining:
+        remaining -= estimate_tokens(digest, provider)
+    else:
+        digest = ""
+    digest = "\n\n".join(text for text in (summary_text, digest) if text)
+
+    report = {
+        'budget': settings['budget'],
+        'tokens': settings['budget'] - remaining,
+        'chunks': f"{len(chunks)}/{len(knowledge_chunks)}",
+        'search': f"{len(results)}/{len(search_results)}",
+        'history': f"{len(kept_history)}/{len(history)}",
+        'summary': bool(summary_text),
+    }
+    if len(chunks) < len(knowledge_chunks) or len(results) < len(search_results) or omitted:
+        print(f"[INFO] Prompt预算 {settings['budget']} tokens(估算使用 {report['tokens']}): "
+              f"知识库 {report['chunks']} 块, 搜索 {report['search']} 条, 历史 {report['history']} 条")
+    return {
+        'knowledge_chunks': chunks,
+        'search_results': results,
+        'history': kept_history,
+        'history_digest': digest,
+        'report': report,
+    }
+
+
+def build_messages(query, knowledge_context="", search_context="", history=None, image_base64=None, image_mime_type="image/jpeg",
+                   history_digest_text=""):
     """组装发给LLM的完整消息列表
     
     Args:
@@ -160,14 +279,16 @@ def build_messages(query, knowledge_context="", search_context="", history=None,
         knowledge_context: 知识库检索结果文本(str)，由 format_knowledge_context() 生成
         search_context: 网络搜索结果文本(str)，由 format_search_results() 生成
         history: 历史对话列表(list[dict])，格式: [{"role": "user/assistant", "content": "..."}]
+                 应先经 plan_prompt() 按预算选取
         image_base64: 图片的Base64编码(str)，不含data:前缀。为None时表示纯文本对话
         image_mime_type: 图片MIME类型(str)，默认image/jpeg
+        history_digest_text: 被省略的早期对话摘要(str)，由 plan_prompt() 生成
     
     Returns:
         list[dict]: 完整的消息列表，可直接传给 llm.chat()
     
     消息结构:
-        1. system: 系统提示词 + 知识库上下文 + 搜索上下文
+        1. system: 系统提示词 + 知识库上下文 + 搜索上下文 + 早期对话摘要
         2. 历史对话（最近N轮）
         3. user: 当前问题（如果有图片则为多模态消息）
     
@@ -181,18 +302,15 @@ def build_messages(query, knowledge_context="", search_context="", history=None,
         system_content += "\n\n" + knowledge_context
     if search_context:
         system_content += "\n\n" + search_context
-
-    # 限制系统提示词长度，避免Ollama等模型因超长输入返回400
-    if len(system_content) > 8000:
-        system_content = system_content[:8000] + "\n\n[注意：知识库内容过长，已截断]"
+    if history_digest_text:
+        system_content += "\n\n" + history_digest_text
 
     messages = [{"role": "system", "content": system_content}]
 
     # 视觉问答时不发送历史对话（多模态content为数组，与历史纯文本content混排
     # 会导致智谱AI等返回400 Bad Request）
     if not image_base64 and history:
-        recent_history = history[-20:]
-        messages.extend(recent_history)
+        messages.extend(history)
 
     # 添加当前问题（区分纯文本和带图片两种情况）
     if image_base64:
@@ -206,7 +324,224 @@ def build_messages(query, knowledge_context="", search_context="", history=None,
     return messages
 
 
-def rag_query(query, user_id=None, session_id=None, enable_search=True, stream=False, image_base64=None, image_mime_type="image/jpeg"):
+# ===== 并发上下文组装 =====
+# 上下文组装线程池（各阶段以 I/O 等待为主；超时的阶段仍在后台跑完，因此池子要留余量）
+_context_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('RAG_CONTEXT_WORKERS', '8')),
+                                   thread_name_prefix='rag-context')
+
+
+def get_context_settings():
+    """读取上下文组装配置
+
+    环境变量:
+        RAG_KNOWLEDGE_TIMEOUT: 知识库检索截止时间(秒)，默认8
+        RAG_SEARCH_TIMEOUT: 网络搜索截止时间(秒)，默认8
+        RAG_HISTORY_TIMEOUT: 历史对话读取截止时间(秒)，默认5
+        RAG_SPECULATIVE_SEARCH: 是否与知识库检索同时发起网络搜索('true'/'false')，默认false；
+            开启后知识库无结果时少等一次搜索，但知识库命中时(多数提问)付费搜索的结果也被丢弃
+
+    Returns:
+        dict: knowledge_timeout / search_timeout / history_timeout / speculative_search
+    """
+    return {
+        'knowledge_timeout': float(os.environ.get('RAG_KNOWLEDGE_TIMEOUT', '8')),
+        'search_timeout': float(os.environ.get('RAG_SEARCH_TIMEOUT', '8')),
+        'history_timeout': float(os.environ.get('RAG_HISTORY_TIMEOUT', '5')),
+        'speculative_search': os.environ.get('RAG_SPECULATIVE_SEARCH', 'false').lower() == 'true',
+    }
+
+
+def _submit_stage(app, fn, *args, **kwargs):
+    """在线程池中执行一个阶段（推入应用上下文，数据库会话随上下文结束释放）
+
+    Returns:
+        tuple: (Future, 提交时刻)
+    """
+    def run():
+        start = time.perf_counter()
+        with app.app_context():
+            result = fn(*args, **kwargs)
+        return result, (time.perf_counter() - start) * 1000
+    return _context_pool.submit(run), time.perf_counter()
+
+
+def _collect_stage(name, submitted, deadline, fallback, timings):
+    """等待阶段结果，直到截止时间；超时或异常时返回 fallback 并记录状态
+
+    Args:
+        name: 阶段名(str)
+        submitted: _submit_stage 的返回值，None 表示阶段未执行
+        deadline: 截止时间(秒，从阶段提交时算起)
+        fallback: 降级结果
+        timings: 耗时记录(dict)，写入 {name: {'ms': 耗时, 'status': ok/timeout/error/skipped}}
+    """
+    if submitted is None:
+        timings[name] = {'ms': 0, 'status': 'skipped'}
+        return fallback
+    future, started = submitted
+    remaining = max(0.0, deadline - (time.perf_counter() - started))
+    try:
+        result, elapsed_ms = future.result(timeout=remaining)
+        timings[name] = {'ms': round(elapsed_ms, 1), 'status': 'ok'}
+        return result
+    except FutureTimeoutError:
+        timings[name] = {'ms': round((time.perf_counter() - started) * 1000, 1), 'status': 'timeout'}
+        print(f"[WARN] RAG上下文阶段 {name} 超过 {deadline}s 截止时间，已降级跳过")
+    except Exception as e:
+        timings[name] = {'ms': round((time.perf_counter() - started) * 1000, 1), 'status': 'error'}
+        print(f"[WARN] RAG上下文阶段 {name} 失败，已降级跳过: {e}")
+    return fallback
+
+
+def assemble_context(query, user_id=None, session_id=None, enable_search=True, image_base64=None):
+    """并发组装 RAG 上下文：知识库检索、历史对话、网络搜索
+
+    Args:
+        query: 用户提问(str)
+        user_id: 用户ID(int)，与 session_id 同时提供时读取历史对话
+        session_id: 会话ID(str)
+        enable_search: 是否允许网络搜索(bool)
+        image_base64: 图片Base64(str)，有图片时不做网络搜索
+
+    Returns:
+        dict:
+            - knowledge_chunks: retrieve_knowledge() 的结果
+            - query_embedding: 检索时计算的问题向量，未做向量检索时为 None
+            - search_results: search_web() 的结果（仅当知识库无结果时使用，否则为空列表）
+            - history: 历史对话列表（会话摘要之后的消息）
+            - summary: 较早对话的摘要(str，见 ai/summary.py)
+            - timings: 各阶段耗时 {阶段: {'ms', 'status'}}，另含 total_ms
+
+    网络搜索仍只在知识库无结果时采用（与原先的串行逻辑一致）；
+    投机模式下搜索与检索同时发起，知识库有结果时丢弃搜索结果。
+    """
+    settings = get_context_settings()
+    app = current_app._get_current_object()
+    start = time.perf_counter()
+    timings = {}
+
+    want_search = enable_search and not image_base64
+    knowledge_job = _submit_stage(app, retrieve_knowledge, query, return_embedding=True)
+    history_job = _submit_stage(app, load_session_context, user_id, session_id) if user_id and session_id else None
+    search_job = _submit_stage(app, search_web, query) if want_search and settings['speculative_search'] else None
+
+    knowledge_chunks, query_embedding = _collect_stage('knowledge', knowledge_job, settings['knowledge_timeout'],
+                                                       ([], None), timings)
+
+    search_results = []
+    if want_search and not knowledge_chunks:
+        if search_job is None:
+            search_job = _submit_stage(app, search_web, query)
+        search_results = _collect_stage('search', search_job, settings['search_timeout'], [], timings)
+    else:
+        timings['search'] = {'ms': 0, 'status': 'skipped' if search_job is None else 'unused'}
+
+    session_context = _collect_stage('history', history_job, settings['history_timeout'],
+                                     {'summary': '', 'history': []}, timings)
+
+    timings['total_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    stages = ' '.join(f"{name}={t['ms']}ms({t['status']})"
+                      for name, t in timings.items() if name != 'total_ms')
+    print(f"[INFO] RAG上下文组装 {timings['total_ms']}ms: {stages}")
+
+    return {
+        'knowledge_chunks': knowledge_chunks,
+        'query_embedding': query_embedding,
+        'search_results': search_results,
+        'history': session_context['history'],
+        'summary': session_context['summary'],
+        'timings': timings,
+    }
+
+
+def _answer_cache_key(query, context, image_base64):
+    """回答缓存的查找键；不适用回答缓存时返回 None
+
+    仅缓存无图片、无历史对话(会话第一问)、且检索到知识库内容的提问：
+    历史对话会改变回答，网络搜索结果随时间变化。
+
+    直接使用检索阶段的问题向量，不再单独向量化；只用了关键词结果（问题向量为 None）时
+    按规范化后的问题文本精确匹配（见 ai/answer_cache.py）。
+
+    Returns:
+        tuple 或 None: (问题向量或 None, 规范化问题文本, 检索结果指纹, 知识库索引版本号)
+    """
+    if get_answer_cache_settings()['size'] <= 0 or image_base64:
+        return None
+    if not context['knowledge_chunks'] or context['history'] or context['summary']:
+        return None
+    if context['timings']['history']['status'] not in ('ok', 'skipped'):
+        return None  # 历史对话读取超时/失败时无法确认是否为会话第一问
+    return (context['query_embedding'], normalize_query(query),
+            chunk_fingerprint(context['knowledge_chunks']), knowledge_index.generation)
+
+
+def _cache_streamed_answer(tokens, prepared):
+    """透传流式token，完整输出后把回答写入缓存（中途出错或调用方停止则不写入）"""
+    parts = []
+    for token in tokens:
+        parts.append(token)
+        yield token
+    remember_answer(prepared, ''.join(parts))
+
+
+def prepare_rag(query, user_id=None, session_id=None, enable_search=True, image_base64=None, image_mime_type="image/jpeg"):
+    """调用LLM之前的全部步骤：并发组装上下文 → 查回答缓存 → 组装Prompt
+
+    rag_query 与 ASGI 异步流式接口(asgi.py)共用；参数含义同 rag_query。
+
+    Returns:
+        dict:
+            - sources: 引用的知识库来源列表
+            - search_used: 是否使用了网络搜索
+            - timings: 上下文组装各阶段耗时（使用回答缓存时含 answer_cache: hit/miss）
+            - cache_key: 回答缓存键，None 表示本次提问不适用回答缓存
+            - cached: 命中的缓存回答(dict: answer/sources/similarity)，未命中为 None
+            - messages: 发给LLM的消息列表（命中缓存时为 None）
+    """
+    # ① 并发组装上下文（仅对文字部分做检索；有图片时不做网络搜索，图片本身已提供足够上下文）
+    context = assemble_context(query, user_id, session_id, enable_search, image_base64)
+    prepared = {
+        'sources': [chunk['source'] for chunk in context['knowledge_chunks']],
+        'search_used': bool(context['search_results']),
+        'timings': context['timings'],
+        'cache_key': None,
+        'cached': None,
+        'messages': None,
+    }
+
+    # ② 回答缓存：相近的常见问题且检索到的资料相同时，直接复用已生成的回答
+    cache_key = _answer_cache_key(query, context, image_base64)
+    if cache_key:
+        prepared['cache_key'] = cache_key
+        prepared['cached'] = answer_cache.get(*cache_key)
+        prepared['timings']['answer_cache'] = 'hit' if prepared['cached'] else 'miss'
+    if prepared['cached']:
+        prepared['sources'] = prepared['cached']['sources']
+        print(f"[INFO] 回答缓存命中(相似度 {prepared['cached']['similarity']})，跳过LLM生成")
+        return prepared
+
+    # ③ 按token预算选取参考资料与历史对话，组装消息（可能包含图片）
+    plan = plan_prompt(query, context['knowledge_chunks'], context['search_results'], context['history'],
+                       image_base64=image_base64, summary=context['summary'])
+    prepared['sources'] = [chunk['source'] for chunk in plan['knowledge_chunks']]
+    prepared['search_used'] = bool(plan['search_results'])
+    prepared['timings']['prompt'] = plan['report']
+    knowledge_context = format_knowledge_context(plan['knowledge_chunks'])
+    search_context = format_search_results(plan['search_results'])
+    prepared['messages'] = build_messages(query, knowledge_context, search_context, plan['history'],
+                                          image_base64=image_base64, image_mime_type=image_mime_type,
+                                          history_digest_text=plan['history_digest'])
+    return prepared
+
+
+def remember_answer(prepared, answer):
+    """把完整生成的回答写入回答缓存（prepare_rag 判定不适用时忽略）"""
+    if prepared['cache_key'] and answer:
+        answer_cache.put(*prepared['cache_key'], answer, prepared['sources'])
+
+
+def rag_query(query, user_id=None, session_id=None, enable_search=True, stream=False, image_base64=None, image_mime_type="image/jpeg", timings=None):
     """RAG 完整流程：检索 + 增强 + 生成
     
     Args:
@@ -217,68 +552,65 @@ def rag_query(query, user_id=None, session_id=None, enable_search=True, stream=F
         stream: 是否流式输出(bool)，默认False
         image_base64: 图片Base64编码(str)，不含data:前缀。None表示纯文本
         image_mime_type: 图片MIME类型(str)，默认image/jpeg
+        timings: 上下文组装各阶段耗时的输出(dict，可选)，流式模式下由调用方传入以获取耗时
     
     Returns:
         如果 stream=False: 返回 dict，包含:
             - answer: AI回答文本
             - sources: 引用的知识库来源列表
             - search_used: 是否使用了网络搜索
-        如果 stream=True: 返回生成器，逐token产出文本片段
+            - timings: 上下文组装各阶段耗时（使用回答缓存时含 answer_cache: hit/miss）
+            - cached: 是否直接使用了缓存的回答
+        如果 stream=True: 返回生成器，逐token产出文本片段（缓存命中时为回放的回答片段）
             （注意：流式模式下不保存对话记录，需在流结束后调用save_chat_message）
     
     完整流程:
-        1. 知识库向量检索 → 获取最相关的文本片段
-        2. (可选) 网络搜索 → 补充知识库未覆盖的信息
+        1. 并发组装上下文 → 知识库向量检索 / 历史对话 / (可选)网络搜索，各有截止时间
+        2. 回答缓存 → 相近问题且检索资料相同时直接复用回答（见 ai/answer_cache.py）
         3. 组装Prompt → 将检索结果和搜索结果拼入上下文（含图片则为多模态）
         4. 调用LLM → 生成回答
         5. 保存对话记录 → 存入数据库
     """
-    # ① 知识库检索（仅对文字部分做检索，不检索图片）
-    knowledge_chunks = retrieve_knowledge(query)
-    knowledge_context = format_knowledge_context(knowledge_chunks)
-
-    # ② 网络搜索（可选，仅当无图片且知识库无结果时）
-    search_context = ""
-    search_used = False
-    if enable_search and not knowledge_chunks and not image_base64:
-        # 有图片时不做网络搜索，图片本身已提供足够上下文
-        search_results = search_web(query)
-        search_context = format_search_results(search_results)
-        search_used = bool(search_results)
-
-    # ③ 获取历史对话
-    history = []
-    if user_id and session_id:
-        history = get_chat_history(user_id, session_id)
-
-    # ④ 组装消息（可能包含图片）
-    messages = build_messages(query, knowledge_context, search_context, history,
-                              image_base64=image_base64, image_mime_type=image_mime_type)
-
-    # ⑤ 调用LLM生成回答
-    if stream:
-        # 流式模式：返回生成器
-        return chat(messages, stream=True)
+    prepared = prepare_rag(query, user_id, session_id, enable_search, image_base64, image_mime_type)
+    if timings is not None:
+        timings.update(prepared['timings'])
+    cached = prepared['cached']
+
+    if cached:
+        if stream:
+            # 以流式片段回放缓存的回答
+            return replay_answer(cached['answer'])
+        answer = cached['answer']
     else:
+        # ④ 调用LLM生成回答
+        if stream:
+            # 流式模式：返回生成器（完整输出后写入回答缓存）
+            tokens = chat(prepared['messages'], stream=True)
+            return _cache_streamed_answer(tokens, prepared) if prepared['cache_key'] else tokens
         # 非流式模式：获取完整回答
-        answer = chat(messages, stream=False)
-
-        # ⑥ 保存对话记录
-        sources = [chunk['source'] for chunk in knowledge_chunks]
-        if user_id and session_id:
-            # 保存用户消息时标注是否有图片
-            user_content = query
-            if image_base64:
-                user_content = f"[图片问答] {query}"
-            save_chat_message(user_id, session_id, 'user', user_content)
-            save_chat_message(user_id, session_id, 'assistant', answer,
-                              sources=json.dumps(sources, ensure_ascii=False))
-
-        return {
-            'answer': answer,
-            'sources': sources,
-            'search_used': search_used
-        }
+        answer = chat(prepared['messages'], stream=False)
+        remember_answer(prepared, answer)
+
+    # ⑤ 保存对话记录
+    sources = prepared['sources']
+    if user_id and session_id:
+        # 保存用户消息时标注是否有图片
+        user_content = query
+        if image_base64:
+            user_content = f"[图片问答] {query}"
+        save_chat_message(user_id, session_id, 'user', user_content)
+        save_chat_message(user_id, session_id, 'assistant', answer,
+                          sources=json.dumps(sources, ensure_ascii=False))
+        # 会话较长时在后台把较早的对话并入摘要
+        schedule_summary(user_id, session_id)
+
+    return {
+        'answer': answer,
+        'sources': sources,
+        'search_used': prepared['search_used'],
+        'timings': prepared['timings'],
+        'cached': bool(cached)
+    }
 
 
 def get_chat_history(user_id, session_id, limit=20):
@@ -0,0 +1,170 @@
+"""
+检索结果重排序 - 不调用任何模型，只用索引中已有的向量和块序号
+
+retrieve_knowledge 原先直接取余弦相似度最高的 top_k 个文本块：同一文档中相邻的块
+(切分时有重叠)经常同时入选，内容大段重复；而相似度明显偏低的块也会凑数进入Prompt。
+
+现在先从索引多取 RERANK_CANDIDATES 个候选，再依次:
+    1. 自适应阈值: 丢弃比最高分低 RERANK_SCORE_GAP 以上的候选（仍不低于原相似度阈值）
+    2. 合并相邻块: 同一来源中块序号相邻的候选合并为一段(去掉切分重叠)，
+       最多 RERANK_MERGE_MAX 块一段，分数取其中最高者
+    3. MMR 多样性选择: 按 λ·相关度 − (1−λ)·与已选段落的最大相似度 依次选取 top_k 段，
+       与已选段落几乎相同(向量相似度 ≥ DUPLICATE_SIMILARITY)的段落直接跳过
+
+全部计算基于候选的归一化向量(几十个向量的点积)，耗时可忽略，不增加API调用。
+
+混合检索(ai/lexical_index.py)的候选带有融合分数 fused 时，合并与MMR以 fused 作为相关度；
+有关键词命中(lexical)的候选只需达到原相似度阈值，不受自适应阈值限制（法条编号等字面匹配的块向量相似度往往偏低）。
+只有关键词检索结果(见 ai.lexical_index.keyword_only_hits)时候选没有余弦相似度：
+以 keyword_score 作为相关度，不做阈值过滤，合并与MMR照常使用索引中的向量。
+
+配置(环境变量，见 config.py):
+    RERANK_ENABLED: 是否启用重排序
+    RERANK_CANDIDATES: 从索引取出的候选数
+    RERANK_SCORE_GAP: 与最高分的最大差距
+    RERANK_MMR_LAMBDA: MMR 中相关度的权重(1 表示只看相关度)
+    RERANK_MERGE_MAX: 每段最多合并的相邻块数
+"""
+import os
+
+import numpy as np
+
+# 查找相邻块重叠部分时比较的最大字符数（切分重叠默认50字，见 ai/chunker.py）
+MAX_OVERLAP_CHARS = 200
+
+# 与已选段落的向量相似度达到此值视为重复内容(如多个文件收录了同一段文字)，不再选取
+DUPLICATE_SIMILARITY = 0.98
+
+
+def get_rerank_settings():
+    """读取重排序配置
+
+    Returns:
+        dict: enabled / candidates / score_gap / mmr_lambda / merge_max
+    """
+    return {
+        'enabled': os.environ.get('RERANK_ENABLED', 'true').lower() == 'true',
+        'candidates': max(1, int(os.environ.get('RERANK_CANDIDATES', '20'))),
+        'score_gap': max(0.0, float(os.environ.get('RERANK_SCORE_GAP', '0.15'))),
+        'mmr_lambda': min(1.0, max(0.0, float(os.environ.get('RERANK_MMR_LAMBDA', '0.7')))),
+        'merge_max': max(1, int(os.environ.get('RERANK_MERGE_MAX', '3'))),
+    }
+
+
+def join_overlapping(first, second):
+    """拼接相邻两块文本，去掉 second 开头与 first 结尾重复的部分"""
+    limit = min(len(first), len(second), MAX_OVERLAP_CHARS)
+    for size in range(limit, 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + '\n' + second
+
+
+def _relevance(hit):
+    if 'fused' in hit:
+        return hit['fused']
+    if 'similarity' in hit:
+        return hit['similarity']
+    return hit['keyword_score']
+
+
+def merge_neighbors(hits, merge_max):
+    """把同一来源中块序号相邻的命中合并为一段
+
+    Args:
+        hits: KnowledgeIndex.search(with_vectors=True) 的结果(或融合后的候选)
+        merge_max: 每段最多合并的块数(int)
+
+    Returns:
+        list[dict]: 段落列表(按相关度降序)，字段同 hits；合并段的 content 为拼接后的文本，
+                    其余字段取段内相关度最高的块，merged 为合并的块数
+    """
+    groups = {}
+    for hit in hits:
+        groups.setdefault((hit['kind'], hit['owner_id']), []).append(hit)
+
+    passages = []
+    for group in groups.values():
+        # 块序号未知(-1)的命中不参与合并
+        run = []
+        for hit in sorted(group, key=lambda h: h['chunk_index']):
+            if (run and hit['chunk_index'] >= 0 and run[-1]['chunk_index'] >= 0 and len(run) < merge_max
+                    and hit['chunk_index'] - run[-1]['chunk_index'] == 1):
+                run.append(hit)
+                continue
+            if run:
+                passages.append(_merge_run(run))
+            run = [hit]
+        if run:
+            passages.append(_merge_run(run))
+    passages.sort(key=_relevance, reverse=True)
+    return passages
+
+
+def _merge_run(run):
+    best = max(run, key=_relevance)
+    if len(run) == 1:
+        return dict(best, merged=1)
+    content = run[0]['content']
+    for hit in run[1:]:
+        content = join_overlapping(content, hit['content'])
+    return dict(best, content=content, merged=len(run))
+
+
+def mmr_select(passages, top_k, mmr_lambda):
+    """最大边际相关(MMR)选择
+
+    Args:
+        passages: 段落列表(含 similarity、fused 或 keyword_score 与归一化 vector)，按相关度降序
+        top_k: 选取数量(int)
+        mmr_lambda: 相关度权重(float)
+
+    Returns:
+        list[dict]: 按选中顺序排列的段落（与已选段落重复的段落被跳过）
+    """
+    if len(passages) <= 1:
+        return passages[:top_k]
+    vectors = np.stack([p['vector'] for p in passages])
+    relevance = np.array([_relevance(p) for p in passages], dtype=np.float32)
+    pairwise = vectors @ vectors.T
+    selected = [0]
+    redundancy = pairwise[0].copy()
+    remaining = np.ones(len(passages), dtype=bool)
+    remaining[0] = False
+    while len(selected) < top_k:
+        remaining &= redundancy < DUPLICATE_SIMILARITY
+        if not remaining.any():
+            break
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[~remaining] = -np.inf
+        choice = int(np.argmax(scores))
+        selected.append(choice)
+        remaining[choice] = False
+        np.maximum(redundancy, pairwise[choice], out=redundancy)
+    return [passages[i] for i in selected]
+
+
+def rerank(hits, top_k, similarity_threshold, settings=None):
+    """对索引候选做自适应阈值过滤、相邻块合并和MMR选择
+
+    Args:
+        hits: KnowledgeIndex.search(with_vectors=True)、fuse_hits() 或 keyword_only_hits() 的结果
+        top_k: 最多返回的段落数(int)
+        similarity_threshold: 原相似度阈值(float)，自适应阈值不低于此值
+        settings: get_rerank_settings() 的结果(可选)
+
+    Returns:
+        list[dict]: 重排序后的段落，字段同 hits(另有 merged)
+    """
+    if not hits:
+        return []
+    settings = settings or get_rerank_settings()
+    # 没有余弦相似度的候选(仅关键词检索)不做阈值过滤
+    scored = [hit['similarity'] for hit in hits if 'similarity' in hit]
+    if scored:
+        floor = max(similarity_threshold, max(scored) - settings['score_gap'])
+        hits = [hit for hit in hits
+                if 'similarity' not in hit or hit['similarity'] >= floor
+                or (hit.get('lexical') and hit['similarity'] >= similarity_threshold)]
+    passages = merge_neighbors(hits, settings['merge_max'])
+    return mmr_select(passages, top_k, settings['mmr_lambda'])
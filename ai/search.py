@@ -3,7 +3,8 @@
 支持: Tavily API（有免费额度）/ 可选关闭
 """
 import os
-import requests
+
+from ai import http_client
 
 
 def search_web(query, max_results=3):
@@ -41,7 +42,7 @@ def search_web(query, max_results=3):
             "include_answer": False,
             "include_raw_content": False,
         }
-        resp = requests.post(url, json=data, timeout=15)
+        resp = http_client.post('tavily', url, json=data)
         resp.raise_for_status()
         result = resp.json()
 
@@ -0,0 +1,219 @@
+"""
+SSE 输出 - 流式回答的token合并写出与心跳
+
+chat_stream 原先每收到一个上游token就 json.dumps 一次、输出一帧 SSE，
+每帧都是 gunicorn/反向代理上的一次独立写入和刷新；完整回答还靠 full_answer += token 拼接。
+
+本模块的 SSEWriter:
+    - 合并token: 距上次写出满 SSE_FLUSH_MS 毫秒或累计满 SSE_FLUSH_CHARS 字符时才写出一帧，
+      第一个token立即写出（不影响首字显示）；上游停顿时已缓冲的token按时写出，不会等下一个token
+    - 收集完整回答(列表拼接)，见 SSEWriter.answer
+    - 上游长时间无输出时每 SSE_HEARTBEAT_SECONDS 秒写一行SSE注释(": ping")，避免代理/浏览器断开空闲连接
+
+帧格式不变(data: {"token": "..."})，前端按帧拼接，只是每帧可能包含多个token。
+Flask 版 chat_stream 用 iter_frames()，ASGI 版(asgi.py)用 aiter_frames()。
+
+配置(环境变量，见 config.py):
+    SSE_FLUSH_MS: 合并窗口(毫秒)，0 表示每个token立即写出
+    SSE_FLUSH_CHARS: 缓冲达到多少字符立即写出
+    SSE_HEARTBEAT_SECONDS: 无输出多久写一次心跳(秒)，0 表示不发心跳
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+
+# 流式响应头（禁止缓存，并关闭反向代理的缓冲）
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+# 心跳帧（SSE注释行，前端忽略）
+HEARTBEAT_FRAME = ': ping\n\n'
+
+# iter_frames 中转队列的消息类型
+_TOKEN, _END, _ERROR = 'token', 'end', 'error'
+
+
+def get_sse_settings():
+    """读取SSE输出配置
+
+    Returns:
+        dict: flush_seconds / flush_chars / heartbeat_seconds
+    """
+    return {
+        'flush_seconds': max(0.0, float(os.environ.get('SSE_FLUSH_MS', '30'))) / 1000,
+        'flush_chars': max(1, int(os.environ.get('SSE_FLUSH_CHARS', '64'))),
+        'heartbeat_seconds': max(0.0, float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))),
+    }
+
+
+def sse_event(payload):
+    """编码一条SSE事件"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class SSEWriter:
+    """把token合并为SSE帧，并收集完整回答（单个请求内使用，非线程安全）"""
+
+    def __init__(self):
+        settings = get_sse_settings()
+        self._flush_seconds = settings['flush_seconds']
+        self._flush_chars = settings['flush_chars']
+        self._heartbeat_seconds = settings['heartbeat_seconds']
+        self._parts = []            # 全部token
+        self._pending = []          # 尚未写出的token
+        self._pending_chars = 0
+        self._last_write = None     # 上次写出token帧的时刻，None 表示尚未写出token
+        self._last_output = time.monotonic()   # 上次写出任何内容(token帧/心跳)的时刻
+        self.frames = 0             # 已写出的token帧数
+
+    @property
+    def answer(self):
+        """目前为止的完整回答"""
+        return ''.join(self._parts)
+
+    def push(self, token):
+        """加入一个token
+
+        Returns:
+            str 或 None: 需要写出的SSE帧；仍在合并窗口内时返回 None
+        """
+        if not token:
+            return None
+        self._parts.append(token)
+        self._pending.append(token)
+        self._pending_chars += len(token)
+        if (self._last_write is None or self._pending_chars >= self._flush_chars
+                or time.monotonic() - self._last_write >= self._flush_seconds):
+            return self.flush()
+        return None
+
+    def flush(self):
+        """写出全部缓冲的token（无缓冲时返回 None）"""
+        if not self._pending:
+            return None
+        frame = sse_event({'token': ''.join(self._pending)})
+        self._pending = []
+        self._pending_chars = 0
+        self._last_write = self._last_output = time.monotonic()
+        self.frames += 1
+        return frame
+
+    def event(self, payload):
+        """先写出缓冲的token，再附加一条事件(done/error)"""
+        return (self.flush() or '') + sse_event(payload)
+
+    def _wait_seconds(self):
+        """等待下一个token的最长时间：有缓冲时到合并窗口结束，否则到下次心跳（None 表示一直等）"""
+        if self._pending:
+            return max(0.0, self._last_write + self._flush_seconds - time.monotonic())
+        if not self._heartbeat_seconds:
+            return None
+        return max(0.0, self._last_output + self._heartbeat_seconds - time.monotonic())
+
+    def _on_idle(self):
+        """等待超时：写出到期的缓冲，或发送心跳"""
+        if self._pending:
+            return self.flush()
+        self._last_output = time.monotonic()
+        return HEARTBEAT_FRAME
+
+    def iter_frames(self, tokens):
+        """把同步token迭代器转换为SSE帧（Flask 流式响应使用）
+
+        token在后台线程中读取，读取阻塞(上游停顿)期间照常按时写出缓冲和心跳。
+
+        Args:
+            tokens: token迭代器
+
+        Yields:
+            str: SSE帧
+
+        Raises:
+            Exception: token迭代器抛出的异常（已缓冲的token会先写出）
+        """
+        messages = queue.Queue()
+        stop = threading.Event()
+
+        def pump():
+            try:
+                for token in tokens:
+                    messages.put((_TOKEN, token))
+                    if stop.is_set():
+                        break
+                messages.put((_END, None))
+            except Exception as e:
+                messages.put((_ERROR, e))
+            finally:
+                close = getattr(tokens, 'close', None)
+                if close:
+                    close()
+
+        threading.Thread(target=pump, name='sse-pump', daemon=True).start()
+        try:
+            while True:
+                try:
+                    kind, value = messages.get(timeout=self._wait_seconds())
+                except queue.Empty:
+                    yield self._on_idle()
+                    continue
+                if kind == _END:
+                    break
+                if kind == _ERROR:
+                    frame = self.flush()
+                    if frame:
+                        yield frame
+                    raise value
+                frame = self.push(value)
+                if frame:
+                    yield frame
+            frame = self.flush()
+            if frame:
+                yield frame
+        finally:
+            # 客户端断开(生成器被关闭)时让后台线程在下一个token后停止读取
+            stop.set()
+
+    async def aiter_frames(self, tokens):
+        """把异步token迭代器转换为SSE帧（ASGI 流式接口使用），行为同 iter_frames
+
+        Args:
+            tokens: 异步token迭代器
+
+        Yields:
+            str: SSE帧
+        """
+        iterator = tokens.__aiter__()
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=self._wait_seconds())
+                if not done:
+                    yield self._on_idle()
+                    continue
+                task, pending = pending, None
+                try:
+                    token = task.result()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    frame = self.flush()
+                    if frame:
+                        yield frame
+                    raise
+                frame = self.push(token)
+                if frame:
+                    yield frame
+            frame = self.flush()
+            if frame:
+                yield frame
+        finally:
+            if pending is not None:
+                pending.cancel()
@@ -0,0 +1,186 @@
+"""
+会话摘要 - 长会话只发送"摘要 + 最近几轮"，每轮的Prompt大小不再随会话长度增长
+
+原先每轮都读取最近 20 条消息原文发给LLM，会话越长每轮越慢、越贵。
+
+规则:
+    - 会话中尚未并入摘要的对话超过 CHAT_SUMMARY_AFTER_TURNS 轮时，回答完成后在后台
+      把较早的部分(只保留最近 CHAT_SUMMARY_KEEP_TURNS 轮原文)连同已有摘要交给LLM压缩成新摘要，
+      存入 chat_summaries 表(covered_message_id 记录已并入摘要的最后一条消息)
+    - 组装上下文时读取摘要 + covered_message_id 之后的消息原文(见 load_session_context)
+    - 摘要生成失败不影响对话，下一轮回答后重试
+
+配置(环境变量，见 config.py):
+    CHAT_SUMMARY_AFTER_TURNS: 未摘要的对话超过多少轮时生成摘要，0 表示禁用
+    CHAT_SUMMARY_KEEP_TURNS: 生成摘要后保留原文的最近轮数
+    CHAT_SUMMARY_MAX_CHARS: 摘要的最大字数
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+# 交给LLM压缩时，每条消息截取的最大字数（控制摘要请求本身的成本）
+SUMMARY_MESSAGE_CHARS = 800
+
+# 读取历史原文的最大条数（与原先 get_chat_history 的默认值一致，摘要落后时兜底）
+HISTORY_LIMIT = 20
+
+SUMMARY_PROMPT = """你是对话摘要助手。请把"已有摘要"和"新增对话"合并为一份更新后的摘要，供AI助手在后续对话中参考。
+要求:
+1. 保留用户的身份与处境、涉及的平台/账号/财产、已给出的关键结论和办理步骤、用户尚未解决的问题
+2. 省略寒暄和重复内容，不要编造对话中没有的信息
+3. 使用第三人称("用户..."、"助手...")，不超过{max_chars}字，直接输出摘要正文"""
+
+# 后台摘要线程池（单线程，摘要请求不与对话争抢LLM并发）
+_summary_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-summary')
+_pending = set()
+_pending_lock = threading.Lock()
+_stats = {'scheduled': 0, 'summarized': 0, 'failed': 0}
+
+
+def get_summary_settings():
+    """读取会话摘要配置
+
+    Returns:
+        dict: after_turns / keep_turns / max_chars
+    """
+    return {
+        'after_turns': max(0, int(os.environ.get('CHAT_SUMMARY_AFTER_TURNS', '6'))),
+        'keep_turns': max(1, int(os.environ.get('CHAT_SUMMARY_KEEP_TURNS', '3'))),
+        'max_chars': max(100, int(os.environ.get('CHAT_SUMMARY_MAX_CHARS', '500'))),
+    }
+
+
+def load_session_context(user_id, session_id):
+    """读取会话摘要与尚未并入摘要的历史消息
+
+    Args:
+        user_id: 用户ID(int)
+        session_id: 会话ID(str)
+
+    Returns:
+        dict:
+            - summary: 较早对话的摘要(str)，没有时为空字符串
+            - history: 摘要之后的消息列表(最多 HISTORY_LIMIT 条)，格式同 get_chat_history
+    """
+    from models import ChatMessage, ChatSummary
+
+    row = ChatSummary.query.filter_by(user_id=user_id, session_id=session_id).first()
+    query = ChatMessage.query.filter_by(user_id=user_id, session_id=session_id)
+    if row:
+        query = query.filter(ChatMessage.id > row.covered_message_id)
+    messages = query.order_by(ChatMessage.id.desc()).limit(HISTORY_LIMIT).all()
+    messages.reverse()
+    return {
+        'summary': row.summary if row else '',
+        'history': [{'role': msg.role, 'content': msg.content} for msg in messages],
+    }
+
+
+def schedule_summary(user_id, session_id):
+    """回答保存后调用：需要时在后台更新会话摘要（需在应用上下文中调用）"""
+    if not user_id or not session_id or get_summary_settings()['after_turns'] <= 0:
+        return
+    key = (user_id, session_id)
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+        _stats['scheduled'] += 1
+    _summary_pool.submit(_run_summary, current_app._get_current_object(), user_id, session_id)
+
+
+def _run_summary(app, user_id, session_id):
+    from models import db
+    outcome = None
+    try:
+        with app.app_context():
+            try:
+                outcome = 'summarized' if summarize_session(user_id, session_id) else None
+            except Exception as e:
+                db.session.rollback()
+                outcome = 'failed'
+                print(f"[WARN] 会话摘要生成失败(session={session_id}): {e}")
+            finally:
+                db.session.remove()
+    finally:
+        with _pending_lock:
+            _pending.discard((user_id, session_id))
+            if outcome:
+                _stats[outcome] += 1
+
+
+def _format_dialogue(messages):
+    lines = []
+    for msg in messages:
+        content = msg.content
+        if len(content) > SUMMARY_MESSAGE_CHARS:
+            content = content[:SUMMARY_MESSAGE_CHARS] + '…'
+        lines.append(f"{'用户' if msg.role == 'user' else '助手'}: {content}")
+    return '\n'.join(lines)
+
+
+def summarize_session(user_id, session_id):
+    """未摘要的对话超过阈值时，把较早的部分并入摘要
+
+    Returns:
+        bool: 是否更新了摘要
+    """
+    from ai.llm import chat
+    from models import db, ChatMessage, ChatSummary
+
+    settings = get_summary_settings()
+    row = ChatSummary.query.filter_by(user_id=user_id, session_id=session_id).first()
+    covered = row.covered_message_id if row else 0
+    messages = ChatMessage.query.filter(
+        ChatMessage.user_id == user_id, ChatMessage.session_id == session_id, ChatMessage.id > covered
+    ).order_by(ChatMessage.id).all()
+    if len(messages) <= settings['after_turns'] * 2:
+        return False
+
+    # 并入摘要的部分以助手回答结尾，保留的最近几轮以用户提问开头
+    fold = messages[:len(messages) - settings['keep_turns'] * 2]
+    while fold and fold[-1].role != 'assistant':
+        fold.pop()
+    if not fold:
+        return False
+    covered_id = fold[-1].id
+
+    previous = row.summary if row else '（无）'
+    summary = chat([
+        {'role': 'system', 'content': SUMMARY_PROMPT.format(max_chars=settings['max_chars'])},
+        {'role': 'user', 'content': f"【已有摘要】\n{previous}\n\n【新增对话】\n{_format_dialogue(fold)}"},
+    ], stream=False).strip()
+    if not summary:
+        return False
+    summary = summary[:settings['max_chars']]
+
+    # 重新读取：其他worker可能已经更新过摘要
+    db.session.rollback()
+    row = ChatSummary.query.filter_by(user_id=user_id, session_id=session_id).first()
+    if row and row.covered_message_id >= covered_id:
+        return False
+    if row is None:
+        row = ChatSummary(user_id=user_id, session_id=session_id)
+        db.session.add(row)
+    row.summary = summary
+    row.covered_message_id = covered_id
+    db.session.commit()
+    print(f"[INFO] 会话摘要已更新(session={session_id}): 并入 {len(fold)} 条消息，摘要 {len(summary)} 字")
+    return True
+
+
+def delete_session_summary(user_id, session_id):
+    """删除会话时一并删除摘要（由调用方提交事务）"""
+    from models import ChatSummary
+    ChatSummary.query.filter_by(user_id=user_id, session_id=session_id).delete()
+
+
+def get_summary_stats():
+    """本进程会话摘要的生成次数（用于健康检查接口）"""
+    with _pending_lock:
+        result = dict(_stats)
+        result['pending'] = len(_pending)
+    return result
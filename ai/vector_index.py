@@ -0,0 +1,530 @@
+"""
+向量索引 - 进程内知识库向量检索
+
+将本地知识库(KnowledgeChunk)与外部知识库(ExternalKnowledgeChunk)的全部向量
+预先归一化后放入同一个 float32 矩阵，旁边并列保存块ID、来源类型、来源ID和原文，
+另有 (来源类型, 来源ID) -> 来源名称 的缓存映射。
+检索时只需一次矩阵-向量乘法 + argpartition 取 top-k，结果直接由索引给出原文和来源，
+无论命中多少块都不再逐块查询数据库。
+
+索引维护:
+  - 首次检索时从数据库全量加载（每个来源表一次联表投影查询）
+  - upload_knowledge / delete_knowledge / 外部知识库同步 时增量更新(add/remove)，
+    来源名称映射随之更新/失效
+  - 多 worker 部署时，其他进程的修改通过"指纹"(各来源的向量块数量+最大ID)发现：
+    每隔 KNOWLEDGE_INDEX_REFRESH_SECONDS 秒与数据库比对一次，不一致则全量重建
+
+同一索引还持有全部文本块的 BM25 关键词倒排索引(ai/lexical_index.py)，随上述加载/增量更新一起维护，
+由 lexical_search 检索。
+
+检索引擎(RAG_INDEX_ENGINE):
+  - exact(默认): 对全部向量精确打分
+  - ivf: 大知识库使用 IVF 近似检索，只对最接近的若干簇打分，见 ai/ann.py
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from ai import ann
+from ai.embedding import decode_embedding
+from ai.lexical_index import LexicalIndex
+
+
+# 来源类型
+SOURCE_LOCAL = 0      # 本地知识库 KnowledgeChunk，owner_id 为 file_id
+SOURCE_EXTERNAL = 1   # 外部知识库 ExternalKnowledgeChunk，owner_id 为 external_id
+
+# 来源名称缺失时的显示名
+DEFAULT_SOURCE_NAMES = {
+    SOURCE_LOCAL: "未知来源",
+    SOURCE_EXTERNAL: "外部知识库",
+}
+
+
+def _to_vector(embedding):
+    """将向量(浮点列表/numpy数组/旧版JSON文本)转为 float32 数组，无法解析时返回None"""
+    if embedding is None:
+        return None
+    try:
+        if isinstance(embedding, str):
+            embedding = json.loads(embedding)
+        vec = np.asarray(embedding, dtype=np.float32)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return None
+    if vec.ndim != 1 or vec.size == 0:
+        return None
+    return vec
+
+
+def _row_vector(blob, dim, dtype, embedding_json):
+    """从数据库行解析向量：优先二进制列，缺失时回退旧版JSON列"""
+    if blob is not None:
+        try:
+            return _to_vector(decode_embedding(blob, dim, dtype))
+        except (ValueError, TypeError):
+            return None
+    return _to_vector(embedding_json)
+
+
+class KnowledgeIndex:
+    """进程内向量索引（线程安全）
+
+    写操作(add/remove/rebuild)在锁内构造新数组后整体替换，
+    检索只读取当时的数组快照，因此检索过程不需要持锁。
+    """
+
+    def __init__(self, refresh_interval=None):
+        if refresh_interval is None:
+            refresh_interval = float(os.environ.get('KNOWLEDGE_INDEX_REFRESH_SECONDS', '30'))
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._last_check = 0.0
+        self._generation = 0
+        self._reset(None)
+
+    def _reset(self, dim):
+        self._dim = dim
+        self._matrix = np.zeros((0, dim or 0), dtype=np.float32)
+        self._valid = np.zeros(0, dtype=bool)
+        self._kinds = np.zeros(0, dtype=np.int8)
+        self._chunk_ids = np.zeros(0, dtype=np.int64)
+        self._owner_ids = np.zeros(0, dtype=np.int64)
+        self._contents = np.zeros(0, dtype=object)
+        self._positions = np.zeros(0, dtype=np.int32)
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._source_names = {}
+        self._centroids = None
+        self._lexical = LexicalIndex()
+        self._row_of = None   # (kind, chunk_id) -> 行号，关键词检索时按需建立
+
+    def __len__(self):
+        return int(self._valid.sum())
+
+    @property
+    def dim(self):
+        return self._dim
+
+    @property
+    def generation(self):
+        """索引内容版本号：每次重建/增删来源后递增（回答缓存据此判断知识库是否变化）"""
+        return self._generation
+
+    # ------------------------------------------------------------------
+    # 构建
+    # ------------------------------------------------------------------
+    def _build_arrays(self, kind, rows, dim):
+        """将 (chunk_id, owner_id, content, vector, chunk_index) 行转为索引数组
+
+        维度与索引不一致或无法解析的向量仍占一行(零向量, valid=False)，
+        使内存指纹与数据库保持一致，避免反复触发重建。
+        """
+        n = len(rows)
+        matrix = np.zeros((n, dim), dtype=np.float32)
+        valid = np.zeros(n, dtype=bool)
+        chunk_ids = np.empty(n, dtype=np.int64)
+        owner_ids = np.empty(n, dtype=np.int64)
+        contents = np.empty(n, dtype=object)
+        positions = np.empty(n, dtype=np.int32)
+        for i, (chunk_id, owner_id, content, vec, position) in enumerate(rows):
+            chunk_ids[i] = chunk_id
+            owner_ids[i] = owner_id
+            contents[i] = content
+            positions[i] = -1 if position is None else position
+            if vec is None or vec.shape[0] != dim:
+                continue
+            norm = float(np.linalg.norm(vec))
+            if norm == 0.0:
+                continue
+            matrix[i] = vec / norm
+            valid[i] = True
+        kinds = np.full(n, kind, dtype=np.int8)
+        lists = np.full(n, -1, dtype=np.int32)
+        if self._centroids is not None and valid.any():
+            lists[valid] = ann.assign_lists(matrix[valid], self._centroids)
+        return matrix, valid, kinds, chunk_ids, owner_ids, contents, lists, positions
+
+    def _append(self, parts):
+        """追加若干组数组（调用方持锁）"""
+        self._matrix = np.concatenate([self._matrix] + [p[0] for p in parts])
+        self._valid = np.concatenate([self._valid] + [p[1] for p in parts])
+        self._kinds = np.concatenate([self._kinds] + [p[2] for p in parts])
+        self._chunk_ids = np.concatenate([self._chunk_ids] + [p[3] for p in parts])
+        self._owner_ids = np.concatenate([self._owner_ids] + [p[4] for p in parts])
+        self._contents = np.concatenate([self._contents] + [p[5] for p in parts])
+        self._lists = np.concatenate([self._lists] + [p[6] for p in parts])
+        self._positions = np.concatenate([self._positions] + [p[7] for p in parts])
+        for part in parts:
+            valid, kinds, chunk_ids, owner_ids, contents = part[1:6]
+            for i in np.flatnonzero(valid):
+                self._lexical.add(int(kinds[i]), int(owner_ids[i]), int(chunk_ids[i]), contents[i])
+        self._row_of = None
+
+    def _keep(self, mask):
+        """仅保留 mask 为 True 的行（调用方持锁）"""
+        self._matrix = self._matrix[mask]
+        self._valid = self._valid[mask]
+        self._kinds = self._kinds[mask]
+        self._chunk_ids = self._chunk_ids[mask]
+        self._owner_ids = self._owner_ids[mask]
+        self._contents = self._contents[mask]
+        self._lists = self._lists[mask]
+        self._positions = self._positions[mask]
+        self._row_of = None
+
+    def rebuild(self):
+        """从数据库全量加载所有向量块（仅启用的外部知识库）"""
+        local_rows, external_rows, source_names = _load_rows_from_db()
+        dims = Counter(row[3].shape[0] for row in local_rows + external_rows if row[3] is not None)
+        # 切换过Embedding提供者时可能混有不同维度，以多数为准
+        dim = dims.most_common(1)[0][0] if dims else None
+        with self._lock:
+            self._reset(dim)
+            if dim:
+                self._append([
+                    self._build_arrays(SOURCE_LOCAL, local_rows, dim),
+                    self._build_arrays(SOURCE_EXTERNAL, external_rows, dim),
+                ])
+            self._source_names = source_names
+            skipped = len(self._valid) - len(self)
+            if skipped:
+                print(f"[WARN] 知识库索引: {skipped} 个向量块维度不一致或无法解析，已跳过")
+            self._setup_ann()
+            self._loaded = True
+            self._last_check = time.monotonic()
+            self._generation += 1
+
+    def ensure_fresh(self):
+        """确保索引已加载且与数据库一致（按 refresh_interval 节流比对指纹）"""
+        if self._loaded and time.monotonic() - self._last_check < self.refresh_interval:
+            return
+        with self._lock:
+            if self._loaded and time.monotonic() - self._last_check < self.refresh_interval:
+                return
+            if not self._loaded or _fingerprint_from_db() != self._fingerprint():
+                self.rebuild()
+            self._last_check = time.monotonic()
+
+    def _setup_ann(self):
+        """按配置为当前向量建立IVF簇（调用方持锁）
+
+        优先从索引文件恢复簇中心与簇归属（其他 worker 或上次启动已训练），
+        仅对文件中没有的新向量做簇分配；没有可用文件或语料规模变化超过2倍时重新训练。
+        """
+        settings = ann.get_ann_settings()
+        n = len(self)
+        if settings['engine'] != 'ivf' or n < settings['min_chunks']:
+            self._centroids = None
+            return
+
+        path = ann.get_ivf_index_path()
+        keys = self._keys()
+        saved = ann.load_ivf(path)
+        if (saved is not None and saved['centroids'].shape[1] == self._dim
+                and 0.5 <= n / max(saved['trained_rows'], 1) <= 2):
+            centroids = saved['centroids']
+            lists = ann.lookup_lists(saved['keys'], saved['lists'], keys)
+            lists[~self._valid] = -1
+            missing = self._valid & (lists < 0)
+            if missing.any():
+                lists[missing] = ann.assign_lists(self._matrix[missing], centroids)
+            trained_rows = saved['trained_rows']
+            changed = bool(missing.any())
+        else:
+            started = time.monotonic()
+            n_list = settings['n_list'] or ann.auto_n_list(n)
+            centroids = ann.train_centroids(self._matrix[self._valid], n_list)
+            lists = np.full(len(self._valid), -1, dtype=np.int32)
+            lists[self._valid] = ann.assign_lists(self._matrix[self._valid], centroids)
+            trained_rows = n
+            changed = True
+            print(f"[INFO] 知识库IVF索引训练完成: {n} 个向量, {centroids.shape[0]} 个簇, "
+                  f"耗时 {time.monotonic() - started:.1f}s")
+
+        self._centroids = centroids
+        self._lists = lists
+        if changed:
+            try:
+                ann.save_ivf(path, centroids, keys, lists, trained_rows)
+            except OSError as e:
+                print(f"[WARN] 保存IVF索引文件失败: {e}")
+
+    def _keys(self):
+        """每个向量的唯一键: 来源类型占高位，块ID占低40位"""
+        return (self._kinds.astype(np.int64) << 40) | self._chunk_ids
+
+    def invalidate(self):
+        """标记索引失效，下次检索时全量重建"""
+        with self._lock:
+            self._loaded = False
+            self._generation += 1
+
+    def _fingerprint(self):
+        """内存指纹: 每个来源的 (块数量, 最大块ID)"""
+        result = []
+        for kind in (SOURCE_LOCAL, SOURCE_EXTERNAL):
+            ids = self._chunk_ids[self._kinds == kind]
+            result.append((int(ids.size), int(ids.max()) if ids.size else 0))
+        return tuple(result)
+
+    # ------------------------------------------------------------------
+    # 增量更新
+    # ------------------------------------------------------------------
+    def add(self, kind, owner_id, rows, source_name=None):
+        """增量加入某个来源的向量块
+
+        Args:
+            kind: 来源类型(SOURCE_LOCAL / SOURCE_EXTERNAL)
+            owner_id: 来源ID(int)，本地为 file_id，外部为 external_id
+            rows: [(chunk_id, content, embedding, chunk_index), ...]，embedding 为浮点列表或numpy数组，
+                  chunk_index 为块在来源中的序号(检索结果合并相邻块时使用，未知时可省略)
+            source_name: 来源名称(str)，本地为文件名，外部为链接名称
+        """
+        if not self._loaded:
+            # 尚未加载时无需增量维护，首次检索会全量加载
+            return
+        rows = [(row[0], owner_id, row[1], _to_vector(row[2]), row[3] if len(row) > 3 else None) for row in rows]
+        with self._lock:
+            if self._dim is None:
+                dims = Counter(row[3].shape[0] for row in rows if row[3] is not None)
+                if not dims:
+                    return
+                self._reset(dims.most_common(1)[0][0])
+            self._append([self._build_arrays(kind, rows, self._dim)])
+            if source_name is not None:
+                self._source_names[(kind, owner_id)] = source_name
+            self._generation += 1
+
+    def reload(self, kind, owner_id):
+        """从数据库重新读取某个来源的向量块并替换（外部知识库重新启用、知识库文件流式入库后使用）"""
+        if not self._loaded:
+            return
+        rows, source_name = _load_owner_rows_from_db(kind, owner_id)
+        self.replace(kind, owner_id, rows, source_name)
+
+    def remove(self, kind, owner_id):
+        """移除某个来源的全部向量块及其来源名称"""
+        with self._lock:
+            self._keep(~((self._kinds == kind) & (self._owner_ids == owner_id)))
+            self._lexical.remove_owner(kind, owner_id)
+            self._source_names.pop((kind, owner_id), None)
+            self._generation += 1
+
+    def replace(self, kind, owner_id, rows, source_name=None):
+        """替换某个来源的全部向量块（外部知识库重新同步时使用）"""
+        with self._lock:
+            self.remove(kind, owner_id)
+            self.add(kind, owner_id, rows, source_name)
+
+    # ------------------------------------------------------------------
+    # 检索
+    # ------------------------------------------------------------------
+    def search(self, query_embedding, top_k=5, similarity_threshold=0.3, with_vectors=False):
+        """检索与查询向量最相似的向量块
+
+        Args:
+            query_embedding: 查询向量(list[float])
+            top_k: 返回最相关的K个结果(int)
+            similarity_threshold: 相似度阈值(float)
+            with_vectors: 是否在结果中附带归一化后的向量(bool)，重排序(ai/rerank.py)使用
+
+        Returns:
+            list[dict]: 按相似度降序排列，每项包含:
+                - kind / chunk_id / owner_id: 来源类型、块ID、来源ID
+                - chunk_index: 块在来源中的序号(未知时为-1)
+                - content: 文本内容
+                - source: 来源名称
+                - similarity: 余弦相似度
+                - vector: 归一化向量(np.ndarray，仅 with_vectors=True 时)
+        """
+        # 取快照，之后的计算不受并发写入影响
+        with self._lock:
+            matrix, valid = self._matrix, self._valid
+            kinds, chunk_ids, owner_ids = self._kinds, self._chunk_ids, self._owner_ids
+            contents, positions_in_source, source_names = self._contents, self._positions, self._source_names
+            centroids, lists = self._centroids, self._lists
+            dim = self._dim
+
+        n = matrix.shape[0]
+        if n == 0 or top_k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape != (dim,):
+            print(f"[WARN] 查询向量维度({query.shape[-1]})与知识库索引({dim})不一致，"
+                  f"请确认EMBEDDING_PROVIDER未变更或重新向量化")
+            return []
+        norm = float(np.linalg.norm(query))
+        if norm == 0.0:
+            return []
+
+        query = query / norm
+
+        if centroids is not None:
+            # IVF: 只对最接近的 n_probe 个簇内的向量打分
+            positions = ann.probe_candidates(query, centroids, lists, ann.get_ann_settings()['n_probe'])
+            if positions.size == 0:
+                return []
+            scores = matrix[positions] @ query
+        else:
+            positions = None
+            scores = matrix @ query
+            scores[~valid] = -np.inf
+
+        k = min(top_k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for j in top:
+            score = float(scores[j])
+            i = positions[j] if positions is not None else j
+            if score < similarity_threshold:
+                break
+            kind, owner_id = int(kinds[i]), int(owner_ids[i])
+            hit = {
+                'kind': kind,
+                'chunk_id': int(chunk_ids[i]),
+                'owner_id': owner_id,
+                'chunk_index': int(positions_in_source[i]),
+                'content': contents[i],
+                'source': source_names.get((kind, owner_id), DEFAULT_SOURCE_NAMES[kind]),
+                'similarity': score,
+            }
+            if with_vectors:
+                hit['vector'] = matrix[i]
+            results.append(hit)
+        return results
+
+
+    def lexical_search(self, query, top_k=20):
+        """BM25 关键词检索（见 ai/lexical_index.py）
+
+        倒排表在写操作时原地更新，因此打分在锁内进行（只遍历问题中的词的倒排列表，通常不到几毫秒）。
+
+        Args:
+            query: 问题文本(str)
+            top_k: 返回数量(int)
+
+        Returns:
+            tuple: (命中列表, 问题的检索词数)；命中按 BM25 分数降序，字段同 search(with_vectors=True)
+                   但没有 similarity，另有 bm25(分数) 与 coverage(问题词权重的覆盖率)
+        """
+        with self._lock:
+            scored, term_count = self._lexical.search(query, top_k)
+            if not scored:
+                return [], term_count
+            if self._row_of is None:
+                self._row_of = {key: i for i, key in enumerate(zip(self._kinds.tolist(), self._chunk_ids.tolist()))}
+            hits = []
+            for doc, score, coverage in scored:
+                i = self._row_of[doc]
+                kind, owner_id = int(self._kinds[i]), int(self._owner_ids[i])
+                hits.append({
+                    'kind': kind,
+                    'chunk_id': int(self._chunk_ids[i]),
+                    'owner_id': owner_id,
+                    'chunk_index': int(self._positions[i]),
+                    'content': self._contents[i],
+                    'source': self._source_names.get((kind, owner_id), DEFAULT_SOURCE_NAMES[kind]),
+                    'bm25': score,
+                    'coverage': coverage,
+                    'vector': self._matrix[i],
+                })
+        return hits, term_count
+
+
+# ==============================================================================
+# 数据库访问
+# ==============================================================================
+def _vector_columns(model):
+    return (model.embedding_blob, model.embedding_dim, model.embedding_dtype, model.embedding)
+
+
+def _load_rows_from_db():
+    """每个来源表一次联表投影，读取全部向量块
+
+    Returns:
+        tuple: (本地行, 外部行, 来源名称映射)
+            行格式为 (chunk_id, owner_id, content, vector, chunk_index)，
+            来源名称映射为 {(来源类型, 来源ID): 名称}
+    """
+    from models import db, KnowledgeFile, KnowledgeChunk, ExternalKnowledge, ExternalKnowledgeChunk
+
+    local = db.session.query(
+        KnowledgeChunk.id, KnowledgeChunk.file_id, KnowledgeChunk.content,
+        KnowledgeFile.filename, KnowledgeChunk.chunk_index, *_vector_columns(KnowledgeChunk)
+    ).join(KnowledgeFile, KnowledgeChunk.file_id == KnowledgeFile.id).filter(
+        KnowledgeChunk.has_embedding(),
+        KnowledgeFile.is_ready == True
+    ).all()
+
+    external = db.session.query(
+        ExternalKnowledgeChunk.id, ExternalKnowledgeChunk.external_id, ExternalKnowledgeChunk.content,
+        ExternalKnowledge.name, ExternalKnowledgeChunk.chunk_index, *_vector_columns(ExternalKnowledgeChunk)
+    ).join(ExternalKnowledge, ExternalKnowledgeChunk.external_id == ExternalKnowledge.id).filter(
+        ExternalKnowledgeChunk.has_embedding(),
+        ExternalKnowledge.is_active == True
+    ).all()
+
+    source_names = {}
+    for kind, rows in ((SOURCE_LOCAL, local), (SOURCE_EXTERNAL, external)):
+        for row in rows:
+            source_names[(kind, row[1])] = row[3]
+
+    return (
+        [(row[0], row[1], row[2], _row_vector(*row[5:]), row[4]) for row in local],
+        [(row[0], row[1], row[2], _row_vector(*row[5:]), row[4]) for row in external],
+        source_names,
+    )
+
+
+def _load_owner_rows_from_db(kind, owner_id):
+    """读取单个来源的向量块
+
+    Returns:
+        tuple: ([(chunk_id, content, vector, chunk_index), ...], 来源名称)
+    """
+    from models import db, KnowledgeFile, KnowledgeChunk, ExternalKnowledge, ExternalKnowledgeChunk
+
+    if kind == SOURCE_LOCAL:
+        model, owner_col, source = KnowledgeChunk, KnowledgeChunk.file_id, db.session.get(KnowledgeFile, owner_id)
+        source_name = source.filename if source else None
+        if source is None or not source.is_ready:
+            return [], source_name
+    else:
+        model, owner_col, source = ExternalKnowledgeChunk, ExternalKnowledgeChunk.external_id, db.session.get(ExternalKnowledge, owner_id)
+        source_name = source.name if source else None
+    rows = db.session.query(model.id, model.content, model.chunk_index, *_vector_columns(model)).filter(
+        owner_col == owner_id, model.has_embedding()
+    ).all()
+    return [(row[0], row[1], _row_vector(*row[3:]), row[2]) for row in rows], source_name
+
+
+def _fingerprint_from_db():
+    """数据库指纹: 每个来源的 (块数量, 最大块ID)，与 KnowledgeIndex._fingerprint 对应"""
+    from models import db, KnowledgeFile, KnowledgeChunk, ExternalKnowledge, ExternalKnowledgeChunk
+
+    local = db.session.query(
+        db.func.count(KnowledgeChunk.id), db.func.max(KnowledgeChunk.id)
+    ).join(KnowledgeFile, KnowledgeChunk.file_id == KnowledgeFile.id).filter(
+        KnowledgeChunk.has_embedding(),
+        KnowledgeFile.is_ready == True
+    ).one()
+
+    external = db.session.query(
+        db.func.count(ExternalKnowledgeChunk.id), db.func.max(ExternalKnowledgeChunk.id)
+    ).join(ExternalKnowledge, ExternalKnowledgeChunk.external_id == ExternalKnowledge.id).filter(
+        ExternalKnowledgeChunk.has_embedding(),
+        ExternalKnowledge.is_active == True
+    ).one()
+
+    return ((int(local[0] or 0), int(local[1] or 0)),
+            (int(external[0] or 0), int(external[1] or 0)))
+
+
+# 进程级单例：所有请求共享
+knowledge_index = KnowledgeIndex()
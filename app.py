@@ -31,9 +31,11 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, timezone
 import os
 import requests
-from models import db, User, DigitalAsset, DigitalWill, PlatformPolicy, Story, FAQ, KnowledgeFile, KnowledgeChunk, ChatMessage, ChatUsage
+from models import (db, User, DigitalAsset, DigitalWill, PlatformPolicy, Story, FAQ, KnowledgeFile, KnowledgeChunk,
+                    ExternalKnowledge, ChatMessage, ChatUsage)
 from utils.encryption import encrypt_data, decrypt_data
-from utils.pdf_generator import generate_will_pdf
+from utils.encryption_migration import start_rewrap_migration
+from utils.pdf_generator import generate_will_pdf, discard_will_pdf, remove_legacy_output_files
 from config import config
 
 # 注册后台管理蓝图
@@ -131,7 +133,8 @@ app.register_blueprint(admin_bp)
 # 创建必要的目录
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs('static/uploads', exist_ok=True)
-os.makedirs('temp_pdfs', exist_ok=True)
+# 声明书PDF/资产清单改为在内存中生成，清理旧版本遗留在 DATA_DIR/temp_pdfs 的文件
+remove_legacy_output_files(app.config['DATA_DIR'])
 
 # 自动初始化数据库（部署时自动执行）
 def init_database_on_startup():
@@ -377,6 +380,103 @@ _db_initialized = False
 _db_init_lock = False
 
 
+# 二进制向量列定义 (列名, SQLite类型)；PostgreSQL 中 BLOB 对应 BYTEA
+_EMBEDDING_BLOB_COLUMNS = (
+    ('embedding_blob', 'BLOB'),
+    ('embedding_dim', 'INTEGER'),
+    ('embedding_dtype', 'VARCHAR(10)'),
+)
+
+
+def _backfill_embedding_blobs(table, batch_size=500):
+    """将旧版JSON文本向量回填到 embedding_blob 列
+
+    按ID分批读取尚未回填的行，避免一次性把全部JSON载入内存；
+    无法解析的JSON跳过（保留原值，检索时视为无效向量）。
+    原 embedding 列保留不删，便于回滚到旧版本。
+
+    Args:
+        table: 表名(str)，knowledge_chunks 或 external_knowledge_chunks
+        batch_size: 每批处理行数(int)
+    """
+    from ai.embedding import encode_embedding
+    last_id = 0
+    total = 0
+    with db.engine.connect() as conn:
+        while True:
+            rows = conn.execute(db.text(
+                f"SELECT id, embedding FROM {table} "
+                "WHERE embedding IS NOT NULL AND embedding_blob IS NULL AND id > :last_id "
+                "ORDER BY id LIMIT :limit"
+            ), {'last_id': last_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for row_id, embedding_json in rows:
+                try:
+                    blob, dim, dtype = encode_embedding(json.loads(embedding_json))
+                except (ValueError, TypeError):
+                    continue
+                params.append({'id': row_id, 'blob': blob, 'dim': dim, 'dtype': dtype})
+            if params:
+                conn.execute(db.text(
+                    f"UPDATE {table} SET embedding_blob = :blob, embedding_dim = :dim, "
+                    "embedding_dtype = :dtype WHERE id = :id"
+                ), params)
+                conn.commit()
+                total += len(params)
+    if total:
+        print(f"[MIGRATE] {table}表回填 {total} 条二进制向量")
+
+
+def _backfill_content_hashes(table, batch_size=500):
+    """为旧文本块回填 content_hash 列（按当前 Embedding 模型计算，见 ai/embedding_store.py）
+
+    只处理 content_hash 为空的行，回填完成后每次启动只是一次索引查询。
+
+    Args:
+        table: 表名(str)，knowledge_chunks 或 external_knowledge_chunks
+        batch_size: 每批处理行数(int)
+    """
+    from ai.embedding_store import content_hash, current_model
+    model = current_model()
+    total = 0
+    with db.engine.connect() as conn:
+        while True:
+            rows = conn.execute(db.text(
+                f"SELECT id, content FROM {table} WHERE content_hash IS NULL ORDER BY id LIMIT :limit"
+            ), {'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            conn.execute(db.text(f"UPDATE {table} SET content_hash = :hash WHERE id = :id"),
+                         [{'id': row_id, 'hash': content_hash(model, content or '')} for row_id, content in rows])
+            conn.commit()
+            total += len(rows)
+    if total:
+        print(f"[MIGRATE] {table}表回填 {total} 条 content_hash")
+
+
+def _backfill_external_source_urls():
+    """从 config_json 回填 external_knowledge.source_url（只解析JSON，URL字段不加密）"""
+    with db.engine.connect() as conn:
+        rows = conn.execute(db.text(
+            "SELECT id, config_json FROM external_knowledge WHERE source_url IS NULL"
+        )).fetchall()
+        params = []
+        for row_id, config_json in rows:
+            try:
+                config = json.loads(config_json) if config_json else {}
+            except (json.JSONDecodeError, TypeError):
+                config = {}
+            url = ExternalKnowledge.primary_url(config) if isinstance(config, dict) else ''
+            params.append({'id': row_id, 'url': url[:1000]})
+        if params:
+            conn.execute(db.text("UPDATE external_knowledge SET source_url = :url WHERE id = :id"), params)
+            conn.commit()
+            print(f"[MIGRATE] external_knowledge表回填 {len(params)} 条 source_url")
+
+
 def _migrate_add_columns():
     """自动迁移：为已有数据库表添加新列
 
@@ -413,6 +513,16 @@ def _migrate_add_columns():
             if 'config_json' not in ek_cols:
                 cursor.execute("ALTER TABLE external_knowledge ADD COLUMN config_json TEXT DEFAULT '{}'")
                 print("[MIGRATE] external_knowledge表添加 config_json 列")
+            if 'source_url' not in ek_cols:
+                cursor.execute("ALTER TABLE external_knowledge ADD COLUMN source_url VARCHAR(1000)")
+                print("[MIGRATE] external_knowledge表添加 source_url 列")
+
+            # 知识库文件表: 入库完成标记(已有文件均为完整文件)
+            cursor.execute('PRAGMA table_info(knowledge_files)')
+            kf_cols = [row[1] for row in cursor.fetchall()]
+            if 'is_ready' not in kf_cols:
+                cursor.execute("ALTER TABLE knowledge_files ADD COLUMN is_ready BOOLEAN NOT NULL DEFAULT 1")
+                print("[MIGRATE] knowledge_files表添加 is_ready 列")
             # 删除模型已不再使用的废弃列(仅在存在时执行)
             if 'url' in ek_cols:
                 cursor.execute("ALTER TABLE external_knowledge DROP COLUMN url")
@@ -421,6 +531,20 @@ def _migrate_add_columns():
                 cursor.execute("ALTER TABLE external_knowledge DROP COLUMN content_type")
                 print("[MIGRATE] external_knowledge表删除废弃的 content_type 列")
 
+            # 知识库文本块表: 添加二进制向量列
+            for table in ('knowledge_chunks', 'external_knowledge_chunks'):
+                cursor.execute(f'PRAGMA table_info({table})')
+                chunk_cols = [row[1] for row in cursor.fetchall()]
+                for col, col_type in _EMBEDDING_BLOB_COLUMNS:
+                    if col not in chunk_cols:
+                        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {col} {col_type}')
+                        print(f"[MIGRATE] {table}表添加 {col} 列")
+                # 向量存储键(清理未引用向量时按索引反连接)
+                if 'content_hash' not in chunk_cols:
+                    cursor.execute(f'ALTER TABLE {table} ADD COLUMN content_hash VARCHAR(64)')
+                    print(f"[MIGRATE] {table}表添加 content_hash 列")
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_content_hash ON {table} (content_hash)')
+
             conn.commit()
             conn.close()
         else:
@@ -456,6 +580,24 @@ def _migrate_add_columns():
                     ))
                     conn.commit()
                     print("[MIGRATE] external_knowledge表添加 config_json 列")
+                if 'source_url' not in ek_cols:
+                    conn.execute(db.text(
+                        "ALTER TABLE external_knowledge ADD COLUMN source_url VARCHAR(1000)"
+                    ))
+                    conn.commit()
+                    print("[MIGRATE] external_knowledge表添加 source_url 列")
+
+                # 知识库文件表: 入库完成标记(已有文件均为完整文件)
+                kf_result = conn.execute(db.text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name='knowledge_files' AND column_name='is_ready'"
+                ))
+                if not kf_result.fetchone():
+                    conn.execute(db.text(
+                        "ALTER TABLE knowledge_files ADD COLUMN is_ready BOOLEAN NOT NULL DEFAULT TRUE"
+                    ))
+                    conn.commit()
+                    print("[MIGRATE] knowledge_files表添加 is_ready 列")
                 if 'url' in ek_cols:
                     conn.execute(db.text("ALTER TABLE external_knowledge DROP COLUMN url"))
                     conn.commit()
@@ -465,6 +607,35 @@ def _migrate_add_columns():
                     conn.commit()
                     print("[MIGRATE] external_knowledge表删除废弃的 content_type 列")
 
+                # 知识库文本块表: 添加二进制向量列
+                for table in ('knowledge_chunks', 'external_knowledge_chunks'):
+                    chunk_result = conn.execute(db.text(
+                        "SELECT column_name FROM information_schema.columns "
+                        f"WHERE table_name='{table}'"
+                    ))
+                    chunk_cols = [r[0] for r in chunk_result.fetchall()]
+                    for col, col_type in _EMBEDDING_BLOB_COLUMNS:
+                        if col not in chunk_cols:
+                            pg_type = 'BYTEA' if col_type == 'BLOB' else col_type
+                            conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {col} {pg_type}'))
+                            conn.commit()
+                            print(f"[MIGRATE] {table}表添加 {col} 列")
+                    # 向量存储键(清理未引用向量时按索引反连接)
+                    if 'content_hash' not in chunk_cols:
+                        conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN content_hash VARCHAR(64)'))
+                        print(f"[MIGRATE] {table}表添加 content_hash 列")
+                    conn.execute(db.text(
+                        f'CREATE INDEX IF NOT EXISTS ix_{table}_content_hash ON {table} (content_hash)'
+                    ))
+                    conn.commit()
+
+        # 将旧版JSON向量回填为二进制格式，并回填向量存储键
+        for table in ('knowledge_chunks', 'external_knowledge_chunks'):
+            _backfill_embedding_blobs(table)
+            _backfill_content_hashes(table)
+        # 外部知识库主URL明文列
+        _backfill_external_source_urls()
+
         print("[OK] Database migration check complete")
     except Exception as e:
         print(f"[WARN] Migration check failed (non-critical): {e}")
@@ -528,6 +699,11 @@ def initialize_database():
 
                 _db_initialized = True
                 print("[OK] Database initialization complete")
+
+                # 启动本进程的知识库后台任务线程（数据库就绪后才能领取任务）
+                job_runner.start(app)
+                # 后台把旧格式密文升级为信封加密格式
+                start_rewrap_migration(app)
                 break  # 成功,退出重试循环
                 
             except Exception as e:
@@ -1586,6 +1762,25 @@ def view_will(will_id):
 
     return render_template('wills/view.html', will=will)
 
+def _send_generated_file(generated, download_name, no_store=False):
+    """以附件形式返回内存中生成的文件(见 utils/pdf_generator.py)，带 Content-Length 和 ETag
+
+    不沿用静态文件的一年缓存：每次下载都用 ETag 向服务器确认，内容未变时返回304。
+
+    Args:
+        generated: generate_will_pdf / generate_asset_list_xlsx 的结果
+        download_name: 下载文件名
+        no_store: 是否禁止浏览器和代理保存(含敏感内容时)
+    """
+    response = send_file(generated['file'], as_attachment=True, download_name=download_name,
+                         etag=generated['etag'], conditional=True, max_age=0)
+    if response.status_code == 200:
+        response.content_length = generated['size']
+    response.cache_control.private = True
+    response.cache_control.no_store = no_store
+    return response
+
+
 @app.route('/wills/<int:will_id>/generate_pdf', methods=['GET'])
 @login_required
 def generate_pdf(will_id):
@@ -1597,15 +1792,8 @@ def generate_pdf(will_id):
         return redirect(url_for('wills'))
 
     try:
-        print(f"Generating PDF for will {will_id}: {will.title}")
-        pdf_path = generate_will_pdf(will)
-        print(f"PDF generated at: {pdf_path}")
-
-        if pdf_path and os.path.exists(pdf_path):
-            return send_file(pdf_path, as_attachment=True, download_name=f'数字资产处置意愿声明书_{will.title}.pdf')
-        else:
-            flash('PDF文件生成失败，请稍后重试', 'error')
-            return redirect(url_for('view_will', will_id=will_id))
+        generated = generate_will_pdf(will)
+        return _send_generated_file(generated, f'数字资产处置意愿声明书_{will.title}.pdf')
     except Exception as e:
         print(f"PDF generation error: {e}")
         import traceback
@@ -1621,10 +1809,9 @@ def print_asset_list():
     from utils.pdf_generator import generate_asset_list_xlsx
     assets = DigitalAsset.query.filter_by(user_id=current_user.id).order_by(DigitalAsset.category).all()
     try:
-        xlsx_path = generate_asset_list_xlsx(current_user, assets)
-        if xlsx_path and os.path.exists(xlsx_path):
-            return send_file(xlsx_path, as_attachment=True, download_name=f'数字资产清单_{current_user.username}.xlsx')
-        flash('资产清单生成失败', 'error')
+        generated = generate_asset_list_xlsx(current_user, assets)
+        # 清单含解密后的密码，不允许任何缓存保存
+        return _send_generated_file(generated, f'数字资产清单_{current_user.username}.xlsx', no_store=True)
     except Exception as e:
         print(f"Asset list xlsx error: {e}")
         flash(f'资产清单生成失败：{str(e)}', 'error')
@@ -1643,6 +1830,7 @@ def delete_will(will_id):
     try:
         db.session.delete(will)
         db.session.commit()
+        discard_will_pdf(will_id)
         flash('遗嘱删除成功', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3259,12 +3447,24 @@ def initialize_sample_data():
 # ============================================================
 # AI 对话功能路由
 # ============================================================
+import itertools
 import json
 import uuid
-from ai.document_parser import parse_document, get_supported_types
-from ai.chunker import split_text
-from ai.embedding import embed_texts
+from ai.document_parser import iter_document, get_supported_types
+from ai.chunker import iter_chunks
+from ai.embedding import get_query_cache_stats
+from ai.http_client import get_transport_stats
+from ai.provider_router import get_router_stats
+from ai.llm import get_hedge_stats
+from ai.answer_cache import get_answer_cache_stats
+from ai.embedding_store import embed_texts_dedup, schedule_prune
+from ai.jobs import (JOB_KNOWLEDGE_UPLOAD, JobError, enqueue_job, get_job, has_active_job,
+                     register_job_handler, job_runner)
 from ai.rag import rag_query, get_chat_history, save_chat_message
+from ai.sse import SSE_HEADERS, SSEWriter
+from ai.summary import delete_session_summary, get_summary_stats, schedule_summary
+from ai.lexical_index import get_hybrid_stats
+from ai.vector_index import knowledge_index, SOURCE_LOCAL
 
 
 @app.route('/chat')
@@ -3291,6 +3491,8 @@ def chat_message():
         - session_id: 会话ID
         - sources: 引用的知识库来源
         - search_used: 是否使用了网络搜索
+        - timings: 上下文组装各阶段耗时(ms)及状态
+        - cached: 是否直接使用了缓存的回答
     """
     # 每日对话次数限制检查
     usage_check = _check_chat_limit(current_user.id)
@@ -3324,7 +3526,9 @@ def chat_message():
             'answer': result['answer'],
             'session_id': session_id,
             'sources': result['sources'],
-            'search_used': result['search_used']
+            'search_used': result['search_used'],
+            'timings': result['timings'],
+            'cached': result['cached']
         })
     except Exception as e:
         error_msg = str(e)
@@ -3337,107 +3541,126 @@ def chat_message():
         return jsonify({'error': friendly}), 500
 
 
-@app.route('/chat/api/stream', methods=['POST'])
-@login_required
-def chat_stream():
-    """处理用户发送的聊天消息（流式SSE输出，支持图片视觉问答）
-    
-    请求体(JSON): 同 chat_message
-    
-    返回(Server-Sent Events):
-        逐token推送AI回答，格式:
-        data: {"token": "你"}
-        data: {"token": "好"}
-        ...
-        data: {"done": true, "session_id": "xxx"}
+def _parse_chat_stream_request():
+    """校验流式对话请求（每日次数限制、图片大小、空消息），Flask 与 ASGI 流式接口共用
+
+    需在请求上下文中调用。
+
+    Returns:
+        tuple: (params, error_response)；校验失败时 params 为 None，error_response 为 (JSON响应, 状态码)
+               params(dict): user_id / query / session_id / enable_search / image_base64 / image_mime
     """
     # 每日对话次数限制检查
     usage_check = _check_chat_limit(current_user.id)
     if not usage_check['allowed']:
-        return jsonify({'error': usage_check['message']}), 429
+        return None, (jsonify({'error': usage_check['message']}), 429)
     data = request.get_json()
     query = data.get('message', '').strip()
-    session_id = data.get('session_id', '')
-    enable_search = data.get('enable_search', True)
     image_base64 = data.get('image_base64')    # 图片Base64，可选
-    image_mime = data.get('image_mime_type', 'image/jpeg')
 
     # 图片大小检查（智谱AI GLM-4V限制约2MB，base64编码后约为原始1.37倍）
     if image_base64 and len(image_base64) > 3 * 1024 * 1024:
-        return jsonify({'error': '图片太大，请上传不超过2MB的图片'}), 400
+        return None, (jsonify({'error': '图片太大，请上传不超过2MB的图片'}), 400)
 
     if not query:
-        return jsonify({'error': '消息不能为空'}), 400
+        return None, (jsonify({'error': '消息不能为空'}), 400)
+
+    return {
+        'user_id': current_user.id,
+        'query': query,
+        'session_id': data.get('session_id', '') or str(uuid.uuid4()),
+        'enable_search': data.get('enable_search', True),
+        'image_base64': image_base64,
+        'image_mime': data.get('image_mime_type', 'image/jpeg'),
+    }, None
+
+
+def _finish_chat_turn(params, answer):
+    """流式回答完成后保存对话记录，并记录每日使用次数+1（需在应用上下文中调用）"""
+    user_content = params['query']
+    if params['image_base64']:
+        user_content = f"[图片问答] {params['query']}"
+    save_chat_message(params['user_id'], params['session_id'], 'user', user_content)
+    save_chat_message(params['user_id'], params['session_id'], 'assistant', answer)
+    _increment_chat_usage(params['user_id'])
+    # 会话较长时在后台把较早的对话并入摘要
+    schedule_summary(params['user_id'], params['session_id'])
+
+
+def _friendly_stream_error(e):
+    """友好化流式对话的常见错误提示"""
+    error_msg = str(e)
+    if 'Max retries exceeded' in error_msg or 'ConnectionError' in error_msg:
+        return 'AI服务连接失败：Ollama未启动或网络不可达，请检查Ollama是否正在运行'
+    if 'timed out' in error_msg or 'timeout' in error_msg.lower():
+        return 'AI响应超时：模型正在加载中或网络较慢，请稍后重试（首次加载约需1-2分钟）'
+    return 'AI服务暂时不可用，请稍后重试'
 
-    if not session_id:
-        session_id = str(uuid.uuid4())
 
-    # 在生成器外提前捕获user_id（SSE生成器中请求上下文会丢失，current_user不可用）
-    user_id = current_user.id
+@app.route('/chat/api/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """处理用户发送的聊天消息（流式SSE输出，支持图片视觉问答）
+    
+    以 asgi.py 启动时，本接口由异步实现接管（见 asgi.py），行为与此处一致。
+
+    请求体(JSON): 同 chat_message
+    
+    返回(Server-Sent Events):
+        推送AI回答（相邻token合并为一帧，见 ai/sse.py），格式:
+        data: {"token": "你好"}
+        data: {"token": "，关于"}
+        : ping        （上游长时间无输出时的心跳注释）
+        ...
+        data: {"done": true, "session_id": "xxx", "timings": {...}}
+    """
+    params, error_response = _parse_chat_stream_request()
+    if error_response:
+        return error_response
 
     # 豁免CSRF检查（SSE请求）
     request._csrf_exempt = True
 
     def generate():
         """SSE生成器：逐token推送AI回答
-        注意：Flask SSE生成器在yield时请求上下文会丢失，
+        注意：Flask SSE生成器在yield时请求上下文会丢失（current_user不可用，user_id已提前取出），
         需要使用app.app_context()确保数据库操作等正常执行
         """
-        full_answer = ""
+        writer = SSEWriter()
+        timings = {}
         with app.app_context():
             try:
                 # 视觉问答(有图片)时用非流式，避免智谱AI视觉模型stream不兼容
-                use_stream = not image_base64
+                use_stream = not params['image_base64']
                 
                 result = rag_query(
-                    query=query,
-                    user_id=user_id,
-                    session_id=session_id,
-                    enable_search=enable_search,
+                    query=params['query'],
+                    user_id=params['user_id'],
+                    session_id=params['session_id'],
+                    enable_search=params['enable_search'],
                     stream=use_stream,
-                    image_base64=image_base64,
-                    image_mime_type=image_mime
+                    image_base64=params['image_base64'],
+                    image_mime_type=params['image_mime'],
+                    timings=timings
                 )
                 
                 if use_stream:
-                    # 流式模式：逐token输出
-                    for token in result:
-                        full_answer += token
-                        yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+                    # 流式模式：合并相邻token输出
+                    yield from writer.iter_frames(result)
                 else:
                     # 非流式模式（视觉问答）：一次性输出完整回答
-                    full_answer = result.get('answer', '') if isinstance(result, dict) else str(result)
-                    yield f"data: {json.dumps({'token': full_answer}, ensure_ascii=False)}\n\n"
+                    yield writer.push(result.get('answer', '') if isinstance(result, dict) else str(result)) or ''
 
-                # 保存对话记录
-                user_content = query
-                if image_base64:
-                    user_content = f"[图片问答] {query}"
-                save_chat_message(user_id, session_id, 'user', user_content)
-                save_chat_message(user_id, session_id, 'assistant', full_answer)
+                _finish_chat_turn(params, writer.answer)
 
-                # 记录每日使用次数+1
-                _increment_chat_usage(user_id)
-
-                yield f"data: {json.dumps({'done': True, 'session_id': session_id}, ensure_ascii=False)}\n\n"
+                yield writer.event({'done': True, 'session_id': params['session_id'], 'timings': timings})
             except Exception as e:
-                error_msg = str(e)
-                # 友好化常见错误提示
-                if 'Max retries exceeded' in error_msg or 'ConnectionError' in error_msg:
-                    friendly = 'AI服务连接失败：Ollama未启动或网络不可达，请检查Ollama是否正在运行'
-                elif 'timed out' in error_msg or 'timeout' in error_msg.lower():
-                    friendly = 'AI响应超时：模型正在加载中或网络较慢，请稍后重试（首次加载约需1-2分钟）'
-                else:
-                    friendly = 'AI服务暂时不可用，请稍后重试'
-                yield f"data: {json.dumps({'error': friendly}, ensure_ascii=False)}\n\n"
+                yield writer.event({'error': _friendly_stream_error(e)})
 
     return app.response_class(
         generate(),
         mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no',
-        }
+        headers=SSE_HEADERS
     )
 
 
@@ -3471,6 +3694,12 @@ def ai_health_check():
         - available: 是否可用
         - providers: 已配置的提供者列表
         - message: 状态说明
+        - embedding_cache: 本进程问题向量缓存的命中/未命中统计
+        - transport: 本进程各提供者的请求耗时与首token耗时(TTFT)统计
+        - llm_router: 本进程各对话后端的错误率、429比例与熔断状态
+        - llm_hedge: 本进程流式对话对冲请求的次数与备选胜出次数
+        - answer_cache: 本进程回答缓存的命中/未命中统计
+        - chat_summary: 本进程会话摘要的生成次数
     """
     if not current_user.is_admin:
         return jsonify({'available': False, 'providers': [], 'message': '仅管理员可检查'}), 403
@@ -3505,7 +3734,14 @@ def ai_health_check():
     # 生成简洁的提供者显示名称
     provider_display = '智谱AI' if zhipu_key else ('SiliconFlow' if sf_key else '未配置')
 
-    return jsonify({'available': available, 'provider': provider_display, 'providers': providers, 'message': msg})
+    return jsonify({'available': available, 'provider': provider_display, 'providers': providers, 'message': msg,
+                    'embedding_cache': get_query_cache_stats(),
+                    'transport': get_transport_stats(),
+                    'llm_router': get_router_stats(),
+                    'llm_hedge': get_hedge_stats(),
+                    'answer_cache': get_answer_cache_stats(),
+                    'chat_summary': get_summary_stats(),
+                    'hybrid_retrieval': get_hybrid_stats()})
 
 
 @app.route('/chat/api/knowledge/upload', methods=['POST'])
@@ -3520,24 +3756,22 @@ def upload_knowledge():
         - file: 上传的文件（支持 pdf/txt/md/docx）
     
     处理流程:
-        1. 验证文件类型
+        1. 验证文件类型、配额与同名文件
         2. 读取文件二进制数据
-        3. 解析文档提取文本
-        4. 将文本切分为块
-        5. 对每个文本块生成向量
-        6. 存入数据库（所有用户共享此知识库）
+        3. 创建后台任务，立即返回（HTTP 202）
+        4. 后台线程解析文档 → 切分 → 向量化 → 存入数据库（见 _run_knowledge_upload_job）
     
     返回(JSON):
         - success: 是否成功
         - message: 提示信息
-        - chunk_count: 切分后的文本块数量
+        - job_id: 后台任务ID，通过 /admin/api/jobs/<job_id> 查询进度
     """
     if not current_user.is_admin:
         return jsonify({'success': False, 'message': '仅管理员可管理知识库'}), 403
 
     # 知识库配额检查：限制文件数量和总存储容量（防存储DoS）
-    MAX_KNOWLEDGE_FILES = 50
-    MAX_TOTAL_SIZE_MB = 100
+    MAX_KNOWLEDGE_FILES = app.config.get('KNOWLEDGE_MAX_FILES', 50)
+    MAX_TOTAL_SIZE_MB = app.config.get('KNOWLEDGE_MAX_TOTAL_MB', 100)
     existing_count = KnowledgeFile.query.count()
     if existing_count >= MAX_KNOWLEDGE_FILES:
         return jsonify({
@@ -3571,84 +3805,170 @@ def upload_knowledge():
             'message': f'不支持的文件类型: {file_type}，支持: {", ".join(supported)}'
         }), 400
 
-    # 检查同名文件是否已存在，防止重复上传
-    existing = KnowledgeFile.query.filter_by(filename=filename).first()
+    # 检查同名文件是否已存在，防止重复上传（中断的入库留下的未完成文件由重新上传的任务清理）
+    existing = KnowledgeFile.query.filter_by(filename=filename, is_ready=True).first()
     if existing:
         return jsonify({
             'success': False,
             'message': f'文件 "{filename}" 已存在（{existing.chunk_count}个片段，上传于{existing.created_at.strftime("%Y-%m-%d %H:%M") if existing.created_at else ""}），请先删除后再上传'
         }), 400
 
+    # 同名文件正在后台处理中，拒绝重复提交
+    if has_active_job(JOB_KNOWLEDGE_UPLOAD, filename):
+        return jsonify({'success': False, 'message': f'文件 "{filename}" 正在后台处理中，请稍候'}), 400
+
+    file_data = file.read()
+    if len(file_data) > 10 * 1024 * 1024:
+        return jsonify({'success': False, 'message': '文件大小不能超过10MB'}), 400
+
+    # 解析/切分/向量化/入库在后台线程执行，立即返回任务ID供前端轮询进度
     try:
-        file_data = file.read()
+        job_id = enqueue_job(JOB_KNOWLEDGE_UPLOAD, current_user.id, filename,
+                             payload=file_data, options={'file_type': file_type})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'创建处理任务失败: {str(e)}'}), 500
 
-        if len(file_data) > 10 * 1024 * 1024:
-            return jsonify({'success': False, 'message': '文件大小不能超过10MB'}), 400
+    job = get_job(job_id)
+    return jsonify({
+        'success': True,
+        'message': f'文件 "{filename}" 已上传，正在后台解析并向量化',
+        'job_id': job_id,
+        'job': job
+    }), 202
 
-        # ① 解析文档提取文本
-        text = parse_document(file_data, file_type)
 
-        if not text.strip():
-            return jsonify({'success': False, 'message': '文档内容为空或无法提取文本'}), 400
+def _run_knowledge_upload_job(job):
+    """后台任务：流式解析上传的知识库文件 → 切分 → 向量化 → 存入数据库 → 更新向量索引
 
-        # ② 切分文本为块
-        chunks = split_text(text, chunk_size=500, chunk_overlap=50)
+    解析器逐页/逐段产出文本，分块器逐块产出，每攒够 INGESTION_EMBED_WINDOW 个文本块
+    就向量化并写入数据库，随后丢弃该窗口；内存峰值只与窗口大小有关，与文档大小无关。
 
-        if not chunks:
-            return jsonify({'success': False, 'message': '文档切分后无有效内容'}), 400
+    Args:
+        job: ai.jobs.JobContext，payload 为文件数据，options['file_type'] 为文件类型
 
-        # ③ 生成向量（可能耗时较长，尤其是Ollama本地模型）
+    Returns:
+        str: 成功信息
+    """
+    filename = job.name
+    file_type = job.options.get('file_type', '')
+    window = max(1, app.config.get('INGESTION_EMBED_WINDOW', 128))
+
+    # 本任务之前的执行中断(进程退出)时留下的未完成文件
+    for partial in KnowledgeFile.query.filter_by(filename=filename, is_ready=False).all():
+        db.session.delete(partial)
+        db.session.commit()
+        knowledge_index.remove(SOURCE_LOCAL, partial.id)
+
+    # 后台执行期间可能已有同名文件入库
+    if KnowledgeFile.query.filter_by(filename=filename).first():
+        raise JobError(f'文件 "{filename}" 已存在，请先删除后再上传')
+
+    # 带重试的数据库操作，应对Neon冷启动；重试时已向量化的文本块从向量存储复用，不会重复调用API
+    max_db_retries = 3
+    for attempt in range(max_db_retries):
         try:
-            embeddings = embed_texts(chunks)
-        except Exception as emb_err:
-            return jsonify({
-                'success': False,
-                'message': f'向量化失败，请检查AI服务是否正常运行: {str(emb_err)}'
-            }), 500
+            file_id, chunk_count = _ingest_knowledge_file(job, filename, file_type, window)
+            break
+        except JobError:
+            db.session.rollback()
+            raise
+        except Exception as db_err:
+            db.session.rollback()
+            if attempt < max_db_retries - 1:
+                import time
+                time.sleep(2 * (attempt + 1))
+                continue
+            raise db_err
+    job.progress('committed', chunk_count, chunk_count)
+
+    # 增量更新进程内向量索引（从数据库读回本文件的向量，其他worker通过指纹比对发现变更）
+    knowledge_index.reload(SOURCE_LOCAL, file_id)
+
+    return f'成功上传并处理文件 "{filename}"，共 {chunk_count} 个知识片段'
+
 
-        # ④ 存入数据库（user_id为管理员ID，但所有用户共享检索）
-        # 带重试的数据库操作，应对Neon冷启动
-        max_db_retries = 3
-        for attempt in range(max_db_retries):
+def _ingest_knowledge_file(job, filename, file_type, window):
+    """按窗口流式处理文件并写入数据库
+
+    每个窗口单独提交（短事务，SQLite下也不会阻塞进度/向量存储的写入）。
+    文件行以 is_ready=False 写入，最后一个窗口提交后才置为True，此前其他worker的索引与
+    指纹均不包含该文件；任何一步失败都会删除已写入的部分。
+
+    Returns:
+        tuple: (知识库文件ID, 文本块数量)
+    """
+    seen_text = False
+
+    def segments():
+        # 记录是否解析出任何文字，用于区分"文档为空"和"切分后无有效内容"
+        nonlocal seen_text
+        for segment in iter_document(job.payload, file_type):
+            if not seen_text and segment.strip():
+                seen_text = True
+                job.progress('parsed')
+            yield segment
+
+    knowledge_file = KnowledgeFile(
+        user_id=job.user_id,
+        filename=filename,
+        file_type=file_type,
+        file_data=job.payload,
+        chunk_count=0,
+        is_ready=False
+    )
+    db.session.add(knowledge_file)
+    db.session.commit()
+    file_id = knowledge_file.id
+
+    try:
+        chunk_stream = iter_chunks(segments(), chunk_size=500, chunk_overlap=50)
+        chunk_count = 0
+        while True:
+            batch = list(itertools.islice(chunk_stream, window))
+            if not batch:
+                break
+
+            # 已向量化过的相同文本块直接复用，只对新内容调用API
             try:
-                knowledge_file = KnowledgeFile(
-                    user_id=current_user.id,
-                    filename=filename,
-                    file_type=file_type,
-                    file_data=file_data,
-                    chunk_count=len(chunks)
+                embeddings, hashes = embed_texts_dedup([chunk.text for chunk in batch], return_hashes=True)
+            except Exception as emb_err:
+                raise JobError(f'向量化失败，请检查AI服务是否正常运行: {str(emb_err)}')
+
+            for offset, (chunk, embedding, chunk_hash) in enumerate(zip(batch, embeddings, hashes)):
+                row = KnowledgeChunk(
+                    file_id=file_id,
+                    chunk_index=chunk_count + offset,
+                    content=chunk.text,
+                    content_hash=chunk_hash
                 )
-                db.session.add(knowledge_file)
-                db.session.flush()
-
-                for idx, (chunk_text, embedding) in enumerate(zip(chunks, embeddings)):
-                    chunk = KnowledgeChunk(
-                        file_id=knowledge_file.id,
-                        chunk_index=idx,
-                        content=chunk_text,
-                        embedding=json.dumps(embedding, ensure_ascii=False)
-                    )
-                    db.session.add(chunk)
-
-                db.session.commit()
-                break
-            except Exception as db_err:
-                db.session.rollback()
-                if attempt < max_db_retries - 1:
-                    import time
-                    time.sleep(2 * (attempt + 1))
-                    continue
-                raise db_err
+                row.set_embedding(embedding)
+                db.session.add(row)
+            # 提交本窗口后即可释放（提交后会话不再持有这些对象）
+            db.session.commit()
+            chunk_count += len(batch)
+            job.progress('embedding', chunk_count)
 
-        return jsonify({
-            'success': True,
-            'message': f'成功上传并处理文件，共 {len(chunks)} 个知识片段',
-            'chunk_count': len(chunks)
-        })
+        if not seen_text:
+            raise JobError('文档内容为空或无法提取文本')
+        if chunk_count == 0:
+            raise JobError('文档切分后无有效内容')
 
-    except Exception as e:
+        db.session.query(KnowledgeFile).filter_by(id=file_id).update({'chunk_count': chunk_count, 'is_ready': True})
+        db.session.commit()
+        return file_id, chunk_count
+    except Exception:
+        # 删除已写入的部分（文本块随文件级联删除）
         db.session.rollback()
-        return jsonify({'success': False, 'message': f'处理文件失败: {str(e)}'}), 500
+        partial = db.session.get(KnowledgeFile, file_id)
+        if partial is not None:
+            db.session.delete(partial)
+            db.session.commit()
+        knowledge_index.remove(SOURCE_LOCAL, file_id)
+        raise
+
+
+register_job_handler(JOB_KNOWLEDGE_UPLOAD, _run_knowledge_upload_job)
 
 # upload_knowledge CSRF 已恢复校验（前端需带 X-CSRFToken）
 
@@ -3708,6 +4028,8 @@ def delete_knowledge(file_id):
     try:
         db.session.delete(kf)
         db.session.commit()
+        knowledge_index.remove(SOURCE_LOCAL, file_id)
+        schedule_prune()
         return jsonify({'success': True, 'message': '已删除'})
     except Exception as e:
         db.session.rollback()
@@ -3849,6 +4171,7 @@ def delete_session(session_id):
     """
     try:
         ChatMessage.query.filter_by(user_id=current_user.id, session_id=session_id).delete()
+        delete_session_summary(current_user.id, session_id)
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
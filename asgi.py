@@ -0,0 +1,182 @@
+"""
+ASGI 入口 - 异步流式对话接口
+
+gunicorn 同步 worker 下，每个流式回答(/chat/api/stream)在LLM生成的整个过程中
+(经常 10~60 秒)独占一个线程，--workers 1 --threads 2 时第三个用户就要排队。
+
+本模块把应用挂到 ASGI 服务器(uvicorn)上:
+    - POST /chat/api/stream 由事件循环异步处理：上游LLM请求使用 httpx.AsyncClient(见 ai.llm.achat_stream)，
+      等待token期间不占用线程，一个进程即可同时承载数百个流式回答
+    - 其余所有路由原样交给 Flask（a2wsgi 线程池，ASGI_WSGI_THREADS 个线程）
+
+流式接口的行为与 Flask 版 chat_stream 一致:
+    - 登录校验、CSRF、每日次数限制、参数校验都在 Flask 请求上下文中执行（共用 app.py 的辅助函数）
+    - 上下文组装/回答缓存(prepare_rag)与数据库写入在线程中执行，只有等待LLM输出的阶段是异步的
+    - SSE 事件格式不变；客户端断开后立即取消上游请求，不保存对话、不计入使用次数
+
+启动:
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT
+
+配置(环境变量，见 config.py):
+    ASGI_WSGI_THREADS: 处理 Flask 路由的线程数
+    ASGI_UPSTREAM_CONNECTIONS: 异步上游连接池的最大连接数(见 ai/llm.py)
+"""
+import asyncio
+import io
+import os
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask_login import current_user
+
+from app import app, _finish_chat_turn, _friendly_stream_error, _parse_chat_stream_request
+from ai.answer_cache import replay_answer
+from ai.llm import achat_stream, aclose_async_client, chat
+from ai.rag import prepare_rag, remember_answer
+from ai.sse import SSE_HEADERS, SSEWriter
+
+
+# 由本模块异步处理的流式接口
+STREAM_PATH = '/chat/api/stream'
+
+flask_app = WSGIMiddleware(app, workers=int(os.environ.get('ASGI_WSGI_THREADS', '8')))
+
+
+async def application(scope, receive, send):
+    """ASGI 应用：流式对话接口异步处理，其余请求交给 Flask"""
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == STREAM_PATH:
+        await chat_stream(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+
+async def _lifespan(receive, send):
+    """服务启动/关闭事件：关闭时释放异步上游连接池"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_async_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _read_body(receive):
+    """读取完整请求体（超过 MAX_CONTENT_LENGTH 时停止读取，交由 Flask 返回 413）"""
+    limit = app.config.get('MAX_CONTENT_LENGTH')
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if not message.get('more_body') or (limit and size > limit):
+            return b''.join(chunks)
+
+
+def _dispatch(environ):
+    """在 Flask 请求上下文中执行 before_request(CSRF等)、登录校验和参数校验
+
+    流程与 Flask.full_dispatch_request 相同，只是把视图函数换成了参数校验。
+
+    Returns:
+        tuple: (response, params)；params 为 None 时直接返回 response(错误/重定向)，
+               否则 response 是已经过 after_request 处理的SSE响应头(含会话Cookie)
+    """
+    with app.request_context(environ):
+        try:
+            params = None
+            try:
+                rv = app.preprocess_request()
+                if rv is None and not current_user.is_authenticated:
+                    rv = app.login_manager.unauthorized()
+                if rv is None:
+                    params, rv = _parse_chat_stream_request()
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            if rv is None:
+                rv = app.response_class(mimetype='text/event-stream', headers=SSE_HEADERS)
+            return app.finalize_request(rv), params
+        except Exception as e:
+            return app.handle_exception(e), None
+
+
+def _run_in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+async def _send_start(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in response.headers.to_wsgi_list()],
+    })
+
+
+async def _iterate(tokens):
+    for token in tokens:
+        yield token
+
+
+async def _stream_answer(send, params):
+    """生成并推送回答，完成后保存对话记录（SSE格式同 app.chat_stream）"""
+    writer = SSEWriter()
+    try:
+        prepared = await asyncio.to_thread(
+            _run_in_app_context, prepare_rag, params['query'], params['user_id'], params['session_id'],
+            params['enable_search'], params['image_base64'], params['image_mime'])
+
+        if prepared['cached']:
+            # 以流式片段回放缓存的回答
+            tokens = _iterate(replay_answer(prepared['cached']['answer']))
+        elif params['image_base64']:
+            # 视觉问答(有图片)时用非流式，避免智谱AI视觉模型stream不兼容
+            answer = await asyncio.to_thread(chat, prepared['messages'], False)
+            tokens = _iterate([answer])
+        else:
+            tokens = achat_stream(prepared['messages'])
+
+        async for frame in writer.aiter_frames(tokens):
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+
+        if not prepared['cached']:
+            remember_answer(prepared, writer.answer)
+        await asyncio.to_thread(_run_in_app_context, _finish_chat_turn, params, writer.answer)
+
+        event = writer.event({'done': True, 'session_id': params['session_id'], 'timings': prepared['timings']})
+    except Exception as e:
+        event = writer.event({'error': _friendly_stream_error(e)})
+    await send({'type': 'http.response.body', 'body': event.encode('utf-8')})
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def chat_stream(scope, receive, send):
+    """异步版 /chat/api/stream（请求体与SSE事件格式同 app.chat_stream）"""
+    body = await _read_body(receive)
+    if body is None:
+        return
+    response, params = await asyncio.to_thread(_dispatch, build_environ(scope, io.BytesIO(body)))
+    await _send_start(send, response)
+    if params is None:
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+        return
+
+    # 客户端断开时取消生成（上游请求随之关闭）
+    streaming = asyncio.ensure_future(_stream_answer(send, params))
+    watcher = asyncio.ensure_future(_wait_disconnect(receive))
+    done, _ = await asyncio.wait({streaming, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if streaming in done:
+        watcher.cancel()
+    else:
+        streaming.cancel()
+        print(f"[INFO] 客户端已断开，取消流式回答(session={params['session_id']})")
@@ -14,6 +14,14 @@ class Config:
     # 会话空闲超时（30分钟无操作则需重新登录）
     SESSION_IDLE_TIMEOUT = timedelta(minutes=30)
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    # 加密格式迁移: 启动后是否在后台把旧格式密文升级为信封加密、每批处理的记录数(见 utils/encryption_migration.py)
+    ENCRYPTION_REWRAP_ENABLED = os.environ.get('ENCRYPTION_REWRAP_ENABLED', 'true').lower() == 'true'
+    ENCRYPTION_REWRAP_BATCH = int(os.environ.get('ENCRYPTION_REWRAP_BATCH', '20'))
+    # 批量解密(资产清单导出等)旧格式密文的线程数，0=自动取 min(4, CPU核数)
+    ENCRYPTION_DECRYPT_WORKERS = int(os.environ.get('ENCRYPTION_DECRYPT_WORKERS', '0'))
+    # 声明书PDF/资产清单在内存中生成: 超过 PDF_SPOOL_MAX_MB 时转存匿名临时文件；已生成声明书PDF的内存缓存上限(MB)
+    PDF_SPOOL_MAX_MB = float(os.environ.get('PDF_SPOOL_MAX_MB', '8'))
+    PDF_CACHE_MAX_MB = float(os.environ.get('PDF_CACHE_MAX_MB', '32'))
     UPLOAD_FOLDER = 'uploads'
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 
@@ -30,12 +38,97 @@ class Config:
     SILICONFLOW_API_KEY = os.environ.get('SILICONFLOW_API_KEY', '')
     # Embedding提供者: 'siliconflow'(默认,免费) | 'zhipu'(备选)
     EMBEDDING_PROVIDER = os.environ.get('EMBEDDING_PROVIDER', 'siliconflow')
+    # 向量存储精度: 'float32'(默认) | 'float16'(体积减半)
+    EMBEDDING_STORAGE_DTYPE = os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float32')
+    # Embedding客户端: 同时在途批次数、每个提供者每秒请求数(0=不限速)
+    EMBEDDING_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', '4'))
+    EMBEDDING_RATE_LIMIT = float(os.environ.get('EMBEDDING_RATE_LIMIT', '5'))
+    # Embedding客户端: 429/5xx重试次数、首次重试等待秒数(指数退避)
+    EMBEDDING_MAX_RETRIES = int(os.environ.get('EMBEDDING_MAX_RETRIES', '3'))
+    EMBEDDING_RETRY_BACKOFF = float(os.environ.get('EMBEDDING_RETRY_BACKOFF', '1.0'))
+    # AI提供者HTTP连接池: 每个主机保留的连接数、连接超时(秒)、流式响应数据块间最长等待(秒)
+    # 单个提供者可用 HTTP_TIMEOUT_<提供者>="连接,读取" 覆盖，如 HTTP_TIMEOUT_ZHIPU=5,120
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+    HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '10'))
+    HTTP_STREAM_READ_TIMEOUT = float(os.environ.get('HTTP_STREAM_READ_TIMEOUT', '300'))
+    # 对话后端路由: 统计窗口(秒)、连续失败多少次熔断、窗口内失败率(含429)达到多少熔断、按失败率判断的最少样本数
+    ROUTER_WINDOW_SECONDS = float(os.environ.get('ROUTER_WINDOW_SECONDS', '60'))
+    ROUTER_FAILURE_THRESHOLD = int(os.environ.get('ROUTER_FAILURE_THRESHOLD', '3'))
+    ROUTER_ERROR_RATE = float(os.environ.get('ROUTER_ERROR_RATE', '0.5'))
+    ROUTER_MIN_SAMPLES = int(os.environ.get('ROUTER_MIN_SAMPLES', '5'))
+    # 对话后端路由: 熔断持续时间(秒)、是否由后台线程发送极短请求探测恢复
+    ROUTER_OPEN_SECONDS = float(os.environ.get('ROUTER_OPEN_SECONDS', '30'))
+    ROUTER_PROBE_ENABLED = os.environ.get('ROUTER_PROBE_ENABLED', 'true').lower() == 'true'
+    # 流式对话对冲: 是否启用、等待主后端首token的预算(ms，0=自动取主后端首token耗时p95)
+    LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+    LLM_HEDGE_DELAY_MS = float(os.environ.get('LLM_HEDGE_DELAY_MS', '0'))
     # Tavily搜索API密钥(可选，不设置则禁用网络搜索)
     TAVILY_API_KEY = os.environ.get('TAVILY_API_KEY', '')
     # RAG配置: 检索返回的最大文本块数
     RAG_TOP_K = int(os.environ.get('RAG_TOP_K', '5'))
     # RAG配置: 相似度阈值(低于此值的结果被过滤)
     RAG_SIMILARITY_THRESHOLD = float(os.environ.get('RAG_SIMILARITY_THRESHOLD', '0.3'))
+    # RAG配置: 检索引擎 'exact'(默认，精确扫描) | 'ivf'(近似检索，适合数万块以上的大知识库)
+    RAG_INDEX_ENGINE = os.environ.get('RAG_INDEX_ENGINE', 'exact')
+    # RAG配置: IVF簇数量(0=自动取sqrt(块数))、每次检索探查的簇数量、启用IVF的最小块数
+    RAG_IVF_NLIST = int(os.environ.get('RAG_IVF_NLIST', '0'))
+    RAG_IVF_NPROBE = int(os.environ.get('RAG_IVF_NPROBE', '8'))
+    RAG_IVF_MIN_CHUNKS = int(os.environ.get('RAG_IVF_MIN_CHUNKS', '2000'))
+    # RAG配置: IVF索引文件路径(默认 DATA_DIR/knowledge_ivf.npz)，多worker/重启后复用，无需重新训练
+    RAG_IVF_INDEX_PATH = os.environ.get('RAG_IVF_INDEX_PATH', '')
+    # RAG上下文组装: 知识库检索/网络搜索/历史对话并发执行的截止时间(秒)，超时的阶段降级为空结果
+    RAG_KNOWLEDGE_TIMEOUT = float(os.environ.get('RAG_KNOWLEDGE_TIMEOUT', '8'))
+    RAG_SEARCH_TIMEOUT = float(os.environ.get('RAG_SEARCH_TIMEOUT', '8'))
+    RAG_HISTORY_TIMEOUT = float(os.environ.get('RAG_HISTORY_TIMEOUT', '5'))
+    # RAG上下文组装: 是否与知识库检索同时发起网络搜索(仅知识库无结果时采用)、线程池大小
+    RAG_SPECULATIVE_SEARCH = os.environ.get('RAG_SPECULATIVE_SEARCH', 'false').lower() == 'true'
+    RAG_CONTEXT_WORKERS = int(os.environ.get('RAG_CONTEXT_WORKERS', '8'))
+    # 混合检索: 是否启用BM25关键词检索与向量检索融合、RRF常数、跳过向量检索所需的问题词覆盖率(>1=从不跳过)和领先倍数
+    HYBRID_SEARCH_ENABLED = os.environ.get('HYBRID_SEARCH_ENABLED', 'true').lower() == 'true'
+    HYBRID_RRF_K = int(os.environ.get('HYBRID_RRF_K', '60'))
+    HYBRID_DECISIVE_COVERAGE = float(os.environ.get('HYBRID_DECISIVE_COVERAGE', '0.9'))
+    HYBRID_DECISIVE_MARGIN = float(os.environ.get('HYBRID_DECISIVE_MARGIN', '2.0'))
+    # 检索重排序: 是否启用、候选数、与最高分的最大差距(自适应阈值)、MMR相关度权重、每段最多合并的相邻块数
+    RERANK_ENABLED = os.environ.get('RERANK_ENABLED', 'true').lower() == 'true'
+    RERANK_CANDIDATES = int(os.environ.get('RERANK_CANDIDATES', '20'))
+    RERANK_SCORE_GAP = float(os.environ.get('RERANK_SCORE_GAP', '0.15'))
+    RERANK_MMR_LAMBDA = float(os.environ.get('RERANK_MMR_LAMBDA', '0.7'))
+    RERANK_MERGE_MAX = int(os.environ.get('RERANK_MERGE_MAX', '3'))
+    # 回答缓存: 每进程条数上限(0=禁用)、命中所需的问题相似度、存活时间(秒)；知识库变化时自动清空
+    ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '256'))
+    ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', '0.95'))
+    ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', '86400'))
+    # Prompt预算: 每次请求输入部分的token预算、历史对话最多占用的比例
+    PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '5000'))
+    PROMPT_HISTORY_SHARE = float(os.environ.get('PROMPT_HISTORY_SHARE', '0.3'))
+    # 会话摘要: 未摘要对话超过多少轮时在后台生成摘要(0=禁用)、摘要后保留原文的最近轮数、摘要最大字数
+    CHAT_SUMMARY_AFTER_TURNS = int(os.environ.get('CHAT_SUMMARY_AFTER_TURNS', '6'))
+    CHAT_SUMMARY_KEEP_TURNS = int(os.environ.get('CHAT_SUMMARY_KEEP_TURNS', '3'))
+    CHAT_SUMMARY_MAX_CHARS = int(os.environ.get('CHAT_SUMMARY_MAX_CHARS', '500'))
+    # 流式回答SSE输出: token合并窗口(毫秒)、合并字符数上限、无输出时的心跳间隔(秒，0=不发)
+    SSE_FLUSH_MS = float(os.environ.get('SSE_FLUSH_MS', '30'))
+    SSE_FLUSH_CHARS = int(os.environ.get('SSE_FLUSH_CHARS', '64'))
+    SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+    # ASGI入口(asgi.py): 处理Flask路由的线程数、异步流式对话上游连接池的最大连接数
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '8'))
+    ASGI_UPSTREAM_CONNECTIONS = int(os.environ.get('ASGI_UPSTREAM_CONNECTIONS', '200'))
+    # 问题向量缓存: 进程内条数上限(0=禁用)、存活时间(秒，默认7天)
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', '1024'))
+    QUERY_EMBEDDING_CACHE_TTL = float(os.environ.get('QUERY_EMBEDDING_CACHE_TTL', '604800'))
+    # 问题向量缓存: 是否写入数据库供多worker共享、数据库中保留的最大条数
+    QUERY_EMBEDDING_CACHE_PERSIST = os.environ.get('QUERY_EMBEDDING_CACHE_PERSIST', 'false').lower() == 'true'
+    QUERY_EMBEDDING_CACHE_PERSIST_MAX = int(os.environ.get('QUERY_EMBEDDING_CACHE_PERSIST_MAX', '20000'))
+    # 知识库后台任务: 每进程线程数(0=在请求内同步执行)、空闲轮询间隔(秒)、running任务心跳超时(秒)
+    INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', '1'))
+    INGESTION_POLL_SECONDS = float(os.environ.get('INGESTION_POLL_SECONDS', '5'))
+    INGESTION_JOB_STALE_SECONDS = float(os.environ.get('INGESTION_JOB_STALE_SECONDS', '600'))
+    # 知识库后台任务: 每次向量化并上报进度的文本块数
+    INGESTION_EMBED_WINDOW = int(os.environ.get('INGESTION_EMBED_WINDOW', '128'))
+    # 知识库配额: 文件数量上限、总存储上限(MB)
+    KNOWLEDGE_MAX_FILES = int(os.environ.get('KNOWLEDGE_MAX_FILES', '50'))
+    KNOWLEDGE_MAX_TOTAL_MB = int(os.environ.get('KNOWLEDGE_MAX_TOTAL_MB', '100'))
+    # RAG配置: 进程内向量索引与数据库比对指纹的间隔(秒)，多worker时据此发现其他进程的知识库变更
+    KNOWLEDGE_INDEX_REFRESH_SECONDS = float(os.environ.get('KNOWLEDGE_INDEX_REFRESH_SECONDS', '30'))
 
 class DevelopmentConfig(Config):
     """开发环境配置"""
@@ -155,6 +155,39 @@ class FAQ(db.Model):
         return f'<FAQ {self.question}>'
 
 
+class EmbeddingMixin:
+    """向量字段混入 - 以二进制存储文本块向量
+
+    embedding_blob 为小端 float32/float16 原始字节，可由 np.frombuffer 零拷贝读取；
+    旧版本写入的 JSON 文本 embedding 列保留用于兼容，读取时作为后备。
+    """
+    embedding = db.Column(db.Text, nullable=True)            # 旧版向量数据(JSON格式存储的浮点数组)
+    embedding_blob = db.Column(db.LargeBinary, nullable=True)  # 向量原始字节(小端)
+    embedding_dim = db.Column(db.Integer, nullable=True)       # 向量维度
+    embedding_dtype = db.Column(db.String(10), nullable=True)  # 存储类型: float32/float16
+
+    def set_embedding(self, embedding):
+        """写入向量（二进制格式）"""
+        from ai.embedding import encode_embedding
+        self.embedding_blob, self.embedding_dim, self.embedding_dtype = encode_embedding(embedding)
+
+    def get_embedding(self):
+        """读取向量，返回numpy数组；无向量时返回None"""
+        import json
+        import numpy as np
+        from ai.embedding import decode_embedding
+        if self.embedding_blob is not None:
+            return decode_embedding(self.embedding_blob, self.embedding_dim, self.embedding_dtype)
+        if self.embedding:
+            return np.asarray(json.loads(self.embedding), dtype=np.float32)
+        return None
+
+    @classmethod
+    def has_embedding(cls):
+        """查询条件：存在向量（二进制或旧版JSON）"""
+        return db.or_(cls.embedding_blob.isnot(None), cls.embedding.isnot(None))
+
+
 class KnowledgeFile(db.Model):
     """知识库文件模型 - 存储用户上传的知识库源文件"""
     __tablename__ = 'knowledge_files'
@@ -165,6 +198,8 @@ class KnowledgeFile(db.Model):
     file_type = db.Column(db.String(20), nullable=False)   # 文件类型: pdf/txt/md/docx
     file_data = db.Column(db.LargeBinary)                   # 文件二进制数据(存入DB,避免Render磁盘丢失)
     chunk_count = db.Column(db.Integer, default=0)          # 切分后的文本块数量
+    # 全部文本块写入完成后才置为True；入库过程中的文件不参与检索(见 ai/vector_index.py)
+    is_ready = db.Column(db.Boolean, default=True, server_default=db.true(), nullable=False)
     created_at = db.Column(db.DateTime, default=get_china_time)
 
     # 关系: 一个文件对应多个文本块
@@ -175,7 +210,7 @@ class KnowledgeFile(db.Model):
         return f'<KnowledgeFile {self.filename}>'
 
 
-class KnowledgeChunk(db.Model):
+class KnowledgeChunk(EmbeddingMixin, db.Model):
     """知识库文本块模型 - 存储切分后的文本片段及其向量"""
     __tablename__ = 'knowledge_chunks'
 
@@ -183,7 +218,7 @@ class KnowledgeChunk(db.Model):
     file_id = db.Column(db.Integer, db.ForeignKey('knowledge_files.id'), nullable=False, index=True)
     chunk_index = db.Column(db.Integer, nullable=False)     # 在源文件中的块序号
     content = db.Column(db.Text, nullable=False)             # 原文内容
-    embedding = db.Column(db.Text, nullable=True)            # 向量数据(JSON格式存储的浮点数组)
+    content_hash = db.Column(db.String(64), index=True)      # 向量存储键 sha256(模型名+原文)，见 ai/embedding_store.py
     created_at = db.Column(db.DateTime, default=get_china_time)
 
     def __repr__(self):
@@ -199,6 +234,7 @@ class ExternalKnowledge(db.Model):
     name = db.Column(db.String(200), nullable=False)           # 链接名称/描述
     provider = db.Column(db.String(30), default='webpage')     # 提供者类型: webpage/feishu_wiki/generic_api
     config_json = db.Column(db.Text, default='{}')             # 提供者配置(JSON): URL、app_id、api_key等
+    source_url = db.Column(db.String(1000))                    # 主URL明文(配置中的 url 或 api_url，由 set_config 维护)
     is_active = db.Column(db.Boolean, default=True)            # 是否启用
     last_synced = db.Column(db.DateTime)                       # 最后同步时间
     chunk_count = db.Column(db.Integer, default=0)             # 同步后的文本块数量
@@ -209,26 +245,44 @@ class ExternalKnowledge(db.Model):
     chunks = db.relationship('ExternalKnowledgeChunk', backref='source_link', lazy='dynamic',
                              cascade='all, delete-orphan')
 
+    @staticmethod
+    def is_sensitive_key(key):
+        """配置项是否为需要加密存储的敏感字段"""
+        sensitive_keys = ('api_key', 'app_secret', 'token', 'access_token',
+                         'secret', 'password', 'app_key')
+        return key in sensitive_keys or key.endswith(('_key', '_secret', '_token'))
+
+    @staticmethod
+    def primary_url(config):
+        """配置中的主URL（网页/飞书为 url，通用API为 api_url）"""
+        return config.get('url', '') or config.get('api_url', '')
+
     def get_config(self):
-        """获取配置字典（自动解密敏感字段）"""
+        """获取配置字典（自动解密敏感字段）
+
+        解密结果按 config_json 原文缓存在实例上，config_json 变化(set_config/直接赋值)后自动失效；
+        返回副本，调用方修改不影响缓存。
+        """
         import json
         from utils.encryption import decrypt_data
+        cached = getattr(self, '_config_cache', None)
+        if cached is not None and cached[0] == self.config_json:
+            return dict(cached[1])
         try:
             config = json.loads(self.config_json) if self.config_json else {}
         except (json.JSONDecodeError, TypeError):
             return {}
         # 解密敏感字段
-        sensitive_keys = ('api_key', 'app_secret', 'token', 'access_token',
-                         'secret', 'password', 'app_key')
         for key in list(config.keys()):
-            if key in sensitive_keys or key.endswith(('_key', '_secret', '_token')):
+            if self.is_sensitive_key(key):
                 raw = config[key]
                 if isinstance(raw, str) and raw:
                     try:
                         config[key] = decrypt_data(raw)
                     except Exception:
                         config[key] = raw  # 向后兼容旧明文数据
-        return config
+        self._config_cache = (self.config_json, config)
+        return dict(config)
 
     def set_config(self, config_dict):
         """设置配置字典（自动加密敏感字段）"""
@@ -236,10 +290,8 @@ class ExternalKnowledge(db.Model):
         from utils.encryption import encrypt_data
         safe_config = dict(config_dict)
         # 加密敏感字段
-        sensitive_keys = ('api_key', 'app_secret', 'token', 'access_token',
-                         'secret', 'password', 'app_key')
         for key in list(safe_config.keys()):
-            if key in sensitive_keys or key.endswith(('_key', '_secret', '_token')):
+            if self.is_sensitive_key(key):
                 val = safe_config[key]
                 if isinstance(val, str) and val:
                     try:
@@ -247,17 +299,26 @@ class ExternalKnowledge(db.Model):
                     except Exception:
                         pass  # 加密失败则保持原值，避免阻断流程
         self.config_json = json.dumps(safe_config, ensure_ascii=False)
+        self.source_url = self.primary_url(config_dict)[:1000]
+        self._config_cache = (self.config_json, dict(config_dict))
 
     @property
     def url(self):
-        """兼容属性：从config中提取主URL"""
-        return self.get_config().get('url', '') or self.get_config().get('api_url', '')
+        """兼容属性：主URL（读取明文列，不解析/解密配置；旧数据尚未回填时只解析JSON）"""
+        if self.source_url is not None:
+            return self.source_url
+        import json
+        try:
+            config = json.loads(self.config_json) if self.config_json else {}
+        except (json.JSONDecodeError, TypeError):
+            return ''
+        return self.primary_url(config)
 
     def __repr__(self):
         return f'<ExternalKnowledge {self.name} [{self.provider}]>'
 
 
-class ExternalKnowledgeChunk(db.Model):
+class ExternalKnowledgeChunk(EmbeddingMixin, db.Model):
     """外部知识库文本块模型 - 存储从外部URL抓取并切分后的文本片段及其向量"""
     __tablename__ = 'external_knowledge_chunks'
 
@@ -265,13 +326,100 @@ class ExternalKnowledgeChunk(db.Model):
     external_id = db.Column(db.Integer, db.ForeignKey('external_knowledge.id'), nullable=False, index=True)
     chunk_index = db.Column(db.Integer, nullable=False)     # 块序号
     content = db.Column(db.Text, nullable=False)             # 原文内容
-    embedding = db.Column(db.Text, nullable=True)            # 向量数据(JSON格式)
+    content_hash = db.Column(db.String(64), index=True)      # 向量存储键 sha256(模型名+原文)，见 ai/embedding_store.py
     created_at = db.Column(db.DateTime, default=get_china_time)
 
     def __repr__(self):
         return f'<ExternalKnowledgeChunk external_id={self.external_id} idx={self.chunk_index}>'
 
 
+class IngestionJob(db.Model):
+    """知识库后台任务模型 - 文件上传解析/外部知识库同步在后台线程执行(见 ai/jobs.py)"""
+    __tablename__ = 'ingestion_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)                 # 任务类型: knowledge_upload/external_sync
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued/running/succeeded/failed
+    stage = db.Column(db.String(20), default='queued')              # 进度阶段: queued/parsed/chunked/embedding/committed
+    progress_done = db.Column(db.Integer, default=0)                # 已向量化的文本块数
+    progress_total = db.Column(db.Integer, default=0)               # 文本块总数
+    message = db.Column(db.Text)                                    # 结果或错误信息
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    target_id = db.Column(db.Integer, nullable=True)                # 关联对象ID: 知识库文件ID/外部知识库ID
+    name = db.Column(db.String(255))                                # 显示名称: 文件名/链接名称
+    payload = db.Column(db.LargeBinary)                             # 待处理的文件数据(完成后清空)
+    options_json = db.Column(db.Text, default='{}')                 # 任务参数(JSON)
+    attempts = db.Column(db.Integer, default=0)                     # 已执行次数(worker异常退出后重新领取时累加)
+    worker = db.Column(db.String(50))                               # 执行该任务的进程/线程
+    created_at = db.Column(db.DateTime, default=get_china_time)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=get_china_time)     # 心跳: 每次进度更新时刷新
+
+    def to_dict(self):
+        """转换为状态查询接口返回的字典（不含文件数据）"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'progress_done': self.progress_done or 0,
+            'progress_total': self.progress_total or 0,
+            'message': self.message or '',
+            'target_id': self.target_id,
+            'name': self.name or '',
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else '',
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else '',
+        }
+
+    def __repr__(self):
+        return f'<IngestionJob {self.id} {self.kind} {self.status}>'
+
+
+class MaintenanceMarker(db.Model):
+    """后台维护标记模型 - 多进程间的执行租约，以及已知无法处理的数据(见 utils/encryption_migration.py)"""
+    __tablename__ = 'maintenance_markers'
+
+    name = db.Column(db.String(100), primary_key=True)   # 标记名称: lease:<任务> / rewrap_failed:<密文摘要>
+    owner = db.Column(db.String(100))                    # 租约持有者(主机名:进程号)
+    expires_at = db.Column(db.DateTime)                  # 租约到期时间；永久标记为空
+    created_at = db.Column(db.DateTime, default=get_china_time)
+
+    def __repr__(self):
+        return f'<MaintenanceMarker {self.name}>'
+
+
+class ChunkEmbedding(db.Model):
+    """文本块向量存储模型 - 按内容哈希去重，重新上传/同步时复用已计算的向量(见 ai/embedding_store.py)"""
+    __tablename__ = 'chunk_embeddings'
+
+    content_hash = db.Column(db.String(64), primary_key=True)  # sha256(模型名+文本块原文)
+    model = db.Column(db.String(100), nullable=False)          # Embedding模型名称
+    embedding_blob = db.Column(db.LargeBinary, nullable=False)  # 向量原始字节(小端float32)
+    embedding_dim = db.Column(db.Integer, nullable=False)       # 向量维度
+    embedding_dtype = db.Column(db.String(10), nullable=False)  # 存储类型
+    created_at = db.Column(db.DateTime, default=get_china_time)
+
+    def __repr__(self):
+        return f'<ChunkEmbedding {self.model} {self.content_hash[:8]}>'
+
+
+class QueryEmbeddingCache(db.Model):
+    """问题向量缓存模型 - 多个worker共享的问题向量持久缓存(见 ai/embedding_cache.py)"""
+    __tablename__ = 'query_embedding_cache'
+
+    cache_key = db.Column(db.String(64), primary_key=True)     # sha256(提供者+模型+规范化问题)
+    provider = db.Column(db.String(30), nullable=False)        # Embedding提供者
+    model = db.Column(db.String(100), nullable=False)          # Embedding模型名称
+    embedding_blob = db.Column(db.LargeBinary, nullable=False)  # 向量原始字节(小端float32)
+    embedding_dim = db.Column(db.Integer, nullable=False)       # 向量维度
+    embedding_dtype = db.Column(db.String(10), nullable=False)  # 存储类型
+    created_at = db.Column(db.DateTime, default=get_china_time, index=True)
+
+    def __repr__(self):
+        return f'<QueryEmbeddingCache {self.provider}/{self.model} {self.cache_key[:8]}>'
+
+
 class ChatMessage(db.Model):
     """对话消息模型 - 存储AI对话的聊天记录"""
     __tablename__ = 'chat_messages'
@@ -288,6 +436,25 @@ class ChatMessage(db.Model):
         return f'<ChatMessage {self.role} session={self.session_id}>'
 
 
+class ChatSummary(db.Model):
+    """会话摘要模型 - 长会话中较早的对话压缩成的摘要，回答后在后台更新(见 ai/summary.py)"""
+    __tablename__ = 'chat_summaries'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    session_id = db.Column(db.String(36), nullable=False)
+    summary = db.Column(db.Text, nullable=False)
+    covered_message_id = db.Column(db.Integer, nullable=False)      # 已并入摘要的最后一条消息ID
+    created_at = db.Column(db.DateTime, default=get_china_time)
+    updated_at = db.Column(db.DateTime, default=get_china_time, onupdate=get_china_time)
+
+    # 同一用户同一会话唯一
+    __table_args__ = (db.UniqueConstraint('user_id', 'session_id', name='uq_user_session_summary'),)
+
+    def __repr__(self):
+        return f'<ChatSummary session={self.session_id} covered={self.covered_message_id}>'
+
+
 class ChatUsage(db.Model):
     """对话使用量模型 - 记录每位用户每日的AI对话次数"""
     __tablename__ = 'chat_usage'
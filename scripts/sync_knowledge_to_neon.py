@@ -16,6 +16,8 @@
     5. 云端自动用智谱AI embedding-3 重新向量化（因为Ollama和智谱的向量不兼容）
     6. 已删除文件：从云端删除对应记录
     7. 已存在文件：跳过（除非 --re-vectorize）
+    8. 向量化时按内容哈希复用云端 chunk_embeddings 中已有的向量，只对新文本块调用API
+    9. 删除云端 chunk_embeddings 中不再被任何文本块引用的向量
 
 前置条件:
     - .env 中 NEON_DATABASE_URL 已配置
@@ -25,7 +27,6 @@
 
 import sys
 import os
-import json
 import time
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -34,6 +35,8 @@ from dotenv import load_dotenv
 load_dotenv(override=True)
 
 from app import app
+from ai.embedding import EMBEDDING_MODELS, encode_embedding
+from ai.embedding_store import content_hash, embed_texts_dedup, prune_unreferenced
 from models import db as local_db, KnowledgeFile as LocalKnowledgeFile, KnowledgeChunk as LocalKnowledgeChunk
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
@@ -70,6 +73,25 @@ def ensure_neon_tables(neon_session):
         chunk_index INTEGER NOT NULL,
         content TEXT NOT NULL,
         embedding JSONB,
+        embedding_blob BYTEA,
+        embedding_dim INTEGER,
+        embedding_dtype VARCHAR(10),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    ALTER TABLE knowledge_files ADD COLUMN IF NOT EXISTS is_ready BOOLEAN NOT NULL DEFAULT TRUE;
+    ALTER TABLE knowledge_chunks ADD COLUMN IF NOT EXISTS embedding_blob BYTEA;
+    ALTER TABLE knowledge_chunks ADD COLUMN IF NOT EXISTS embedding_dim INTEGER;
+    ALTER TABLE knowledge_chunks ADD COLUMN IF NOT EXISTS embedding_dtype VARCHAR(10);
+    ALTER TABLE knowledge_chunks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+    CREATE INDEX IF NOT EXISTS ix_knowledge_chunks_content_hash ON knowledge_chunks (content_hash);
+
+    CREATE TABLE IF NOT EXISTS chunk_embeddings (
+        content_hash VARCHAR(64) PRIMARY KEY,
+        model VARCHAR(100) NOT NULL,
+        embedding_blob BYTEA NOT NULL,
+        embedding_dim INTEGER NOT NULL,
+        embedding_dtype VARCHAR(10) NOT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     """
@@ -84,9 +106,9 @@ def ensure_neon_tables(neon_session):
 
 
 def get_local_files():
-    """获取本地SQLite中的所有知识库文件"""
+    """获取本地SQLite中的所有知识库文件（不含尚在入库中的文件）"""
     with app.app_context():
-        files = local_db.session.query(LocalKnowledgeFile).all()
+        files = local_db.session.query(LocalKnowledgeFile).filter_by(is_ready=True).all()
         result = []
         for f in files:
             chunks = local_db.session.query(LocalKnowledgeChunk).filter_by(file_id=f.id).all()
@@ -224,10 +246,12 @@ def sync_to_neon(dry_run=False, re_vectorize=False):
         embed_key = os.environ.get('SILICONFLOW_API_KEY')
         embed_fn = siliconflow_embed_texts
         embed_name = 'SiliconFlow bge-large-zh-v1.5(免费)'
+        embed_model = EMBEDDING_MODELS['siliconflow']
     else:
         embed_key = os.environ.get('ZHIPU_API_KEY')
         embed_fn = zhipu_embed_texts
         embed_name = '智谱AI embedding-3'
+        embed_model = EMBEDDING_MODELS['zhipu']
     
     if not embed_key:
         print(f"\n  警告: 未设置 {'SILICONFLOW_API_KEY' if embed_provider == 'siliconflow' else 'ZHIPU_API_KEY'}，无法在云端向量化！")
@@ -254,8 +278,8 @@ def sync_to_neon(dry_run=False, re_vectorize=False):
             admin_id = admin_row[0] if admin_row else 1
             
             neon_session.execute(text("""
-                INSERT INTO knowledge_files (user_id, filename, file_type, file_data, chunk_count, created_at)
-                VALUES (:uid, :fname, :ftype, :fdata, :ccount, :ctime)
+                INSERT INTO knowledge_files (user_id, filename, file_type, file_data, chunk_count, is_ready, created_at)
+                VALUES (:uid, :fname, :ftype, :fdata, :ccount, FALSE, :ctime)
             """), {
                 "uid": admin_id,
                 "fname": fname,
@@ -278,30 +302,43 @@ def sync_to_neon(dry_run=False, re_vectorize=False):
             if embed_key and chunks:
                 print(f"  向量化 {fname} ({len(chunks)}个片段)...")
                 chunk_texts = [c['content'] for c in chunks]
-                embeddings = embed_fn(chunk_texts, embed_key)
+                # 云端 chunk_embeddings 中已有的文本块直接复用，只对新内容调用API
+                embeddings, hashes = embed_texts_dedup(chunk_texts, engine=engine,
+                                                       embed_fn=lambda texts: embed_fn(texts, embed_key),
+                                                       model=embed_model, return_hashes=True)
                 
-                for chunk, embedding in zip(chunks, embeddings):
+                for chunk, embedding, chunk_hash in zip(chunks, embeddings, hashes):
+                    # 二进制格式写入（小端float32/float16原始字节）
+                    emb_blob, emb_dim, emb_dtype = encode_embedding(embedding)
                     neon_session.execute(text("""
-                        INSERT INTO knowledge_chunks (file_id, chunk_index, content, embedding, created_at)
-                        VALUES (:fid, :cidx, :content, :emb, CURRENT_TIMESTAMP)
+                        INSERT INTO knowledge_chunks (file_id, chunk_index, content, content_hash,
+                            embedding_blob, embedding_dim, embedding_dtype, created_at)
+                        VALUES (:fid, :cidx, :content, :hash, :blob, :dim, :dtype, CURRENT_TIMESTAMP)
                     """), {
                         "fid": neon_file_id,
                         "cidx": chunk['chunk_index'],
                         "content": chunk['content'],
-                        "emb": json.dumps(embedding, ensure_ascii=False)
+                        "hash": chunk_hash,
+                        "blob": emb_blob,
+                        "dim": emb_dim,
+                        "dtype": emb_dtype
                     })
             else:
                 # 无API密钥，只推原文不推向量
                 for chunk in chunks:
                     neon_session.execute(text("""
-                        INSERT INTO knowledge_chunks (file_id, chunk_index, content, created_at)
-                        VALUES (:fid, :cidx, :content, CURRENT_TIMESTAMP)
+                        INSERT INTO knowledge_chunks (file_id, chunk_index, content, content_hash, created_at)
+                        VALUES (:fid, :cidx, :content, :hash, CURRENT_TIMESTAMP)
                     """), {
                         "fid": neon_file_id,
                         "cidx": chunk['chunk_index'],
-                        "content": chunk['content']
+                        "content": chunk['content'],
+                        "hash": content_hash(embed_model, chunk['content'])
                     })
             
+            # 全部片段写入后才参与线上检索
+            neon_session.execute(text("UPDATE knowledge_files SET is_ready = TRUE WHERE id = :fid"),
+                                 {"fid": neon_file_id})
             neon_session.commit()
             action = "更新" if fname in to_update else "新增"
             print(f"  已{action}: {fname} ({len(chunks)}个片段)")
@@ -311,6 +348,13 @@ def sync_to_neon(dry_run=False, re_vectorize=False):
             print(f"  同步失败 {fname}: {e}")
     
     neon_session.close()
+
+    # 4d. 清理云端不再被引用的向量（已删除/已更新文件的旧文本块）
+    try:
+        prune_unreferenced(engine=engine)
+    except Exception as e:
+        print(f"  清理向量存储失败: {e}")
+
     print("\n" + "=" * 60)
     print("  同步完成!")
     print("=" * 60 + "\n")
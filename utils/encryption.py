@@ -12,20 +12,36 @@
 - 密钥绝不打印到日志，异常仅记录错误类型
 - PBKDF2 迭代次数 600000（OWASP 2023+ 推荐量级）
 
+信封加密（v3，默认）:
+旧格式每条记录都要用随机盐重新做一次 600000 次迭代的 PBKDF2(约0.5秒CPU)，
+导出40个资产的清单要解密40次、占用一个worker约20秒。现在:
+- 主密钥(KEK) = PBKDF2(ENCRYPTION_PASSWORD, KEK盐)，每个进程每个KEK盐只派生一次并缓存
+- 每条记录生成随机数据密钥(DEK)加密数据，DEK 再用 KEK 加密("包装")后随密文存储
+- 每条记录的加解密只需两次 Fernet 运算(微秒级)
+- 旧格式 salt_b64:cipher_b64 仍可解密；rewrap_data() 把旧格式(或其他KEK盐包装的)密文升级为当前格式，
+  后台迁移见 utils/encryption_migration.py
+
 使用方式:
-- encrypt_data(data): 加密数据（自动生成随机盐，返回 salt_b64:cipher_b64）
-- decrypt_data(encrypted_data): 解密数据（从密文中提取盐值）
-- encrypt_data_with_derived_key(data, password, salt): 使用自定义密码+显式盐加密
-- decrypt_data_with_derived_key(payload, password): 使用自定义密码解密
+- encrypt_data(data): 加密数据（信封加密，返回 v3:kek_salt_b64:wrapped_dek:cipher）
+- decrypt_data(encrypted_data): 解密数据（自动识别信封格式与旧格式）
+- decrypt_many(payloads): 批量解密（旧格式密文分散到线程池并行派生密钥，结果保持顺序）
+- needs_rewrap(payload) / rewrap_data(payload) / rewrap_many(payloads): 判断/升级旧格式密文
+- encrypt_data_with_derived_key(data, password, salt): 使用自定义密码+显式盐加密(旧格式)
+- decrypt_data_with_derived_key(payload, password): 使用自定义密码解密(旧格式)
 
 环境变量:
-- ENCRYPTION_KEY: Fernet加密密钥（必须设置，缺失则拒绝启动）
+- ENCRYPTION_KEY: Fernet加密密钥（必须设置，缺失则拒绝启动；未设置 ENCRYPTION_KEK_SALT 时用于派生KEK盐）
 - ENCRYPTION_PASSWORD: PBKDF2HMAC主密码（必须设置，缺失则拒绝启动）
+- ENCRYPTION_KEK_SALT: KEK盐(urlsafe base64，可选)；更换后新数据使用新KEK，旧数据仍可解密并由迁移重新包装
+- ENCRYPTION_DECRYPT_WORKERS: 批量解密旧格式密文的线程数（可选，默认 min(4, CPU核数)）
 """
 
 import base64
 import binascii
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
@@ -58,6 +74,34 @@ if not ENCRYPTION_PASSWORD:
 # OWASP 2023+ 推荐：PBKDF2-SHA256 迭代 ≥ 600000
 PBKDF2_ITERATIONS = 600000
 
+# 信封加密密文前缀: v3:kek_salt_b64:wrapped_dek:cipher
+ENVELOPE_PREFIX = 'v3'
+
+
+def _load_kek_salt() -> bytes:
+    """KEK盐: ENCRYPTION_KEK_SALT，未设置时由 ENCRYPTION_KEY 确定性派生（各进程一致）"""
+    configured = os.environ.get('ENCRYPTION_KEK_SALT')
+    if configured:
+        try:
+            salt = base64.urlsafe_b64decode(configured)
+        except (ValueError, binascii.Error):
+            salt = b''
+        if len(salt) < 16:
+            raise RuntimeError("ENCRYPTION_KEK_SALT 格式非法：必须为至少16字节的 urlsafe base64 字符串。")
+        return salt
+    return hashlib.sha256(b'kek-salt:' + ENCRYPTION_KEY.encode()).digest()[:16]
+
+
+KEK_SALT = _load_kek_salt()
+
+# KEK盐 -> 主密钥 Fernet（每个盐每个进程只派生一次）
+_kek_cache = {}
+_kek_lock = threading.Lock()
+
+# 批量解密旧格式密文的线程池（PBKDF2 计算期间释放GIL，按需创建）
+_bulk_pool = None
+_bulk_pool_lock = threading.Lock()
+
 
 def derive_key_from_password(password: str, salt: bytes) -> bytes:
     """使用PBKDF2HMAC从密码派生加密密钥。
@@ -116,30 +160,91 @@ def decrypt_data_with_derived_key(payload: str, password: str) -> str:
         raise ValueError("解密失败：密钥不匹配或数据损坏") from e
 
 
+def get_master_key(salt: bytes = None) -> Fernet:
+    """获取主密钥(KEK)：PBKDF2 派生结果按盐缓存在进程内。
+
+    Args:
+        salt: KEK盐，不传则使用当前 KEK_SALT
+
+    Returns:
+        用于包装/解包数据密钥的 Fernet 对象
+    """
+    if salt is None:
+        salt = KEK_SALT
+    kek = _kek_cache.get(salt)
+    if kek is None:
+        with _kek_lock:
+            kek = _kek_cache.get(salt)
+            if kek is None:
+                kek = Fernet(derive_key_from_password(ENCRYPTION_PASSWORD, salt))
+                _kek_cache[salt] = kek
+    return kek
+
+
+def _is_envelope(payload: str) -> bool:
+    return payload.startswith(ENVELOPE_PREFIX + ':')
+
+
+def _split_envelope(payload: str):
+    """拆分信封密文，返回 (KEK盐, 包装后的DEK, 数据密文)"""
+    _, salt_b64, wrapped_dek, cipher = payload.split(':', 3)
+    return base64.urlsafe_b64decode(salt_b64), wrapped_dek, cipher
+
+
+def _join_envelope(salt: bytes, wrapped_dek: str, cipher: str) -> str:
+    return ':'.join((ENVELOPE_PREFIX, base64.urlsafe_b64encode(salt).decode(), wrapped_dek, cipher))
+
+
+def encrypt_envelope(data: str) -> str:
+    """信封加密：随机数据密钥加密数据，数据密钥由缓存的主密钥包装。
+
+    Returns:
+        v3:kek_salt_b64:wrapped_dek:cipher 格式的密文字符串
+    """
+    if not data:
+        return None
+
+    dek = Fernet.generate_key()
+    wrapped_dek = get_master_key().encrypt(dek).decode()
+    cipher = Fernet(dek).encrypt(data.encode()).decode()
+    return _join_envelope(KEK_SALT, wrapped_dek, cipher)
+
+
+def decrypt_envelope(payload: str) -> str:
+    """解密信封格式密文（包装DEK所用的KEK盐从密文中读取）。"""
+    try:
+        salt, wrapped_dek, cipher = _split_envelope(payload)
+        dek = get_master_key(salt).decrypt(wrapped_dek.encode())
+        return Fernet(dek).decrypt(cipher.encode()).decode()
+    except (InvalidToken, ValueError, binascii.Error) as e:
+        # 安全：不打印密钥/敏感信息，仅记录错误类型
+        raise ValueError("解密失败：密钥不匹配或数据损坏") from e
+
+
 def encrypt_data(data: str, salt: bytes = None) -> str:
-    """对外加密接口。每条记录使用独立随机盐。
+    """对外加密接口。默认使用信封加密（每条记录独立随机数据密钥）。
 
     Args:
         data: 要加密的字符串数据
-        salt: 可选随机盐（16字节），不传则自动生成 os.urandom(16)
+        salt: 可选随机盐（16字节）；传入时按旧格式用该盐单独派生密钥（兼容用途，耗时约0.5秒）
 
     Returns:
-        salt_b64:cipher_b64 格式的密文字符串
+        v3:kek_salt_b64:wrapped_dek:cipher 格式的密文字符串（传入 salt 时为 salt_b64:cipher_b64）
     """
     if not data:
         return None
 
-    if salt is None:
-        salt = os.urandom(16)
+    if salt is not None:
+        return encrypt_data_with_derived_key(data, ENCRYPTION_PASSWORD, salt)
 
-    return encrypt_data_with_derived_key(data, ENCRYPTION_PASSWORD, salt)
+    return encrypt_envelope(data)
 
 
 def decrypt_data(encrypted_data: str) -> str:
     """对外解密接口。
 
     Args:
-        encrypted_data: salt_b64:cipher_b64 格式的密文字符串
+        encrypted_data: 信封格式或旧的 salt_b64:cipher_b64 格式的密文字符串
 
     Returns:
         解密后的原始字符串，失败返回 None
@@ -148,6 +253,102 @@ def decrypt_data(encrypted_data: str) -> str:
         return None
 
     try:
+        if _is_envelope(encrypted_data):
+            return decrypt_envelope(encrypted_data)
         return decrypt_data_with_derived_key(encrypted_data, ENCRYPTION_PASSWORD)
     except ValueError:
         return None
+
+
+def current_envelope_prefix() -> str:
+    """当前主密钥包装的密文的公共前缀（迁移时用于筛选需要升级的记录）"""
+    return f"{ENVELOPE_PREFIX}:{base64.urlsafe_b64encode(KEK_SALT).decode()}:"
+
+
+def needs_rewrap(payload: str) -> bool:
+    """密文是否需要升级：旧格式，或数据密钥由非当前 KEK盐 的主密钥包装。"""
+    if not payload:
+        return False
+    if not _is_envelope(payload):
+        return True
+    try:
+        return _split_envelope(payload)[0] != KEK_SALT
+    except (ValueError, binascii.Error):
+        return False
+
+
+def rewrap_data(payload: str) -> str:
+    """把密文升级为当前主密钥包装的信封格式。
+
+    旧格式需要完整解密后重新加密（一次 PBKDF2）；信封格式只重新包装数据密钥，数据密文不变。
+
+    Returns:
+        升级后的密文；无需升级时原样返回
+
+    Raises:
+        ValueError: 解密失败（密钥不匹配或数据损坏）
+    """
+    if not needs_rewrap(payload):
+        return payload
+    if not _is_envelope(payload):
+        return encrypt_envelope(decrypt_data_with_derived_key(payload, ENCRYPTION_PASSWORD))
+    try:
+        salt, wrapped_dek, cipher = _split_envelope(payload)
+        dek = get_master_key(salt).decrypt(wrapped_dek.encode())
+    except (InvalidToken, ValueError, binascii.Error) as e:
+        raise ValueError("解密失败：密钥不匹配或数据损坏") from e
+    return _join_envelope(KEK_SALT, get_master_key().encrypt(dek).decode(), cipher)
+
+
+def _get_bulk_pool() -> ThreadPoolExecutor:
+    global _bulk_pool
+    if _bulk_pool is None:
+        with _bulk_pool_lock:
+            if _bulk_pool is None:
+                workers = int(os.environ.get('ENCRYPTION_DECRYPT_WORKERS', '0')) or min(4, os.cpu_count() or 1)
+                _bulk_pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='bulk-decrypt')
+    return _bulk_pool
+
+
+def _map_ordered(fn, payloads) -> list:
+    """对每条密文执行 fn（失败为 None），旧格式密文(需要 PBKDF2)分散到线程池，结果保持原顺序。"""
+    def run(payload):
+        try:
+            return fn(payload)
+        except ValueError:
+            return None
+
+    results = [None] * len(payloads)
+    legacy = []
+    for index, payload in enumerate(payloads):
+        if not payload:
+            continue
+        if _is_envelope(payload):
+            results[index] = run(payload)
+        else:
+            legacy.append(index)
+    if len(legacy) == 1:
+        results[legacy[0]] = run(payloads[legacy[0]])
+    elif legacy:
+        for index, value in zip(legacy, _get_bulk_pool().map(run, [payloads[i] for i in legacy])):
+            results[index] = value
+    return results
+
+
+def decrypt_many(payloads) -> list:
+    """批量解密。
+
+    信封格式密文直接解密(微秒级)；旧格式密文每条需要一次 PBKDF2，分散到线程池并行执行。
+
+    Args:
+        payloads: 密文字符串列表（可含 None/空字符串）
+
+    Returns:
+        与输入顺序一致的明文列表，空密文或解密失败的位置为 None
+    """
+    return _map_ordered(decrypt_data, list(payloads))
+
+
+def rewrap_many(payloads) -> list:
+    """批量升级密文（见 rewrap_data），与输入顺序一致，解密失败的位置为 None。"""
+    return _map_ordered(rewrap_data, list(payloads))
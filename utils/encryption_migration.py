@@ -0,0 +1,245 @@
+"""
+加密格式迁移 - 在后台把旧格式密文升级为信封加密格式（见 utils/encryption.py）
+
+旧格式(salt_b64:cipher_b64)每次解密都要做一次 600000 次迭代的 PBKDF2，
+升级后解密只需两次 Fernet 运算。迁移范围:
+    - DigitalAsset.encrypted_password
+    - ExternalKnowledge.config_json 中的敏感字段(见 ExternalKnowledge.is_sensitive_key)
+
+每个进程在数据库初始化完成后启动一个后台线程，但只有取得租约(maintenance_markers 表中的
+lease:encryption_rewrap 行)的一个进程执行迁移，其余进程直接退出；执行者按ID顺序分批扫描一遍:
+    - 旧格式或由其他KEK盐包装(更换过 ENCRYPTION_KEK_SALT)的密文重新加密/重新包装
+    - 以"原密文未变"为条件更新，与用户同时修改时不会互相覆盖
+    - 解密失败(密钥不匹配、历史明文数据)的记录保持原样，并记录其密文摘要(rewrap_failed:<sha256>)，
+      以后启动时直接跳过，不再重复做 PBKDF2；记录被修改(密文变化)后会重新尝试
+    - 执行者异常退出时租约在 REWRAP_LEASE_SECONDS 后过期，之后启动的进程接手
+
+配置(环境变量，见 config.py):
+    ENCRYPTION_REWRAP_ENABLED: 启动时是否在后台执行迁移
+    ENCRYPTION_REWRAP_BATCH: 每批处理并提交的记录数
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from utils.encryption import current_envelope_prefix, needs_rewrap, rewrap_data, rewrap_many
+
+# 迁移执行租约（多个进程中只有持有者执行）
+REWRAP_LEASE = 'lease:encryption_rewrap'
+# 租约有效期(秒)，每处理一批续期；持有者异常退出后其他进程最迟在此时间后接手
+REWRAP_LEASE_SECONDS = 600
+# 解密失败的密文标记名前缀
+FAILED_MARKER_PREFIX = 'rewrap_failed:'
+
+_started = False
+_start_lock = threading.Lock()
+_stats = {'upgraded': 0, 'failed': 0, 'running': False}
+
+
+def get_rewrap_settings():
+    """读取加密格式迁移配置
+
+    Returns:
+        dict: enabled / batch_size
+    """
+    return {
+        'enabled': os.environ.get('ENCRYPTION_REWRAP_ENABLED', 'true').lower() == 'true',
+        'batch_size': max(1, int(os.environ.get('ENCRYPTION_REWRAP_BATCH', '20'))),
+    }
+
+
+def _lease_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"[:100]
+
+
+def acquire_lease(name=REWRAP_LEASE, seconds=REWRAP_LEASE_SECONDS):
+    """取得或续期维护租约（租约不存在、已过期或本进程已持有时成功）
+
+    Returns:
+        bool: 是否持有租约
+    """
+    from sqlalchemy.exc import IntegrityError
+    from models import db, MaintenanceMarker, get_china_time
+
+    now = get_china_time()
+    owner = _lease_owner()
+    values = {'owner': owner, 'expires_at': now + timedelta(seconds=seconds)}
+    taken = MaintenanceMarker.query.filter(
+        MaintenanceMarker.name == name,
+        db.or_(MaintenanceMarker.expires_at < now, MaintenanceMarker.owner == owner),
+    ).update(values, synchronize_session=False)
+    db.session.commit()
+    if taken:
+        return True
+    try:
+        db.session.add(MaintenanceMarker(name=name, **values))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def release_lease(name=REWRAP_LEASE):
+    """释放本进程持有的租约（置为已过期）"""
+    from models import db, MaintenanceMarker, get_china_time
+
+    MaintenanceMarker.query.filter_by(name=name, owner=_lease_owner()).update(
+        {'expires_at': get_china_time()}, synchronize_session=False)
+    db.session.commit()
+
+
+def _failed_marker(payload):
+    """解密失败标记名：当前KEK盐前缀 + 密文的 sha256（更换KEK盐或修改记录后标记失效）"""
+    digest = hashlib.sha256(f"{current_envelope_prefix()}{payload}".encode('utf-8')).hexdigest()
+    return FAILED_MARKER_PREFIX + digest
+
+
+def _known_failures(payloads):
+    """已知解密失败的密文
+
+    Returns:
+        set: payloads 中已标记为解密失败的密文
+    """
+    from models import MaintenanceMarker
+
+    markers = {_failed_marker(p): p for p in payloads}
+    if not markers:
+        return set()
+    rows = MaintenanceMarker.query.with_entities(MaintenanceMarker.name).filter(
+        MaintenanceMarker.name.in_(list(markers))).all()
+    return {markers[name] for (name,) in rows}
+
+
+def _mark_failures(payloads):
+    """记录解密失败的密文（调用方提交）"""
+    from models import db, MaintenanceMarker
+
+    for name in dict.fromkeys(_failed_marker(p) for p in payloads):
+        db.session.merge(MaintenanceMarker(name=name))
+
+
+def rewrap_assets(batch_size=20):
+    """升级全部数字资产密码的密文（已标记为解密失败的跳过）
+
+    Returns:
+        tuple: (升级条数, 失败条数)
+    """
+    from models import db, DigitalAsset
+
+    upgraded = failed = 0
+    last_id = 0
+    prefix = current_envelope_prefix()
+    while True:
+        rows = db.session.query(DigitalAsset.id, DigitalAsset.encrypted_password).filter(
+            DigitalAsset.id > last_id,
+            DigitalAsset.encrypted_password.isnot(None),
+            DigitalAsset.encrypted_password != '',
+            ~DigitalAsset.encrypted_password.startswith(prefix, autoescape=True),
+        ).order_by(DigitalAsset.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        known = _known_failures([row[1] for row in rows])
+        rows = [row for row in rows if row[1] not in known]
+        failures = []
+        for (asset_id, payload), new_payload in zip(rows, rewrap_many([row[1] for row in rows])):
+            if new_payload is None:
+                failures.append(payload)
+                continue
+            # 仅当密文未被并发修改时更新，不改动 updated_at
+            upgraded += DigitalAsset.query.filter_by(id=asset_id, encrypted_password=payload).update(
+                {'encrypted_password': new_payload, 'updated_at': DigitalAsset.updated_at},
+                synchronize_session=False)
+        _mark_failures(failures)
+        failed += len(failures)
+        db.session.commit()
+        acquire_lease()  # 续期
+    return upgraded, failed
+
+
+def rewrap_external_configs():
+    """升级外部知识库配置中敏感字段的密文（已标记为解密失败的跳过）
+
+    Returns:
+        tuple: (升级字段数, 失败字段数)
+    """
+    from models import db, ExternalKnowledge
+
+    upgraded = failed = 0
+    for link_id, config_json in db.session.query(ExternalKnowledge.id, ExternalKnowledge.config_json).all():
+        try:
+            config = json.loads(config_json) if config_json else {}
+        except (json.JSONDecodeError, TypeError):
+            continue
+        pending = {key: value for key, value in config.items()
+                   if ExternalKnowledge.is_sensitive_key(key) and isinstance(value, str) and needs_rewrap(value)}
+        known = _known_failures(list(pending.values()))
+        changed = 0
+        for key, value in pending.items():
+            if value in known:
+                continue
+            try:
+                config[key] = rewrap_data(value)
+                changed += 1
+            except ValueError:
+                _mark_failures([value])
+                failed += 1
+        if changed and ExternalKnowledge.query.filter_by(id=link_id, config_json=config_json).update(
+                {'config_json': json.dumps(config, ensure_ascii=False)}, synchronize_session=False):
+            upgraded += changed
+    db.session.commit()
+    return upgraded, failed
+
+
+def run_rewrap_migration(app, batch_size=20):
+    """扫描并升级全部旧格式密文（在应用上下文中执行；未取得租约时直接返回）"""
+    from models import db
+
+    _stats['running'] = True
+    try:
+        with app.app_context():
+            try:
+                if not acquire_lease():
+                    return  # 其他进程正在执行
+                try:
+                    assets = rewrap_assets(batch_size)
+                    configs = rewrap_external_configs()
+                finally:
+                    db.session.rollback()
+                    release_lease()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[WARN] 加密格式迁移中断(下次启动时继续): {type(e).__name__}")
+                return
+            finally:
+                db.session.remove()
+        upgraded, failed = assets[0] + configs[0], assets[1] + configs[1]
+        _stats['upgraded'] += upgraded
+        _stats['failed'] += failed
+        if upgraded or failed:
+            print(f"[INFO] 加密格式迁移完成: 升级 {upgraded} 条，解密失败 {failed} 条(已标记，以后跳过)")
+    finally:
+        _stats['running'] = False
+
+
+def start_rewrap_migration(app):
+    """启动本进程的后台迁移线程（每个进程只启动一次）"""
+    global _started
+    settings = get_rewrap_settings()
+    if not settings['enabled']:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=run_rewrap_migration, args=(app, settings['batch_size']),
+                     name='encryption-rewrap', daemon=True).start()
+
+
+def get_rewrap_stats():
+    """本进程迁移的升级/失败条数"""
+    return dict(_stats)
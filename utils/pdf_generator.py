@@ -6,7 +6,14 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+import glob
+import hashlib
+import io
+import json
 import os
+import tempfile
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 from utils.fonts import register_chinese_font, get_chinese_font_name, get_chinese_bold_font_name
@@ -87,47 +94,209 @@ def _format_actions(category_key, selected_actions):
     return lines
 
 
+MB = 1024 * 1024
+
+
+def get_pdf_cache_settings():
+    """读取生成文件的内存缓冲与声明书缓存配置
+
+    Returns:
+        dict: spool_bytes / cache_bytes
+    """
+    return {
+        'spool_bytes': int(max(0.0, float(os.environ.get('PDF_SPOOL_MAX_MB', '8'))) * MB),
+        'cache_bytes': int(max(0.0, float(os.environ.get('PDF_CACHE_MAX_MB', '32'))) * MB),
+    }
+
+
+def _new_buffer(settings):
+    """生成文件的写入缓冲：不超过 spool_bytes 时只在内存中，超过后转存到匿名临时文件(关闭即删除)"""
+    return tempfile.SpooledTemporaryFile(max_size=settings['spool_bytes'])
+
+
+def _rewind(buffer):
+    """写入完成后回到开头，返回文件大小"""
+    size = buffer.tell()
+    buffer.seek(0)
+    return size
+
+
+def remove_legacy_output_files(data_dir):
+    """删除旧版本写入 DATA_DIR/temp_pdfs 的生成文件（现在只在内存中生成，该目录不再使用）"""
+    output_dir = os.path.join(data_dir, 'temp_pdfs')
+    if not os.path.isdir(output_dir):
+        return
+    for path in glob.glob(os.path.join(output_dir, '*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    try:
+        os.rmdir(output_dir)
+    except OSError:
+        pass
+
+
+# ==============================================================================
+# 数字资产继承意愿声明书
+# ==============================================================================
+
+# 声明书版式版本：修改版式或固定文字后递增，使已缓存的PDF失效
+WILL_RENDER_VERSION = 1
+
+WILL_AUTHORIZATION_TEXT = "本人明确授权，在身故或丧失自主行为能力后，本人指定的联系人（继承人）可依据本声明书所载意愿，对以下各类数字资产进行处置："
+WILL_EXECUTOR_NOTE = "主要联系人将全权负责启动并主导本声明所涉的资产处置流程。仅当主要联系人无法履行职责时，备用联系方可接替其职责。此指定仅为操作授权，并不涉及或改变任何法定继承人之实质财产继承权。"
+WILL_LEGAL_TEXT = "本人确认，本声明书旨在清晰表达本人关于数字资产处置的最终意愿，并为继承人提供明确指引。本人理解，本声明书本身并非具有直接强制执行力的法律文件，数字资产的最终归属与处理须遵守《中华人民共和国民法典》等法律规定及各平台合约。本人建议，可将本声明书进行公证，或作为本人正式遗嘱之附件，以增强其法律参考效力。"
+
+# 资产类别表格中不随声明书变化的标题/风险提示(Paragraph标记)
+_CATEGORY_MARKUP = {
+    cat_key: (cat_info['title'].replace('\n', '<br/>'), cat_info.get('risk_tips', '').replace('\n', '<br/>'))
+    for cat_key, cat_info in ASSET_CATEGORIES.items()
+}
+
+# 已生成的声明书PDF: 声明书ID -> (内容指纹, PDF字节)，按最近使用顺序，总大小不超过 PDF_CACHE_MAX_MB
+_will_pdf_cache = OrderedDict()
+_will_pdf_cache_bytes = 0
+_will_pdf_cache_lock = threading.Lock()
+
+_will_styles = None
+_will_styles_lock = threading.Lock()
+
+
+def _get_will_styles():
+    """声明书使用的段落样式（每个进程只构建一次）
+
+    Paragraph 等 flowable 在排版时会保存自身状态，不能在并发的渲染之间共享，因此只缓存样式和固定文字。
+    """
+    global _will_styles
+    if _will_styles is None:
+        with _will_styles_lock:
+            if _will_styles is None:
+                styles = getSampleStyleSheet()
+                normal_font = get_chinese_font_name()
+                bold_font = get_chinese_bold_font_name()
+                cell = ParagraphStyle('CellBody', parent=styles['BodyText'],
+                    fontName=normal_font, fontSize=9.5, alignment=TA_LEFT, leading=15, spaceAfter=1,
+                    wordWrap='CJK')
+                _will_styles = {
+                    'normal_font': normal_font,
+                    'title': ParagraphStyle('CustomTitle', parent=styles['Heading1'],
+                        fontName=bold_font, fontSize=18, spaceAfter=14, alignment=TA_CENTER, leading=24,
+                        wordWrap='CJK'),
+                    'body': ParagraphStyle('CustomBody', parent=styles['BodyText'],
+                        fontName=normal_font, fontSize=10, spaceAfter=8, alignment=TA_JUSTIFY, leading=17,
+                        wordWrap='CJK'),
+                    'small': ParagraphStyle('SmallBody', parent=styles['BodyText'],
+                        fontName=normal_font, fontSize=9, spaceAfter=4, alignment=TA_JUSTIFY, leading=13,
+                        wordWrap='CJK'),
+                    'header': ParagraphStyle('TableHeader', parent=styles['BodyText'],
+                        fontName=bold_font, fontSize=10, textColor=colors.whitesmoke, alignment=TA_CENTER,
+                        leading=14, wordWrap='CJK'),
+                    'cell': cell,
+                    'cell_center': ParagraphStyle('CellCenter', parent=cell, alignment=TA_CENTER),
+                }
+    return _will_styles
+
+
+def will_fingerprint(will):
+    """声明书内容指纹: assets_data、status、updated_at 与版式版本的 sha256(前16位)
+
+    Args:
+        will: DigitalWill对象
+
+    Returns:
+        str: 16位十六进制字符串，内容不变时保持不变
+    """
+    payload = json.dumps({
+        'version': WILL_RENDER_VERSION,
+        'assets_data': will.assets_data,
+        'status': will.status,
+        'updated_at': will.updated_at.isoformat() if will.updated_at else None,
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def discard_will_pdf(will_id):
+    """从缓存中移除某份声明书的PDF（删除声明书时调用）"""
+    global _will_pdf_cache_bytes
+    with _will_pdf_cache_lock:
+        entry = _will_pdf_cache.pop(will_id, None)
+        if entry:
+            _will_pdf_cache_bytes -= len(entry[1])
+
+
+def _cache_will_pdf(will_id, fingerprint, data, cache_bytes):
+    global _will_pdf_cache_bytes
+    with _will_pdf_cache_lock:
+        old = _will_pdf_cache.pop(will_id, None)
+        if old:
+            _will_pdf_cache_bytes -= len(old[1])
+        _will_pdf_cache[will_id] = (fingerprint, data)
+        _will_pdf_cache_bytes += len(data)
+        while _will_pdf_cache_bytes > cache_bytes:
+            _, (_, evicted) = _will_pdf_cache.popitem(last=False)
+            _will_pdf_cache_bytes -= len(evicted)
+
+
 def generate_will_pdf(will):
-    """生成数字资产继承意愿声明书PDF
+    """生成数字资产继承意愿声明书PDF（在内存中生成，不写磁盘）
+
+    同一份声明书内容未变(见 will_fingerprint)时直接返回缓存的PDF，不再重新排版。
 
     Args:
         will: DigitalWill对象
 
     Returns:
-        PDF文件路径
+        dict:
+            - file: 已回到开头的二进制文件对象，由调用方(send_file)负责关闭
+            - size: 字节数(int)
+            - etag: 内容指纹(str)
     """
-    from flask import current_app
-    output_dir = os.path.join(current_app.config.get('DATA_DIR', 'temp_pdfs'), 'temp_pdfs')
-    os.makedirs(output_dir, exist_ok=True)
+    settings = get_pdf_cache_settings()
+    fingerprint = will_fingerprint(will)
+    etag = f'will-{will.id}-{fingerprint}'
+    with _will_pdf_cache_lock:
+        entry = _will_pdf_cache.get(will.id)
+        if entry and entry[0] == fingerprint:
+            _will_pdf_cache.move_to_end(will.id)
+            return {'file': io.BytesIO(entry[1]), 'size': len(entry[1]), 'etag': etag}
+
+    buffer = _new_buffer(settings)
+    try:
+        _render_will_pdf(will, buffer)
+    except Exception as e:
+        buffer.close()
+        print(f"PDF generation error: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+    size = _rewind(buffer)
 
-    filename = f'will_{will.id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
-    filepath = os.path.join(output_dir, filename)
+    # 单个文件不超过缓存容量的1/4时才缓存，避免一个大文件挤掉全部缓存
+    if size <= settings['cache_bytes'] // 4:
+        data = buffer.read()
+        buffer.close()
+        _cache_will_pdf(will.id, fingerprint, data, settings['cache_bytes'])
+        return {'file': io.BytesIO(data), 'size': size, 'etag': etag}
+    discard_will_pdf(will.id)
+    return {'file': buffer, 'size': size, 'etag': etag}
 
+
+def _render_will_pdf(will, target):
+    """排版声明书并写入 target（可写的二进制文件对象）"""
     doc = SimpleDocTemplate(
-        filepath, pagesize=A4,
+        target, pagesize=A4,
         rightMargin=48, leftMargin=48, topMargin=45, bottomMargin=45
     )
 
-    styles = getSampleStyleSheet()
-    normal_font = get_chinese_font_name()
-    bold_font = get_chinese_bold_font_name()
-
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'],
-        fontName=bold_font, fontSize=18, spaceAfter=14, alignment=TA_CENTER, leading=24,
-        wordWrap='CJK')
-
-    body_style = ParagraphStyle('CustomBody', parent=styles['BodyText'],
-        fontName=normal_font, fontSize=10, spaceAfter=8, alignment=TA_JUSTIFY, leading=17,
-        wordWrap='CJK')
-
-    small_style = ParagraphStyle('SmallBody', parent=styles['BodyText'],
-        fontName=normal_font, fontSize=9, spaceAfter=4, alignment=TA_JUSTIFY, leading=13,
-        wordWrap='CJK')
+    styles = _get_will_styles()
+    normal_font = styles['normal_font']
+    body_style = styles['body']
+    cell_style = styles['cell']
 
     story = []
-
     # 标题
-    story.append(Paragraph("数字资产继承意愿声明书", title_style))
+    story.append(Paragraph("数字资产继承意愿声明书", styles['title']))
     story.append(Spacer(1, 0.1 * inch))
 
     # 声明人信息
@@ -151,29 +320,18 @@ def generate_will_pdf(will):
     story.append(Spacer(1, 0.1 * inch))
 
     # 核心生效前提
-    story.append(Paragraph(
-        "本人明确授权，在身故或丧失自主行为能力后，本人指定的联系人（继承人）可依据本声明书所载意愿，对以下各类数字资产进行处置：",
-        body_style
-    ))
+    story.append(Paragraph(WILL_AUTHORIZATION_TEXT, body_style))
     story.append(Spacer(1, 0.1 * inch))
 
     # 数字资产类型与处置意愿 - 三列表格（匹配模板PDF格式）
     # 表头
     asset_table_data = [
-        [Paragraph('资产类别与示例', ParagraphStyle('th1', parent=styles['BodyText'],
-            fontName=bold_font, fontSize=10, textColor=colors.whitesmoke, alignment=TA_CENTER, leading=14, wordWrap='CJK')),
-         Paragraph('处置意愿<br/>（请勾选）', ParagraphStyle('th2', parent=styles['BodyText'],
-            fontName=bold_font, fontSize=10, textColor=colors.whitesmoke, alignment=TA_CENTER, leading=14, wordWrap='CJK')),
-         Paragraph('关键平台政策与风险提示<br/>（供参考）', ParagraphStyle('th3', parent=styles['BodyText'],
-            fontName=bold_font, fontSize=10, textColor=colors.whitesmoke, alignment=TA_CENTER, leading=14, wordWrap='CJK'))]
+        [Paragraph('资产类别与示例', styles['header']),
+         Paragraph('处置意愿<br/>（请勾选）', styles['header']),
+         Paragraph('关键平台政策与风险提示<br/>（供参考）', styles['header'])]
     ]
 
-    cell_style = ParagraphStyle('CellBody', parent=styles['BodyText'],
-        fontName=normal_font, fontSize=9.5, alignment=TA_LEFT, leading=15, spaceAfter=1,
-        wordWrap='CJK')
-    cell_style_center = ParagraphStyle('CellCenter', parent=cell_style, alignment=TA_CENTER)
-
-    for cat_key, cat_info in ASSET_CATEGORIES.items():
+    for cat_key, (title_markup, risk_markup) in _CATEGORY_MARKUP.items():
         selected = []
         if will.assets_data:
             cat_data = will.assets_data.get(cat_key)
@@ -185,12 +343,8 @@ def generate_will_pdf(will):
         action_lines = _format_actions(cat_key, selected)
         actions_para = Paragraph('<br/>'.join(action_lines), cell_style)
 
-        risk_tips_raw = cat_info.get('risk_tips', '')
-        risk_lines = risk_tips_raw.replace('\n', '<br/>')
-        risk_para = Paragraph(risk_lines, cell_style)
-
-        title_raw = cat_info['title'].replace('\n', '<br/>')
-        title_para = Paragraph(title_raw, cell_style_center)
+        risk_para = Paragraph(risk_markup, cell_style)
+        title_para = Paragraph(title_markup, styles['cell_center'])
 
         asset_table_data.append([title_para, actions_para, risk_para])
 
@@ -246,17 +400,11 @@ def generate_will_pdf(will):
         body_style
     ))
     story.append(Spacer(1, 0.05 * inch))
-    story.append(Paragraph(
-        "主要联系人将全权负责启动并主导本声明所涉的资产处置流程。仅当主要联系人无法履行职责时，备用联系方可接替其职责。此指定仅为操作授权，并不涉及或改变任何法定继承人之实质财产继承权。",
-        small_style
-    ))
+    story.append(Paragraph(WILL_EXECUTOR_NOTE, styles['small']))
     story.append(Spacer(1, 0.15 * inch))
 
     # 法律效力声明
-    story.append(Paragraph(
-        "本人确认，本声明书旨在清晰表达本人关于数字资产处置的最终意愿，并为继承人提供明确指引。本人理解，本声明书本身并非具有直接强制执行力的法律文件，数字资产的最终归属与处理须遵守《中华人民共和国民法典》等法律规定及各平台合约。本人建议，可将本声明书进行公证，或作为本人正式遗嘱之附件，以增强其法律参考效力。",
-        body_style
-    ))
+    story.append(Paragraph(WILL_LEGAL_TEXT, body_style))
     story.append(Spacer(1, 0.2 * inch))
 
     # 签署栏
@@ -275,16 +423,7 @@ def generate_will_pdf(will):
     ]))
     story.append(sign_table)
 
-    try:
-        doc.build(story)
-        if os.path.exists(filepath):
-            return filepath
-        raise Exception("PDF file was not created")
-    except Exception as e:
-        print(f"PDF generation error: {e}")
-        import traceback
-        traceback.print_exc()
-        raise
+    doc.build(story)
 
 
 def generate_asset_list_xlsx(user, assets):
@@ -295,18 +434,11 @@ def generate_asset_list_xlsx(user, assets):
         assets: DigitalAsset查询对象或列表
 
     Returns:
-        xlsx文件路径
+        dict: file / size / etag，同 generate_will_pdf（etag 为文件内容的 sha256）
     """
-    from flask import current_app
     import openpyxl
     from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-    from utils.encryption import decrypt_data
-
-    output_dir = os.path.join(current_app.config.get('DATA_DIR', 'temp_pdfs'), 'temp_pdfs')
-    os.makedirs(output_dir, exist_ok=True)
-
-    filename = f'assets_{user.id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    filepath = os.path.join(output_dir, filename)
+    from utils.encryption import decrypt_many
 
     wb = openpyxl.Workbook()
     ws = wb.active
@@ -358,6 +490,11 @@ def generate_asset_list_xlsx(user, assets):
         'other': '其他数字资产',
     }
 
+    # 一次性批量解密全部密码（失败留空）
+    assets = list(assets)
+    passwords = dict(zip((asset.id for asset in assets),
+                         decrypt_many([asset.encrypted_password for asset in assets])))
+
     categories = {}
     for asset in assets:
         cat = asset.category or 'other'
@@ -371,14 +508,7 @@ def generate_asset_list_xlsx(user, assets):
         cat_fill = PatternFill(start_color='E9ECEF', end_color='E9ECEF', fill_type='solid')
 
         for asset in cat_assets:
-            # 尝试解密密码，失败则留空
-            password = asset.encrypted_password or ''
-            display_pwd = ''
-            if password:
-                try:
-                    display_pwd = decrypt_data(password)
-                except Exception:
-                    display_pwd = ''  # 解密失败留空
+            display_pwd = passwords.get(asset.id) or ''
 
             ws.cell(row=row_idx, column=1, value=cat_label).font = normal_font_xl
             ws.cell(row=row_idx, column=2, value=asset.platform_name or '').font = normal_font_xl
@@ -401,5 +531,15 @@ def generate_asset_list_xlsx(user, assets):
     ws.cell(row=row_idx, column=1, value='说明：密码栏为空表示该资产密码经加密存储，无法在此导出。如需查看密码，请登录平台在资产详情中查看。').font = Font(name='微软雅黑', size=9, color='666666')
     ws.cell(row=row_idx, column=1).alignment = Alignment(wrap_text=True)
 
-    wb.save(filepath)
-    return filepath
+    buffer = _new_buffer(get_pdf_cache_settings())
+    try:
+        wb.save(buffer)
+    except Exception:
+        buffer.close()
+        raise
+    size = _rewind(buffer)
+    digest = hashlib.sha256()
+    for block in iter(lambda: buffer.read(64 * 1024), b''):
+        digest.update(block)
+    buffer.seek(0)
+    return {'file': buffer, 'size': size, 'etag': digest.hexdigest()[:32]}